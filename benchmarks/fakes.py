@@ -0,0 +1,624 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the external services used by the API (GCS, BigQuery, Redis and
+Infisical), so the app can be driven in-process without any credentials or network access.
+"""
+
+import asyncio
+import fnmatch
+import io
+import re
+import time
+import zlib
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+import pendulum
+import xarray as xr
+from google.cloud import bigquery
+from PIL import Image
+
+
+@dataclass(frozen=True)
+class NamingScheme:
+    """Describes how BLOBs of a given series are named in the bucket, mirroring the arguments
+    that `get_matching_blobs` receives."""
+
+    path_prefix: str
+    blob_name_prefix: str = ""
+    blob_extension: str = ".png"
+    timestamp_format: str = "YYYY-MM-DD HH:mm:ss"
+    interval_seconds: int = 600
+
+    def blob_name(self, timestamp: pendulum.DateTime) -> str:
+        return (
+            self.path_prefix.rstrip("/")
+            + "/"
+            + self.blob_name_prefix
+            + timestamp.format(self.timestamp_format)
+            + self.blob_extension
+        )
+
+
+def default_naming_schemes() -> List[NamingScheme]:
+    """Naming schemes currently used by the satellite and radar routers."""
+    satellite_prefixes = ["CAPE", "KI", "SI", "LI", "TT", "RR", "SST"]
+    schemes = [
+        NamingScheme(
+            path_prefix="cor-clima-imagens/satelite/goes16/without_background/",
+            blob_name_prefix=f"{prefix}_",
+        )
+        for prefix in satellite_prefixes
+    ]
+    schemes.append(
+        NamingScheme(
+            path_prefix="cor-clima-imagens/radar/mendanha/refletividade_horizontal/without_background/without_colorbar/",
+            timestamp_format="YYYY-MM-DD-HH-mm-ss",
+            interval_seconds=300,
+        )
+    )
+    return schemes
+
+
+class FakeBlob:
+    def __init__(self, name: str, bucket: "FakeBucket", generation: int):
+        self.name = name
+        self.bucket = bucket
+        self.generation = generation
+        self.content_type = "image/png"
+
+    @property
+    def public_url(self) -> str:
+        return (
+            f"https://storage.googleapis.com/{self.bucket.name}/"
+            f"{quote(self.name, safe='/~')}"
+        )
+
+    @property
+    def size(self) -> int:
+        return len(self.bucket.payload(self.name))
+
+    def download_as_bytes(self, *args, **kwargs) -> bytes:
+        return self.bucket.payload(self.name)
+
+
+class FakeBucket:
+    """In-memory bucket. BLOB names are kept sorted so prefix listings are a binary search, and
+    the fake itself doesn't dominate the measured latencies."""
+
+    def __init__(
+        self,
+        name: str,
+        blob_names: List[str] = None,
+        image_size: Tuple[int, int] = (1200, 1200),
+    ):
+        self.name = name
+        self.image_size = image_size
+        self._names: List[str] = sorted(blob_names or [])
+        self._payload: Optional[bytes] = None
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def add_blob(self, name: str) -> None:
+        index = bisect_left(self._names, name)
+        if index == len(self._names) or self._names[index] != name:
+            self._names.insert(index, name)
+
+    def exists(self, *args, **kwargs) -> bool:
+        return True
+
+    def reload(self, *args, **kwargs) -> None:
+        return None
+
+    def blob(self, name: str, generation: int = None, *args, **kwargs) -> FakeBlob:
+        return FakeBlob(name, self, generation=generation or self._generation(name))
+
+    def get_blob(self, name: str, *args, **kwargs) -> Optional[FakeBlob]:
+        index = bisect_left(self._names, name)
+        if index < len(self._names) and self._names[index] == name:
+            return self.blob(name)
+        return None
+
+    def list_blobs(
+        self,
+        prefix: str = None,
+        max_results: int = None,
+        match_glob: str = None,
+        **kwargs,
+    ) -> Iterator[FakeBlob]:
+        prefix = prefix or ""
+        index = bisect_left(self._names, prefix)
+        count = 0
+        while index < len(self._names) and self._names[index].startswith(prefix):
+            name = self._names[index]
+            index += 1
+            if match_glob and not fnmatch.fnmatchcase(name, match_glob):
+                continue
+            yield self.blob(name)
+            count += 1
+            if max_results is not None and count >= max_results:
+                return
+
+    def payload(self, name: str) -> bytes:
+        """Every BLOB has the same content: a PNG of smooth colored bands over a transparent
+        background, shaped like the rendered product maps."""
+        if self._payload is None:
+            width, height = self.image_size
+            y, x = np.mgrid[0:height, 0:width]
+            field = np.sin(x / 97.0) + np.cos(y / 61.0) + np.sin((x + y) / 143.0)
+            levels = np.digitize(field, np.linspace(-2.5, 2.5, 12))
+            rgba = np.zeros((height, width, 4), dtype=np.uint8)
+            rgba[..., 0] = levels * 21
+            rgba[..., 1] = 255 - levels * 18
+            rgba[..., 2] = 120
+            rgba[..., 3] = np.where(levels > 3, 200, 0)
+            output = io.BytesIO()
+            Image.fromarray(rgba).save(output, format="PNG")
+            self._payload = output.getvalue()
+        return self._payload
+
+    @staticmethod
+    def _generation(name: str) -> int:
+        return zlib.crc32(name.encode())
+
+
+class FakeStorageClient:
+    def __init__(self, buckets: Dict[str, FakeBucket]):
+        self.buckets = buckets
+        self.project = "fake-project"
+
+    def get_bucket(self, bucket_name: str, *args, **kwargs) -> FakeBucket:
+        return self.buckets[bucket_name]
+
+    def bucket(self, bucket_name: str, *args, **kwargs) -> FakeBucket:
+        return self.buckets[bucket_name]
+
+    def lookup_bucket(self, bucket_name: str, *args, **kwargs) -> Optional[FakeBucket]:
+        return self.buckets.get(bucket_name)
+
+    def list_blobs(self, bucket_or_name, *args, **kwargs) -> Iterator[FakeBlob]:
+        bucket = (
+            bucket_or_name
+            if isinstance(bucket_or_name, FakeBucket)
+            else self.buckets[bucket_or_name]
+        )
+        return bucket.list_blobs(*args, **kwargs)
+
+
+def build_fake_bucket(
+    *,
+    bucket_name: str = "datario-public",
+    blob_count: int = 1000,
+    naming_schemes: List[NamingScheme] = None,
+    end_time: pendulum.DateTime = None,
+) -> FakeBucket:
+    """Build a bucket holding `blob_count` BLOBs per naming scheme, ending at `end_time`
+    (defaults to now) and spaced by each scheme's interval.
+    """
+    naming_schemes = naming_schemes or default_naming_schemes()
+    end_time = end_time or pendulum.now("America/Sao_Paulo")
+    names = []
+    for scheme in naming_schemes:
+        last = end_time.subtract(
+            seconds=end_time.int_timestamp % scheme.interval_seconds
+        )
+        for i in range(blob_count):
+            names.append(
+                scheme.blob_name(last.subtract(seconds=i * scheme.interval_seconds))
+            )
+    return FakeBucket(bucket_name, names)
+
+
+class FakeQueryJob:
+    def __init__(
+        self, dataframe: pd.DataFrame, *, dry_run: bool = False, latency: float = 0
+    ):
+        self._dataframe = dataframe
+        self.dry_run = dry_run
+        self.latency = latency
+        self.job_id = f"fake-{id(self)}"
+        self.cache_hit = False
+        self.slot_millis = 0 if dry_run else len(dataframe)
+        self.total_bytes_processed = len(dataframe) * 64
+        self.total_bytes_billed = 0 if dry_run else self.total_bytes_processed
+
+    def result(self, *args, **kwargs) -> "FakeQueryJob":
+        if self.latency:
+            time.sleep(self.latency)
+        return self
+
+    def to_dataframe(self, *args, **kwargs) -> pd.DataFrame:
+        self.result()
+        return self._dataframe
+
+
+class FakeBigQueryClient:
+    """Answers queries with synthetic `data_medicao`/`valor` frames spanning the `start_time`/
+    `end_time` query parameters, one row every `interval_seconds`. A fraction of the values are
+    NaN and a fraction of the rows are duplicated, as happens in the real table. Queries over
+    several products (a `products` array parameter) get one series per product, labelled in
+    `produto_satelite`. Queries selecting the coordinates get them too, for a single point.
+    """
+
+    def __init__(
+        self,
+        *,
+        interval_seconds: int = 600,
+        nan_ratio: float = 0.05,
+        duplicate_ratio: float = 0.05,
+        latency: float = 0,
+        seed: int = 0,
+    ):
+        self.interval_seconds = interval_seconds
+        self.nan_ratio = nan_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.latency = latency
+        self.project = "fake-project"
+        self._rng = np.random.default_rng(seed)
+
+    def query(self, query: str, job_config=None, *args, **kwargs) -> FakeQueryJob:
+        params = {
+            param.name: param.value
+            for param in getattr(job_config, "query_parameters", None) or []
+            if hasattr(param, "value")
+        }
+        arrays = {
+            param.name: param.values
+            for param in getattr(job_config, "query_parameters", None) or []
+            if hasattr(param, "values")
+        }
+        if "products" in arrays:
+            frames = []
+            for column in arrays["products"]:
+                frame = self._synthetic_frame(
+                    params.get("start_time"), params.get("end_time")
+                )
+                frames.append(frame.assign(produto_satelite=column))
+            dataframe = pd.concat(frames, ignore_index=True)
+        else:
+            dataframe = self._synthetic_frame(
+                params.get("start_time"), params.get("end_time")
+            )
+        selected = re.search(r"SELECT(.*?)FROM", query, re.DOTALL)
+        if selected and "latitude" in selected.group(1):
+            dataframe = dataframe.assign(latitude=-22.9, longitude=-43.4)
+        return FakeQueryJob(
+            dataframe,
+            dry_run=bool(getattr(job_config, "dry_run", False)),
+            latency=self.latency,
+        )
+
+    def get_table(self, table, *args, **kwargs) -> bigquery.Table:
+        # The layout of the real metrics table: formatted timestamps, neither partitioned
+        # nor clustered
+        return bigquery.Table(
+            f"{self.project}.{table.split('.', 1)[-1]}",
+            schema=[
+                bigquery.SchemaField("data_medicao", "STRING"),
+                bigquery.SchemaField("produto_satelite", "STRING"),
+                bigquery.SchemaField("valor", "FLOAT"),
+                bigquery.SchemaField("latitude", "FLOAT"),
+                bigquery.SchemaField("longitude", "FLOAT"),
+            ],
+        )
+
+    def _synthetic_frame(self, start_time, end_time) -> pd.DataFrame:
+        if start_time is None or end_time is None:
+            return pd.DataFrame({"data_medicao": [], "valor": []})
+        start = _to_timestamp(start_time)
+        end = _to_timestamp(end_time)
+        index = pd.date_range(
+            start.ceil(f"{self.interval_seconds}s"),
+            end,
+            freq=f"{self.interval_seconds}s",
+        )
+        values = self._rng.gamma(2.0, 500.0, size=len(index))
+        values[self._rng.random(len(index)) < self.nan_ratio] = np.nan
+        dataframe = pd.DataFrame(
+            {
+                "data_medicao": index.strftime("%Y-%m-%d %H:%M:%S"),
+                "valor": values,
+            }
+        )
+        duplicates = dataframe.sample(frac=self.duplicate_ratio, random_state=0)
+        return pd.concat([dataframe, duplicates], ignore_index=True)
+
+
+def _to_timestamp(value) -> pd.Timestamp:
+    if isinstance(value, str):
+        value = re.sub(r"[+-]\d{2}:\d{2}$", "", value)
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("America/Sao_Paulo").tz_localize(None)
+    return timestamp
+
+
+def build_fake_gridded_store(
+    path: str,
+    variable: str,
+    *,
+    days: int = 7,
+    interval_seconds: int = 600,
+    extent: Tuple[float, float, float, float] = (-43.8, -23.1, -43.1, -22.75),
+    resolution: float = 0.01,
+    end_time: pendulum.DateTime = None,
+) -> None:
+    """Write a chunked Zarr store with the layout expected by `app.gridded_data`: a single
+    variable over naive UTC `time` and descending `lat`/ascending `lon` coordinates."""
+    end_time = (end_time or pendulum.now("UTC")).in_tz("UTC")
+    end = pd.Timestamp(end_time.naive()).floor(f"{interval_seconds}s")
+    times = pd.date_range(
+        end=end, periods=days * 86400 // interval_seconds, freq=f"{interval_seconds}s"
+    )
+    min_lon, min_lat, max_lon, max_lat = extent
+    lats = np.arange(max_lat, min_lat, -resolution)
+    lons = np.arange(min_lon, max_lon, resolution)
+    rng = np.random.default_rng(0)
+    values = rng.gamma(2.0, 500.0, size=(len(times), len(lats), len(lons))).astype(
+        "float32"
+    )
+    dataset = xr.Dataset(
+        {variable: (("time", "lat", "lon"), values)},
+        coords={"time": times, "lat": lats, "lon": lons},
+    )
+    dataset.to_zarr(
+        path,
+        mode="w",
+        consolidated=True,
+        encoding={variable: {"chunks": (144, 16, 16)}},
+    )
+
+
+class FakeRedis:
+    """Minimal asyncio Redis stand-in, implementing the subset of commands the app uses."""
+
+    def __init__(self, *args, **kwargs):
+        self._data: Dict[str, bytes] = {}
+        self._expires: Dict[str, float] = {}
+        self._subscriptions: List["FakePubSub"] = []
+        self._hashes: Dict[str, Tuple[float, float]] = {}
+        self._sorted_sets: Dict[str, Dict[str, float]] = {}
+        self._sizes: Dict[str, Dict[str, int]] = {}
+
+    def _expired(self, key: str) -> bool:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+            return True
+        return False
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode()
+
+    async def ping(self) -> bool:
+        return True
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if self._expired(key):
+            return None
+        return self._data.get(key)
+
+    async def set(
+        self,
+        key: str,
+        value,
+        ex: int = None,
+        px: int = None,
+        nx: bool = False,
+        xx: bool = False,
+    ):
+        exists = await self.get(key) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+        self._data[key] = self._encode(value)
+        self._expires.pop(key, None)
+        if ex is not None:
+            self._expires[key] = time.monotonic() + ex
+        elif px is not None:
+            self._expires[key] = time.monotonic() + px / 1000
+        return True
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [await self.get(key) for key in keys]
+
+    async def incr(self, key: str) -> int:
+        value = int(await self.get(key) or 0) + 1
+        self._data[key] = self._encode(value)
+        return value
+
+    async def zadd(self, name: str, mapping: Dict[str, float], xx: bool = False) -> int:
+        members = self._sorted_sets.setdefault(name, {})
+        added = 0
+        for member, score in mapping.items():
+            if xx and member not in members:
+                continue
+            added += member not in members
+            members[member] = float(score)
+        return added
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+    async def delete(self, *keys: str) -> int:
+        deleted = 0
+        for key in keys:
+            self._expires.pop(key, None)
+            if self._data.pop(key, None) is not None:
+                deleted += 1
+        return deleted
+
+    async def flushdb(self) -> bool:
+        self._data.clear()
+        self._expires.clear()
+        self._hashes.clear()
+        self._sorted_sets.clear()
+        self._sizes.clear()
+        return True
+
+    async def ttl(self, key: str) -> int:
+        if self._expired(key) or key not in self._data:
+            return -2
+        expires_at = self._expires.get(key)
+        if expires_at is None:
+            return -1
+        return int(expires_at - time.monotonic())
+
+    async def publish(self, channel: str, message) -> int:
+        receivers = [
+            pubsub for pubsub in self._subscriptions if channel in pubsub.channels
+        ]
+        for pubsub in receivers:
+            pubsub.messages.put_nowait(
+                {"type": "message", "channel": channel, "data": self._encode(message)}
+            )
+        return len(receivers)
+
+    def pubsub(self) -> "FakePubSub":
+        return FakePubSub(self)
+
+    def register_script(self, script: str):
+        """Lua can't run here, so scripts are recognized by their `-- name` first line and run
+        as Python ports."""
+        name = script.strip().splitlines()[0].lstrip("- ").strip()
+        implementation = {
+            "cache_rendition": self._cache_rendition,
+            "token_bucket": self._token_bucket,
+        }[name]
+
+        async def run(keys=(), args=()):
+            return implementation(list(keys), list(args))
+
+        return run
+
+    def _token_bucket(self, keys: List[str], args: list) -> list:
+        rate, capacity, cost = (float(arg) for arg in args)
+        now = time.monotonic()
+        buckets = [self._hashes.get(key, (capacity, now)) for key in keys]
+        tokens = [
+            min(capacity, available + max(0.0, now - updated_at) * rate)
+            for available, updated_at in buckets
+        ]
+        wait = max([(cost - available) / rate for available in tokens] + [0.0])
+        if wait == 0:
+            tokens = [available - cost for available in tokens]
+        for key, available in zip(keys, tokens):
+            self._hashes[key] = (available, now)
+        return [1 if wait == 0 else 0, str(min(tokens + [capacity])), str(wait)]
+
+    def _cache_rendition(self, keys: List[str], args: list) -> int:
+        key, index_key, sizes_key, bytes_key = keys
+        content, ttl, used_at, max_bytes = args
+        index = self._sorted_sets.setdefault(index_key, {})
+        sizes = self._sizes.setdefault(sizes_key, {})
+        previous = sizes.get(key, 0)
+        self._data[key] = content
+        self._expires[key] = time.monotonic() + int(ttl)
+        index[key] = float(used_at)
+        sizes[key] = len(content)
+        total = int(self._data.get(bytes_key, 0)) + len(content) - previous
+        while total > int(max_bytes) and index:
+            oldest = min(index, key=index.get)
+            del index[oldest]
+            total -= sizes.pop(oldest, 0)
+            self._data.pop(oldest, None)
+            self._expires.pop(oldest, None)
+        self._data[bytes_key] = self._encode(total)
+        return total
+
+    async def aclose(self) -> None:
+        return None
+
+
+class FakePipeline:
+    """Queues commands and runs them, in order, on `execute`."""
+
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self._commands = []
+
+    def __getattr__(self, name: str):
+        def queue(*args, **kwargs):
+            self._commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self) -> list:
+        commands, self._commands = self._commands, []
+        return [await command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class FakePubSub:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.channels: Set[str] = set()
+        self.messages: asyncio.Queue = asyncio.Queue()
+
+    async def subscribe(self, *channels: str) -> None:
+        self.channels.update(channels)
+        if self not in self.redis._subscriptions:
+            self.redis._subscriptions.append(self)
+
+    async def unsubscribe(self, *channels: str) -> None:
+        self.channels.difference_update(channels or set(self.channels))
+
+    async def get_message(
+        self, ignore_subscribe_messages: bool = False, timeout: float = 0.0
+    ) -> Optional[dict]:
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def _cache_rendition(self, keys: List[str], args: list) -> int:
+        key, index_key, sizes_key, bytes_key = keys
+        content, ttl, used_at, max_bytes = args
+        index = self._sorted_sets.setdefault(index_key, {})
+        sizes = self._sizes.setdefault(sizes_key, {})
+        previous = sizes.get(key, 0)
+        self._data[key] = content
+        self._expires[key] = time.monotonic() + int(ttl)
+        index[key] = float(used_at)
+        sizes[key] = len(content)
+        total = int(self._data.get(bytes_key, 0)) + len(content) - previous
+        while total > int(max_bytes) and index:
+            oldest = min(index, key=index.get)
+            del index[oldest]
+            total -= sizes.pop(oldest, 0)
+            self._data.pop(oldest, None)
+            self._expires.pop(oldest, None)
+        self._data[bytes_key] = self._encode(total)
+        return total
+
+    async def aclose(self) -> None:
+        if self in self.redis._subscriptions:
+            self.redis._subscriptions.remove(self)
+
+    async def close(self) -> None:
+        return None
+
+
+class FakeCredentials:
+    project_id = "fake-project"
+
+    def with_scopes(self, *args, **kwargs) -> "FakeCredentials":
+        return self
+
+
+class FakeInfisicalClient:
+    """Stand-in for `infisical.InfisicalClient` that injects no secrets."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_all_secrets(self, *args, **kwargs) -> list:
+        return []
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Bootstraps the API against the local stand-ins in `benchmarks.fakes` and drives it in-process
+through its ASGI interface, collecting latency, throughput and memory figures.
+"""
+
+import asyncio
+import base64
+import os
+import tempfile
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import orjson as json
+
+from benchmarks import fakes
+
+FAKE_ENVIRONMENT = {
+    "ENVIRONMENT": "dev",
+    "INFISICAL_ADDRESS": "http://localhost",
+    "INFISICAL_TOKEN": "fake-token",
+    "BIGQUERY_TABLE_INDICE_ESTABILIDADE": "fake.dataset.indice_estabilidade",
+    "BIGQUERY_TABLE_METRICAS_GEOESPACIAIS": "fake.dataset.metricas_geoespaciais",
+    "BIGQUERY_TABLE_TAXA_PRECIPITACAO": "fake.dataset.taxa_precipitacao",
+    "BIGQUERY_TABLE_TEMPERATURA_OCEANO": "fake.dataset.temperatura_oceano",
+    "GCP_SERVICE_ACCOUNT_CREDENTIALS": base64.b64encode(b"{}").decode(),
+    # The gridded store is built locally rather than synced from the bucket
+    "GRIDDED_DATA_SYNC_ENABLE": "false",
+    "LOG_LEVEL": "WARNING",
+    "METRICS_MIRROR_DAYS": "14",
+    "METRICS_MIRROR_ENABLE": "true",
+    # Every request comes from the same client, so its bucket is made large enough for any
+    # run. The limiter still runs, so its overhead is measured.
+    "RATE_LIMIT_BURST": "1000000000",
+}
+
+
+@dataclass
+class Services:
+    storage_client: fakes.FakeStorageClient
+    bigquery_client: fakes.FakeBigQueryClient
+
+
+def bootstrap_app(
+    *, blob_count: int = 1000, bigquery_latency: float = 0
+) -> Tuple[Any, Services]:
+    """Import the FastAPI app with every external service replaced by its local stand-in.
+
+    Args:
+        blob_count (int, optional): Number of BLOBs per naming scheme in the fake bucket.
+            Defaults to 1000.
+        bigquery_latency (float, optional): Seconds each fake BigQuery job takes to complete.
+            Defaults to 0.
+
+    Returns:
+        Tuple[Any, Services]: The FastAPI app and the fake services it is wired to.
+    """
+    for key, value in FAKE_ENVIRONMENT.items():
+        os.environ.setdefault(key, value)
+    if "GRIDDED_DATA_CACHE_DIR" not in os.environ:
+        gridded_data_dir = tempfile.mkdtemp(prefix="benchmark-gridded-")
+        fakes.build_fake_gridded_store(
+            os.path.join(gridded_data_dir, "CAPE.zarr"), "cape"
+        )
+        os.environ["GRIDDED_DATA_CACHE_DIR"] = gridded_data_dir
+    if "IMAGE_PROXY_CACHE_DIR" not in os.environ:
+        os.environ["IMAGE_PROXY_CACHE_DIR"] = tempfile.mkdtemp(
+            prefix="benchmark-images-"
+        )
+    if "METRICS_MIRROR_DIR" not in os.environ:
+        os.environ["METRICS_MIRROR_DIR"] = tempfile.mkdtemp(prefix="benchmark-mirror-")
+
+    services = Services(
+        storage_client=fakes.FakeStorageClient(
+            {"datario-public": fakes.build_fake_bucket(blob_count=blob_count)}
+        ),
+        bigquery_client=fakes.FakeBigQueryClient(latency=bigquery_latency),
+    )
+
+    # Library entrypoints are patched, rather than the app helpers, so every code path that
+    # builds a client (including cached ones) gets the stand-ins. This must happen before the
+    # app is imported, since it binds some of these names at import time.
+    import infisical
+    import redis.asyncio
+    from google.cloud import bigquery, storage
+    from google.oauth2 import service_account
+
+    infisical.InfisicalClient = fakes.FakeInfisicalClient
+    redis.asyncio.Redis = fakes.FakeRedis
+    service_account.Credentials.from_service_account_info = staticmethod(
+        lambda *args, **kwargs: fakes.FakeCredentials()
+    )
+    bigquery.Client = lambda *args, **kwargs: services.bigquery_client
+    storage_client_factory = lambda *args, **kwargs: services.storage_client  # noqa: E731
+    storage_client_factory.SCOPE = storage.Client.SCOPE
+    storage.Client = storage_client_factory
+
+    from app import main
+
+    return main.app, services
+
+
+class ASGIClient:
+    """Tiny in-process HTTP client speaking ASGI directly to the app."""
+
+    def __init__(self, app):
+        self.app = app
+
+    @asynccontextmanager
+    async def lifespan(self):
+        """Run the app's startup and shutdown events around the block."""
+        receive_queue: asyncio.Queue = asyncio.Queue()
+        send_queue: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(
+            self.app(
+                {"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}},
+                receive_queue.get,
+                send_queue.put,
+            )
+        )
+        await receive_queue.put({"type": "lifespan.startup"})
+        message = await send_queue.get()
+        if message["type"] != "lifespan.startup.complete":
+            raise RuntimeError(f"App startup failed: {message}")
+        try:
+            yield self
+        finally:
+            await receive_queue.put({"type": "lifespan.shutdown"})
+            await send_queue.get()
+            await task
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        params: Dict[str, Any] = None,
+        *,
+        body: bytes = b"",
+        headers: Dict[str, str] = None,
+    ) -> Tuple[int, bytes]:
+        query_string = urlencode(params or {}).encode()
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method.upper(),
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query_string,
+            "root_path": "",
+            "headers": [
+                (b"host", b"benchmark"),
+                *(
+                    (name.lower().encode(), value.encode())
+                    for name, value in (headers or {}).items()
+                ),
+            ],
+            "client": ("127.0.0.1", 12345),
+            "server": ("benchmark", 80),
+            "state": {},
+        }
+        request_sent = False
+        status_code = 500
+        response_body = bytearray()
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                response_body.extend(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        return status_code, bytes(response_body)
+
+
+@dataclass
+class ScenarioResult:
+    scenario: str
+    requests: int
+    errors: int
+    throughput_rps: float
+    p50_ms: float
+    p99_ms: float
+    peak_memory_mb: float
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of `values`."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+async def run_load(
+    client: ASGIClient,
+    make_request: Callable[[int], Tuple[str, str, Dict[str, Any]]],
+    *,
+    requests: int,
+    concurrency: int,
+    prepare: Optional[Callable[[], Awaitable[None]]] = None,
+) -> Tuple[List[float], int, float]:
+    """Fire `requests` requests with at most `concurrency` in flight, calling `prepare` before
+    each one, outside of its timing.
+
+    Returns:
+        Tuple[List[float], int, float]: Per-request latencies in seconds, the number of
+            non-2xx responses and the wall-clock duration of the run.
+    """
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            method, path, params = make_request(i)
+            if prepare is not None:
+                await prepare()
+            started = time.perf_counter()
+            status_code, _ = await client.request(method, path, params)
+            latencies.append(time.perf_counter() - started)
+            if not 200 <= status_code < 300:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def measure(
+    client: ASGIClient,
+    name: str,
+    make_request: Callable[[int], Tuple[str, str, Dict[str, Any]]],
+    *,
+    requests: int,
+    concurrency: int,
+    warmup: int = 5,
+    memory_requests: int = 20,
+    prepare: Optional[Callable[[], Awaitable[None]]] = None,
+) -> ScenarioResult:
+    """Measure a scenario. Latency and throughput come from a plain run; peak memory comes
+    from a separate, shorter run under `tracemalloc`, which would otherwise skew timings."""
+    await run_load(
+        client, make_request, requests=warmup, concurrency=1, prepare=prepare
+    )
+
+    latencies, errors, elapsed = await run_load(
+        client,
+        make_request,
+        requests=requests,
+        concurrency=concurrency,
+        prepare=prepare,
+    )
+
+    tracemalloc.start()
+    try:
+        await run_load(
+            client,
+            make_request,
+            requests=memory_requests,
+            concurrency=concurrency,
+            prepare=prepare,
+        )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return ScenarioResult(
+        scenario=name,
+        requests=requests,
+        errors=errors,
+        throughput_rps=requests / elapsed if elapsed else 0.0,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        peak_memory_mb=peak / 2**20,
+    )
+
+
+def dumps(data: Any) -> bytes:
+    return json.dumps(data, option=json.OPT_INDENT_2 | json.OPT_SORT_KEYS)
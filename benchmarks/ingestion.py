@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Post ingestion notifications to a running API, as GCS and the BigQuery loads would.
+
+    python -m benchmarks.ingestion --token secret gcs "cor-clima-imagens/satelite/goes16/without_background/CAPE_2024-10-01 12:00:00.png"
+    python -m benchmarks.ingestion --token secret bigquery project.dataset.table 2024-10-01T00:00:00-03:00 2024-10-01T06:00:00-03:00
+"""
+
+import argparse
+import base64
+import urllib.request
+from typing import Any, Dict, List
+
+import orjson as json
+
+
+def object_finalize_envelope(
+    bucket: str, name: str, generation: int = 1
+) -> Dict[str, Any]:
+    """A GCS object finalize notification, as delivered by a Pub/Sub push subscription."""
+    resource = {"bucket": bucket, "name": name, "generation": str(generation)}
+    return {
+        "message": {
+            "attributes": {
+                "eventType": "OBJECT_FINALIZE",
+                "bucketId": bucket,
+                "objectId": name,
+                "objectGeneration": str(generation),
+                "payloadFormat": "JSON_API_V1",
+            },
+            "data": base64.b64encode(json.dumps(resource)).decode(),
+            "message_id": str(generation),
+        },
+        "subscription": "projects/local/subscriptions/ingestion",
+    }
+
+
+def bigquery_load_notice(
+    table: str, start_time: str, end_time: str, products: List[str] = None
+) -> Dict[str, Any]:
+    notice = {"table": table, "start_time": start_time, "end_time": end_time}
+    if products:
+        notice["products"] = products
+    return notice
+
+
+def post(url: str, token: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload),
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        },
+        method="POST",
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--token", required=True)
+    subparsers = parser.add_subparsers(dest="source", required=True)
+    gcs = subparsers.add_parser("gcs", help="A new object in the bucket")
+    gcs.add_argument("name")
+    gcs.add_argument("--bucket", default="datario-public")
+    bigquery = subparsers.add_parser("bigquery", help="Data loaded into a table")
+    bigquery.add_argument("table")
+    bigquery.add_argument("start_time")
+    bigquery.add_argument("end_time")
+    bigquery.add_argument("--products", nargs="*")
+    args = parser.parse_args()
+
+    if args.source == "gcs":
+        path = "/ingestion/gcs"
+        payload = object_finalize_envelope(args.bucket, args.name)
+    else:
+        path = "/ingestion/bigquery"
+        payload = bigquery_load_notice(
+            args.table, args.start_time, args.end_time, args.products
+        )
+    print(json.dumps(post(args.url.rstrip("/") + path, args.token, payload)).decode())
+
+
+if __name__ == "__main__":
+    main()
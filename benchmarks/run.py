@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Run the benchmark scenarios and compare them against stored baselines.
+
+    python -m benchmarks.run
+    python -m benchmarks.run --scenarios chart gif --requests 500 --concurrency 20
+    python -m benchmarks.run --save-baseline
+"""
+
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import orjson as json
+
+from benchmarks.harness import ASGIClient, ScenarioResult, bootstrap_app, dumps, measure
+from benchmarks.scenarios import get_scenarios
+
+BASELINES_DIR = Path(__file__).parent / "baselines"
+
+# Metrics compared against the baseline, and whether higher values are better
+COMPARED_METRICS = {
+    "throughput_rps": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_memory_mb": False,
+}
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--scenarios", nargs="*", help="Scenarios to run (default: all)"
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--hours", type=int, default=24, help="Time window of each request"
+    )
+    parser.add_argument(
+        "--blob-count",
+        type=int,
+        default=2000,
+        help="BLOBs per naming scheme in the fake bucket",
+    )
+    parser.add_argument(
+        "--bigquery-latency",
+        type=float,
+        default=0,
+        help="Seconds each fake BigQuery job takes",
+    )
+    parser.add_argument("--baseline-name", default="default")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative change over the baseline that counts as a regression",
+    )
+    return parser.parse_args(argv)
+
+
+def compare(
+    results: List[ScenarioResult], baseline: Dict[str, dict], tolerance: float
+) -> List[str]:
+    regressions = []
+    for result in results:
+        reference = baseline.get(result.scenario)
+        if not reference:
+            continue
+        current = result.to_dict()
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before, after = reference.get(metric), current[metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            if (higher_is_better and change < -tolerance) or (
+                not higher_is_better and change > tolerance
+            ):
+                regressions.append(
+                    f"{result.scenario}.{metric}: {before:.2f} -> {after:.2f} ({change:+.0%})"
+                )
+    return regressions
+
+
+def print_results(results: List[ScenarioResult]) -> None:
+    header = f"{'scenario':<18}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r.scenario:<18}{r.requests:>10}{r.errors:>8}{r.throughput_rps:>10.1f}"
+            f"{r.p50_ms:>10.2f}{r.p99_ms:>10.2f}{r.peak_memory_mb:>10.2f}"
+        )
+
+
+async def run(args: argparse.Namespace) -> List[ScenarioResult]:
+    app, _ = bootstrap_app(
+        blob_count=args.blob_count, bigquery_latency=args.bigquery_latency
+    )
+    scenarios = get_scenarios(hours=args.hours)
+    if args.scenarios:
+        scenarios = [s for s in scenarios if s.name in args.scenarios]
+
+    results = []
+    async with ASGIClient(app).lifespan() as client:
+        # Imported once the entrypoints are patched. The mirror is filled upfront so the
+        # long-range scenario doesn't measure the initial sync.
+        from app.metrics_mirror import metrics_mirror
+        from app.utils import get_redis_client
+
+        await metrics_mirror.sync()
+        redis = get_redis_client()
+        for scenario in scenarios:
+            results.append(
+                await measure(
+                    client,
+                    scenario.name,
+                    scenario.make_request,
+                    requests=args.requests,
+                    concurrency=args.concurrency,
+                    prepare=redis.flushdb if scenario.flush_cache else None,
+                )
+            )
+    return results
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    print_results(results)
+
+    baseline_path = BASELINES_DIR / f"{args.baseline_name}.json"
+    if args.save_baseline:
+        baseline = {}
+        if baseline_path.exists():
+            baseline = json.loads(baseline_path.read_bytes())
+        baseline.update({r.scenario: r.to_dict() for r in results})
+        BASELINES_DIR.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_bytes(dumps(baseline))
+        print(f"\nBaseline saved to {baseline_path}")
+        return 0
+
+    if not baseline_path.exists():
+        print(
+            f"\nNo baseline at {baseline_path}; run with --save-baseline to create one."
+        )
+        return 0
+
+    regressions = compare(
+        results, json.loads(baseline_path.read_bytes()), args.tolerance
+    )
+    if regressions:
+        print(f"\nRegressions against {baseline_path.name}:")
+        for regression in regressions:
+            print(f" - {regression}")
+        return 1
+    print(f"\nNo regressions against {baseline_path.name}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Load scenarios. Each scenario builds the i-th request of a run as `(method, path, params)`.
+"""
+
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Dict, List, Tuple
+
+import pendulum
+
+from benchmarks.fakes import default_naming_schemes
+
+RequestFactory = Callable[[int], Tuple[str, str, Dict[str, Any]]]
+
+CHART_PRODUCTS = ["cp", "ki", "si", "li", "tt"]
+GIF_PRODUCTS = ["cp", "ki", "si", "li", "tt", "rr", "sst"]
+RADARS = ["mendanha"]
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    description: str
+    make_request: RequestFactory
+    # Empty Redis before each request, so every one misses the result caches
+    flush_cache: bool = False
+
+
+def _window(hours: int) -> Dict[str, str]:
+    end_time = pendulum.now("America/Sao_Paulo").subtract(minutes=1)
+    start_time = end_time.subtract(hours=hours)
+    return {"start_time": start_time.isoformat(), "end_time": end_time.isoformat()}
+
+
+def chart(hours: int = 24) -> Scenario:
+    params = _window(hours)
+
+    def make_request(i: int):
+        product = CHART_PRODUCTS[i % len(CHART_PRODUCTS)]
+        return "GET", f"/satellite/goes16/chart/{product}", params
+
+    return Scenario(
+        name="chart",
+        description=f"GOES-16 chart data over the last {hours}h, rotating products",
+        make_request=make_request,
+    )
+
+
+def chart_cold(hours: int = 24) -> Scenario:
+    return replace(
+        chart(hours),
+        name="chart_cold",
+        description=f"GOES-16 chart data over the last {hours}h, with empty caches",
+        flush_cache=True,
+    )
+
+
+def chart_point(hours: int = 24) -> Scenario:
+    params = {**_window(hours), "lat": -22.9, "lon": -43.2}
+
+    def make_request(i: int):
+        product = CHART_PRODUCTS[i % len(CHART_PRODUCTS)]
+        return "GET", f"/satellite/goes16/chart/{product}", params
+
+    return Scenario(
+        name="chart_point",
+        description=f"GOES-16 chart data at a point over the last {hours}h",
+        make_request=make_request,
+    )
+
+
+def chart_refresh(hours: int = 24, minutes: int = 20) -> Scenario:
+    params = _window(hours)
+    end_time = pendulum.parse(params["end_time"])
+    params["since"] = end_time.subtract(minutes=minutes).isoformat()
+
+    def make_request(i: int):
+        product = CHART_PRODUCTS[i % len(CHART_PRODUCTS)]
+        return "GET", f"/satellite/goes16/chart/{product}", params
+
+    return Scenario(
+        name="chart_refresh",
+        description=f"GOES-16 chart points of the last {minutes}min, after a cursor",
+        make_request=make_request,
+    )
+
+
+def chart_history(days: int = 7) -> Scenario:
+    params = _window(days * 24)
+
+    def make_request(i: int):
+        product = CHART_PRODUCTS[i % len(CHART_PRODUCTS)]
+        return "GET", f"/satellite/goes16/chart/{product}", params
+
+    return Scenario(
+        name="chart_history",
+        description=f"GOES-16 chart data over the last {days} days, from the local mirror",
+        make_request=make_request,
+    )
+
+
+def chart_downsampled(days: int = 7, max_points: int = 300) -> Scenario:
+    params = {**_window(days * 24), "max_points": max_points}
+
+    def make_request(i: int):
+        product = CHART_PRODUCTS[i % len(CHART_PRODUCTS)]
+        return "GET", f"/satellite/goes16/chart/{product}", params
+
+    return Scenario(
+        name="chart_downsampled",
+        description=f"GOES-16 chart data over the last {days} days, as {max_points} points",
+        make_request=make_request,
+    )
+
+
+def events(days: int = 7) -> Scenario:
+    params = _window(days * 24)
+
+    def make_request(i: int):
+        product = CHART_PRODUCTS[i % len(CHART_PRODUCTS)]
+        return "GET", f"/satellite/goes16/events/{product}", params
+
+    return Scenario(
+        name="events",
+        description=f"GOES-16 alert level events over the last {days} days",
+        make_request=make_request,
+    )
+
+
+def value(hours: int = 24 * 7) -> Scenario:
+    point_params = {**_window(hours), "lat": -22.9, "lon": -43.2}
+    bbox_params = {**_window(hours), "bbox": "-43.3,-23.0,-43.1,-22.8"}
+
+    def make_request(i: int):
+        return (
+            "GET",
+            "/satellite/goes16/value/cp",
+            (point_params if i % 2 == 0 else bbox_params),
+        )
+
+    return Scenario(
+        name="value",
+        description=f"Gridded CAPE at a point and over a bbox, last {hours}h",
+        make_request=make_request,
+    )
+
+
+def gif(hours: int = 24) -> Scenario:
+    params = _window(hours)
+
+    def make_request(i: int):
+        product = GIF_PRODUCTS[i % len(GIF_PRODUCTS)]
+        return "GET", f"/satellite/goes16/gif/{product}", params
+
+    return Scenario(
+        name="gif",
+        description=f"GOES-16 frame listing over the last {hours}h, rotating products",
+        make_request=make_request,
+    )
+
+
+def gif_cold(hours: int = 24) -> Scenario:
+    return replace(
+        gif(hours),
+        name="gif_cold",
+        description=f"GOES-16 frame listing over the last {hours}h, with empty caches",
+        flush_cache=True,
+    )
+
+
+def radar(hours: int = 24) -> Scenario:
+    params = _window(hours)
+
+    def make_request(i: int):
+        return "GET", "/radar/mendanha", params
+
+    return Scenario(
+        name="radar",
+        description=f"Mendanha radar frame listing over the last {hours}h",
+        make_request=make_request,
+    )
+
+
+def radar_composite(hours: int = 24) -> Scenario:
+    params = {**_window(hours), "radars": ",".join(RADARS)}
+
+    def make_request(i: int):
+        return "GET", "/radar/composite", params
+
+    return Scenario(
+        name="radar_composite",
+        description=f"Every radar merged on one timeline over the last {hours}h",
+        make_request=make_request,
+    )
+
+
+def image(frames: int = 20) -> Scenario:
+    # The latest frame is skipped, since it may not exist yet when the bucket was built
+    scheme = default_naming_schemes()[-1]
+    now = pendulum.now("America/Sao_Paulo")
+    last = now.subtract(seconds=now.int_timestamp % scheme.interval_seconds)
+    paths = [
+        scheme.blob_name(last.subtract(seconds=i * scheme.interval_seconds))
+        for i in range(1, frames + 1)
+    ]
+    widths = [256, 512]
+
+    def make_request(i: int):
+        params = {"width": widths[i // len(paths) % len(widths)], "format": "webp"}
+        return "GET", f"/images/{paths[i % len(paths)]}", params
+
+    return Scenario(
+        name="image",
+        description=f"Resized WebP renditions of the last {frames} radar frames",
+        make_request=make_request,
+    )
+
+
+def render(frames: int = 10) -> Scenario:
+    now = pendulum.now("America/Sao_Paulo")
+    timestamps = [
+        now.subtract(minutes=10 * i).isoformat() for i in range(1, frames + 1)
+    ]
+    thresholds = [None, 1000, 2000]
+
+    def make_request(i: int):
+        params = {"timestamp": timestamps[i % len(timestamps)], "format": "webp"}
+        threshold = thresholds[i // len(timestamps) % len(thresholds)]
+        if threshold is not None:
+            params["min_value"] = threshold
+        return "GET", "/satellite/goes16/render/cp", params
+
+    return Scenario(
+        name="render",
+        description="CAPE frames rendered from the grid, with and without thresholds",
+        make_request=make_request,
+    )
+
+
+def catalog() -> Scenario:
+    def make_request(i: int):
+        return "GET", "/catalog", {}
+
+    return Scenario(
+        name="catalog",
+        description="Product catalog with data availability",
+        make_request=make_request,
+    )
+
+
+def health() -> Scenario:
+    def make_request(i: int):
+        return "GET", "/health", {}
+
+    return Scenario(
+        name="health",
+        description="Liveness check",
+        make_request=make_request,
+    )
+
+
+def readiness() -> Scenario:
+    def make_request(i: int):
+        return "GET", "/health/ready", {}
+
+    return Scenario(
+        name="readiness",
+        description="Readiness check",
+        make_request=make_request,
+    )
+
+
+def get_scenarios(hours: int = 24) -> List[Scenario]:
+    return [
+        chart(hours),
+        chart_cold(hours),
+        chart_point(hours),
+        chart_refresh(hours),
+        chart_history(),
+        chart_downsampled(),
+        events(),
+        value(),
+        gif(hours),
+        gif_cold(hours),
+        radar(hours),
+        radar_composite(hours),
+        image(),
+        render(),
+        catalog(),
+        health(),
+        readiness(),
+    ]
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+from pendulum import DateTime
+
+from app import config
+from app.pydantic_models import ImageSliderOut
+from app.radars import get_radar_layers
+from app.utils import get_gcs_client, parse_blob_timestamp
+
+
+@dataclass(frozen=True)
+class AvailabilitySource:
+    """A series of BLOBs in the bucket, named as `get_matching_blobs` expects."""
+
+    path_prefix: str
+    blob_name_prefix: str = ""
+    blob_extension: str = ".png"
+    timestamp_format: str = "YYYY-MM-DD HH:mm:ss"
+
+    @property
+    def prefix(self) -> str:
+        return self.path_prefix.rstrip("/") + "/" + self.blob_name_prefix
+
+
+@dataclass
+class SeriesAvailability:
+    earliest: Optional[DateTime] = None
+    latest: Optional[DateTime] = None
+    gaps: List[Tuple[DateTime, DateTime]] = field(default_factory=list)
+    updated_at: Optional[DateTime] = None
+
+    def extend(self, timestamps: List[DateTime], gap_threshold_seconds: int) -> None:
+        """Add timestamps newer than `latest`, recording any gap longer than the threshold.
+        `timestamps` must be sorted."""
+        previous = self.latest
+        for timestamp in timestamps:
+            if previous is not None and timestamp <= previous:
+                continue
+            if self.earliest is None:
+                self.earliest = timestamp
+            if (
+                previous is not None
+                and (timestamp - previous).total_seconds() > gap_threshold_seconds
+            ):
+                self.gaps.append((previous, timestamp))
+            previous = timestamp
+        self.latest = previous
+        self.updated_at = DateTime.now(tz=config.TIMEZONE)
+
+
+class AvailabilityIndex:
+    """Keeps the earliest and latest timestamps, and the gaps, of each series of BLOBs.
+
+    The index is fully rebuilt from a bucket listing every `full_refresh_seconds`. In between,
+    it is refreshed every `refresh_seconds` by listing only the days since the latest known
+    timestamp, which BLOB names allow since their timestamps start with `YYYY-MM-DD`.
+    """
+
+    def __init__(
+        self,
+        sources: Dict[str, AvailabilitySource],
+        *,
+        bucket_name: str,
+        refresh_seconds: int,
+        full_refresh_seconds: int,
+        gap_threshold_seconds: int,
+    ):
+        self.sources = sources
+        self.bucket_name = bucket_name
+        self.refresh_seconds = refresh_seconds
+        self.full_refresh_seconds = full_refresh_seconds
+        self.gap_threshold_seconds = gap_threshold_seconds
+        self._availability: Dict[str, SeriesAvailability] = {
+            key: SeriesAvailability() for key in sources
+        }
+        # Bumped on every change, so consumers can cheaply tell whether to recompute
+        self.version = 0
+        # Called with the series key and its new frames after each incremental refresh
+        self.listeners: List[
+            Callable[[str, List[ImageSliderOut]], Awaitable[None]]
+        ] = []
+        self._task: asyncio.Task = None
+
+    def get(self, key: str) -> SeriesAvailability:
+        return self._availability[key]
+
+    def list_frames(
+        self, key: str, name_prefix: str = ""
+    ) -> List[Tuple[DateTime, str]]:
+        """List the frames of a series as sorted (timestamp, public URL) pairs, restricted to
+        BLOB names starting with `name_prefix` after the series prefix."""
+        source = self.sources[key]
+        bucket = get_gcs_client().bucket(self.bucket_name)
+        frames = []
+        for blob in bucket.list_blobs(prefix=source.prefix + name_prefix):
+            try:
+                timestamp = parse_blob_timestamp(
+                    blob.name,
+                    blob_name_prefix=source.blob_name_prefix,
+                    blob_extension=source.blob_extension,
+                    timestamp_format=source.timestamp_format,
+                    timezone=config.TIMEZONE,
+                )
+            except ValueError:
+                logger.warning(f"Skipping BLOB with unexpected name: {blob.name}")
+                continue
+            if timestamp is not None:
+                frames.append((timestamp, blob.public_url))
+        frames.sort(key=lambda frame: frame[0])
+        return frames
+
+    def rebuild(self, key: str) -> None:
+        availability = SeriesAvailability()
+        timestamps = [timestamp for timestamp, _ in self.list_frames(key)]
+        availability.extend(timestamps, self.gap_threshold_seconds)
+        self._availability[key] = availability
+        self.version += 1
+
+    def refresh(self, key: str) -> List[ImageSliderOut]:
+        """List the days since the latest known timestamp and add what is new.
+
+        Returns:
+            List[ImageSliderOut]: The frames that were added. Empty if the series had no known
+                timestamp yet, in which case it is fully rebuilt instead.
+        """
+        availability = self._availability[key]
+        if availability.latest is None:
+            self.rebuild(key)
+            return []
+        day = availability.latest.in_tz(config.TIMEZONE).start_of("day")
+        today = DateTime.now(tz=config.TIMEZONE).start_of("day")
+        frames = []
+        while day <= today:
+            frames += self.list_frames(key, day.format("YYYY-MM-DD"))
+            day = day.add(days=1)
+        new_frames = [
+            ImageSliderOut(timestamp=timestamp, image_url=image_url)
+            for timestamp, image_url in frames
+            if timestamp > availability.latest
+        ]
+        if new_frames:
+            availability.extend(
+                [frame.timestamp for frame in new_frames], self.gap_threshold_seconds
+            )
+            self.version += 1
+        return new_frames
+
+    def match_blob(self, blob_name: str) -> Optional[Tuple[str, DateTime]]:
+        """Find the series a BLOB belongs to, and its timestamp.
+
+        Returns:
+            Optional[Tuple[str, DateTime]]: The series key and the timestamp, or None if the
+                BLOB isn't part of any series.
+        """
+        for key, source in self.sources.items():
+            if not (
+                blob_name.startswith(source.prefix)
+                and blob_name.endswith(source.blob_extension)
+            ):
+                continue
+            try:
+                timestamp = parse_blob_timestamp(
+                    blob_name,
+                    blob_name_prefix=source.blob_name_prefix,
+                    blob_extension=source.blob_extension,
+                    timestamp_format=source.timestamp_format,
+                    timezone=config.TIMEZONE,
+                )
+            except ValueError:
+                continue
+            if timestamp is not None:
+                return key, timestamp
+        return None
+
+    def add(self, key: str, timestamp: DateTime) -> bool:
+        """Record a timestamp known to exist, e.g. from an ingestion notification.
+
+        Returns:
+            bool: Whether the timestamp is newer than the latest known one.
+        """
+        availability = self._availability[key]
+        if availability.latest is None or timestamp > availability.latest:
+            availability.extend([timestamp], self.gap_threshold_seconds)
+            self.version += 1
+            return True
+        return False
+
+    async def notify(self, key: str, frames: List[ImageSliderOut]) -> None:
+        for listener in self.listeners:
+            try:
+                await listener(key, frames)
+            except Exception as exc:
+                logger.error(f"Failed to notify new frames of {key}: {exc}")
+
+    async def _update(self, full: bool) -> None:
+        for key in self.sources:
+            try:
+                if full:
+                    await asyncio.to_thread(self.rebuild, key)
+                    continue
+                new_frames = await asyncio.to_thread(self.refresh, key)
+            except Exception as exc:
+                logger.error(f"Failed to update availability of {key}: {exc}")
+                continue
+            if new_frames:
+                await self.notify(key, new_frames)
+
+    async def _run(self) -> None:
+        last_full_refresh = None
+        while True:
+            now = time.monotonic()
+            full = (
+                last_full_refresh is None
+                or now - last_full_refresh >= self.full_refresh_seconds
+            )
+            await self._update(full=full)
+            if full:
+                last_full_refresh = now
+            await asyncio.sleep(self.refresh_seconds)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def get_availability_sources() -> Dict[str, AvailabilitySource]:
+    """Satellite products are keyed by their enum value, radar layers by `RadarLayer.key`."""
+    sources = {
+        product.value: AvailabilitySource(
+            path_prefix=config.GOES16_GCS_PATH_PREFIX,
+            blob_name_prefix=f"{mapping['gcs_prefix']}_",
+        )
+        for product, mapping in config.SATELLITE_PRODUCTS_MAPPING.items()
+    }
+    for layer in get_radar_layers():
+        sources[layer.key] = AvailabilitySource(
+            path_prefix=layer.path_prefix,
+            timestamp_format=layer.timestamp_format,
+        )
+    return sources
+
+
+availability_index = AvailabilityIndex(
+    get_availability_sources(),
+    bucket_name=config.GCS_BUCKET_NAME,
+    refresh_seconds=config.AVAILABILITY_REFRESH_SECONDS,
+    full_refresh_seconds=config.AVAILABILITY_FULL_REFRESH_SECONDS,
+    gap_threshold_seconds=config.AVAILABILITY_GAP_THRESHOLD_SECONDS,
+)
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
+import json
 from os import getenv
 from typing import List
 
 from infisical import InfisicalClient
 from loguru import logger
 
-from app.enums import SatelliteProductEnum
+from app.enums import (
+    EventDirectionEnum,
+    RadarEnum,
+    RadarProductEnum,
+    SatelliteProductEnum,
+)
 
 
 def getenv_or_action(
@@ -109,6 +115,16 @@ if environment not in ["dev", "staging", "prod"]:
 inject_environment_variables(environment=environment)
 
 # Actual configs
+ADMISSION_MAX_INFLIGHT_EXPENSIVE = int(
+    getenv_or_action("ADMISSION_MAX_INFLIGHT_EXPENSIVE", default="32")
+)
+# Streams hold their connection open for as long as the client stays, so they're capped apart
+ADMISSION_MAX_OPEN_STREAMS = int(
+    getenv_or_action("ADMISSION_MAX_OPEN_STREAMS", default="500")
+)
+ADMISSION_RETRY_AFTER_SECONDS = int(
+    getenv_or_action("ADMISSION_RETRY_AFTER_SECONDS", default="1")
+)
 ALLOW_CREDENTIALS = (
     getenv_or_action("ALLOW_CREDENTIALS", default="true").lower() == "true"
 )
@@ -116,6 +132,30 @@ ALLOWED_HEADERS = getenv_list_or_action("ALLOWED_HEADERS", default="*")
 ALLOWED_METHODS = getenv_list_or_action("ALLOWED_METHODS", default="*")
 ALLOWED_ORIGINS = getenv_list_or_action("ALLOWED_ORIGINS", default="*")
 ALLOWED_ORIGINS_REGEX = getenv_or_action("ALLOWED_ORIGINS_REGEX", action="ignore")
+AVAILABILITY_FULL_REFRESH_SECONDS = int(
+    getenv_or_action("AVAILABILITY_FULL_REFRESH_SECONDS", default="86400")
+)
+AVAILABILITY_GAP_THRESHOLD_SECONDS = int(
+    getenv_or_action("AVAILABILITY_GAP_THRESHOLD_SECONDS", default="1800")
+)
+AVAILABILITY_REFRESH_SECONDS = int(
+    getenv_or_action("AVAILABILITY_REFRESH_SECONDS", default="60")
+)
+BIGQUERY_DRY_RUN_ENABLE = (
+    getenv_or_action("BIGQUERY_DRY_RUN_ENABLE", default="true").lower() == "true"
+)
+BIGQUERY_JOB_TIMEOUT_SECONDS = int(
+    getenv_or_action("BIGQUERY_JOB_TIMEOUT_SECONDS", default="30")
+)
+BIGQUERY_LATITUDE_COLUMN = getenv_or_action(
+    "BIGQUERY_LATITUDE_COLUMN", default="latitude"
+)
+BIGQUERY_LONGITUDE_COLUMN = getenv_or_action(
+    "BIGQUERY_LONGITUDE_COLUMN", default="longitude"
+)
+BIGQUERY_MAXIMUM_BYTES_BILLED = int(
+    getenv_or_action("BIGQUERY_MAXIMUM_BYTES_BILLED", default=str(1024**3))
+)
 BIGQUERY_TABLE_INDICE_ESTABILIDADE = getenv_or_action(
     "BIGQUERY_TABLE_INDICE_ESTABILIDADE"
 )
@@ -126,18 +166,236 @@ BIGQUERY_TABLE_TAXA_PRECIPITACAO = getenv_or_action("BIGQUERY_TABLE_TAXA_PRECIPI
 BIGQUERY_TABLE_TEMPERATURA_OCEANO = getenv_or_action(
     "BIGQUERY_TABLE_TEMPERATURA_OCEANO"
 )
+BIGQUERY_USE_QUERY_CACHE = (
+    getenv_or_action("BIGQUERY_USE_QUERY_CACHE", default="true").lower() == "true"
+)
+# Response header with the cursor of incremental refreshes, exposed to browsers by CORS
+CURSOR_HEADER = getenv_or_action("CURSOR_HEADER", default="X-Cursor")
+EVENTS_MAX_ALLOWED_RANGE_SECONDS = int(
+    getenv_or_action("EVENTS_MAX_ALLOWED_RANGE_SECONDS", default="2678400")
+)
+# Readings further apart than this end an event, even if both exceed the level
+EVENTS_MAX_GAP_SECONDS = int(getenv_or_action("EVENTS_MAX_GAP_SECONDS", default="1800"))
+EVENTS_REFRESH_SECONDS = int(getenv_or_action("EVENTS_REFRESH_SECONDS", default="300"))
+# Alert levels of each product, after the warm colors of their legends. Instability rises with
+# CAPE, KI and TT, and as LI and SI drop.
+EVENTS_THRESHOLDS = {
+    product: {
+        "direction": direction,
+        "levels": [
+            float(value)
+            for value in getenv_list_or_action(
+                f"EVENTS_THRESHOLDS_{product.name}", default=levels
+            )
+        ],
+    }
+    for product, direction, levels in [
+        (SatelliteProductEnum.CAPE, EventDirectionEnum.ABOVE, "2000,3000,4000"),
+        (SatelliteProductEnum.K_INDEX, EventDirectionEnum.ABOVE, "30,40"),
+        (SatelliteProductEnum.SHOWALTER_INDEX, EventDirectionEnum.BELOW, "0,-5"),
+        (SatelliteProductEnum.LIFTED_INDEX, EventDirectionEnum.BELOW, "0,-5"),
+        (SatelliteProductEnum.TOTALS_TOTALS_INDEX, EventDirectionEnum.ABOVE, "50,60"),
+    ]
+}
+EVENTS_WARM_DAYS = int(getenv_or_action("EVENTS_WARM_DAYS", default="14"))
 GCP_SERVICE_ACCOUNT_CREDENTIALS = getenv_or_action("GCP_SERVICE_ACCOUNT_CREDENTIALS")
+GCS_BUCKET_NAME = getenv_or_action("GCS_BUCKET_NAME", default="datario-public")
+GCS_HTTP_POOL_SIZE = int(getenv_or_action("GCS_HTTP_POOL_SIZE", default="32"))
 GOOGLE_BIGQUERY_PAGE_SIZE = int(
     getenv_or_action("GOOGLE_BIGQUERY_PAGE_SIZE", default="10000")
 )
+GOES16_GCS_PATH_PREFIX = "cor-clima-imagens/satelite/goes16/without_background/"
+GRIDDED_DATA_CACHE_DIR = getenv_or_action(
+    "GRIDDED_DATA_CACHE_DIR", default="/data/gridded"
+)
+# The pipeline publishes the gridded store of each product to GCS_BUCKET_NAME at
+# `{GRIDDED_DATA_GCS_PREFIX}{gcs_prefix}.zarr/`, uploading its consolidated `.zmetadata` last.
+# Every replica syncs the stores of GRIDDED_DATA_PRODUCTS into GRIDDED_DATA_CACHE_DIR. Add
+# `gridded_data` to HEALTHCHECK_REQUIRED_DEPENDENCIES to keep replicas unready until they are.
+GRIDDED_DATA_GCS_PREFIX = getenv_or_action(
+    "GRIDDED_DATA_GCS_PREFIX", default="cor-clima-imagens/satelite/goes16/zarr/"
+)
+GRIDDED_DATA_MAX_ALLOWED_RANGE_SECONDS = int(
+    getenv_or_action("GRIDDED_DATA_MAX_ALLOWED_RANGE_SECONDS", default="2592000")
+)
+GRIDDED_DATA_MAX_BBOX_DEGREES = float(
+    getenv_or_action("GRIDDED_DATA_MAX_BBOX_DEGREES", default="0.5")
+)
+GRIDDED_DATA_PRODUCTS = [
+    SatelliteProductEnum[name]
+    for name in getenv_list_or_action(
+        "GRIDDED_DATA_PRODUCTS",
+        default=(
+            "CAPE,K_INDEX,SHOWALTER_INDEX,LIFTED_INDEX,TOTALS_TOTALS_INDEX,"
+            "RAIN_RATE,OCEAN_TEMPERATURE"
+        ),
+    )
+]
+GRIDDED_DATA_SYNC_ENABLE = (
+    getenv_or_action("GRIDDED_DATA_SYNC_ENABLE", default="true").lower() == "true"
+)
+GRIDDED_DATA_SYNC_SECONDS = int(
+    getenv_or_action("GRIDDED_DATA_SYNC_SECONDS", default="300")
+)
+HEALTHCHECK_INTERVAL_SECONDS = int(
+    getenv_or_action("HEALTHCHECK_INTERVAL_SECONDS", default="30")
+)
+HEALTHCHECK_REQUIRED_DEPENDENCIES = getenv_list_or_action(
+    "HEALTHCHECK_REQUIRED_DEPENDENCIES", default="redis"
+)
+HEALTHCHECK_TIMEOUT_SECONDS = int(
+    getenv_or_action("HEALTHCHECK_TIMEOUT_SECONDS", default="5")
+)
+IMAGE_PROXY_ALLOWED_WIDTHS = [
+    int(value)
+    for value in getenv_list_or_action(
+        "IMAGE_PROXY_ALLOWED_WIDTHS", default="256,512,768,1024"
+    )
+]
+IMAGE_PROXY_CACHE_DIR = getenv_or_action(
+    "IMAGE_PROXY_CACHE_DIR", default="/tmp/image-proxy-cache"
+)
+IMAGE_PROXY_CACHE_MAX_BYTES = int(
+    getenv_or_action("IMAGE_PROXY_CACHE_MAX_BYTES", default=str(512 * 1024**2))
+)
+# How long the generation of a BLOB is trusted before the bucket is asked again, which also
+# bounds how long an overwritten BLOB may still be served in its previous version
+IMAGE_PROXY_GENERATION_TTL_SECONDS = int(
+    getenv_or_action("IMAGE_PROXY_GENERATION_TTL_SECONDS", default="60")
+)
+# Proxy URLs don't carry the generation, so clients revalidate them with the ETag after this
+IMAGE_PROXY_MAX_AGE_SECONDS = int(
+    getenv_or_action("IMAGE_PROXY_MAX_AGE_SECONDS", default="300")
+)
+IMAGE_PROXY_QUALITY = int(getenv_or_action("IMAGE_PROXY_QUALITY", default="80"))
+# Total size of the renditions in Redis, past which the least recently used are evicted
+IMAGE_PROXY_REDIS_MAX_BYTES = int(
+    getenv_or_action("IMAGE_PROXY_REDIS_MAX_BYTES", default=str(256 * 1024**2))
+)
+IMAGE_PROXY_REDIS_MAX_ITEM_BYTES = int(
+    getenv_or_action("IMAGE_PROXY_REDIS_MAX_ITEM_BYTES", default=str(512 * 1024))
+)
+IMAGE_PROXY_REDIS_TTL_SECONDS = int(
+    getenv_or_action("IMAGE_PROXY_REDIS_TTL_SECONDS", default="86400")
+)
+INGESTION_WEBHOOK_TOKEN = getenv_or_action("INGESTION_WEBHOOK_TOKEN", action="ignore")
+LIVE_UPDATES_KEEPALIVE_SECONDS = int(
+    getenv_or_action("LIVE_UPDATES_KEEPALIVE_SECONDS", default="15")
+)
+LIVE_UPDATES_LEADER_LEASE_SECONDS = int(
+    getenv_or_action("LIVE_UPDATES_LEADER_LEASE_SECONDS", default="30")
+)
+LIVE_UPDATES_METRICS_POLL_SECONDS = int(
+    getenv_or_action("LIVE_UPDATES_METRICS_POLL_SECONDS", default="60")
+)
+LIVE_UPDATES_SUBSCRIBER_QUEUE_SIZE = int(
+    getenv_or_action("LIVE_UPDATES_SUBSCRIBER_QUEUE_SIZE", default="100")
+)
 LOG_LEVEL = getenv_or_action("LOG_LEVEL", default="INFO")
+METRICS_MIRROR_DAYS = int(getenv_or_action("METRICS_MIRROR_DAYS", default="90"))
+METRICS_MIRROR_DIR = getenv_or_action(
+    "METRICS_MIRROR_DIR", default="/tmp/metrics-mirror"
+)
+METRICS_MIRROR_ENABLE = (
+    getenv_or_action("METRICS_MIRROR_ENABLE", default="false").lower() == "true"
+)
+# Bucket the mirror files are shared through. Each version of a day is then queried from
+# BigQuery by a single replica, which uploads it for the others to download. Unset, every
+# replica queries BigQuery for its own mirror.
+METRICS_MIRROR_GCS_BUCKET = getenv_or_action(
+    "METRICS_MIRROR_GCS_BUCKET", action="ignore"
+)
+METRICS_MIRROR_GCS_PREFIX = getenv_or_action(
+    "METRICS_MIRROR_GCS_PREFIX", default="plataforma-clima-api/metrics-mirror/"
+)
+METRICS_MIRROR_SYNC_SECONDS = int(
+    getenv_or_action("METRICS_MIRROR_SYNC_SECONDS", default="3600")
+)
+# Path prefixes never profiled at random, such as the streams, which are open for hours
+PROFILING_EXCLUDED_PATHS = getenv_list_or_action(
+    "PROFILING_EXCLUDED_PATHS", default="/live/"
+)
+PROFILING_HEADER = getenv_or_action("PROFILING_HEADER", default="X-Profile")
+PROFILING_INTERVAL_SECONDS = float(
+    getenv_or_action("PROFILING_INTERVAL_SECONDS", default="0.005")
+)
+# Profiles of longer requests are cut at this duration, and the next request can be profiled
+PROFILING_MAX_SECONDS = float(getenv_or_action("PROFILING_MAX_SECONDS", default="60"))
+# Share of the requests profiled at random, besides the ones asking for it
+PROFILING_SAMPLE_RATE = float(getenv_or_action("PROFILING_SAMPLE_RATE", default="0"))
+# Profiling is disabled unless a token is set
+PROFILING_TOKEN = getenv_or_action("PROFILING_TOKEN", action="ignore")
+PROFILING_TTL_SECONDS = int(getenv_or_action("PROFILING_TTL_SECONDS", default="86400"))
 RADAR_DATA_MAX_ALLOWED_RANGE_SECONDS = int(
     getenv_or_action("RADAR_DATA_MAX_ALLOWED_RANGE_SECONDS", default="86400")
 )
+# Images of a radar are at `{gcs_path_prefix}{product}/{with|without}_background/without_colorbar/`
+RADARS_MAPPING = {
+    RadarEnum.MENDANHA: {
+        "gcs_path_prefix": "cor-clima-imagens/radar/mendanha/",
+        # TODO: Modify this when the new format is set
+        "timestamp_format": "YYYY-MM-DD-HH-mm-ss",
+        "products": [RadarProductEnum.HORIZONTAL_REFLECTIVITY],
+    },
+}
+RATE_LIMIT_API_KEY_HEADER = getenv_or_action(
+    "RATE_LIMIT_API_KEY_HEADER", default="X-API-Key"
+)
+RATE_LIMIT_BURST = float(getenv_or_action("RATE_LIMIT_BURST", default="300"))
+RATE_LIMIT_ENABLE = (
+    getenv_or_action("RATE_LIMIT_ENABLE", default="true").lower() == "true"
+)
+RATE_LIMIT_TOKENS_PER_SECOND = float(
+    getenv_or_action("RATE_LIMIT_TOKENS_PER_SECOND", default="5")
+)
+# Proxies in front of the pods, each appending the address it got the request from to
+# X-Forwarded-For. Clients can write the leftmost entries themselves, so the client address is
+# the entry this many hops from the right, the one the ingress appended. With 0 the address of
+# the connection is used instead, which uvicorn only leaves alone without --forwarded-allow-ips.
+RATE_LIMIT_TRUSTED_PROXY_HOPS = int(
+    getenv_or_action("RATE_LIMIT_TRUSTED_PROXY_HOPS", default="1")
+)
 REDIS_HOST = getenv_or_action("REDIS_HOST", default="localhost")
 REDIS_PORT = int(getenv_or_action("REDIS_PORT", default="6379"))
 REDIS_DB = int(getenv_or_action("REDIS_DB", default="0"))
 REDIS_PASSWORD = getenv_or_action("REDIS_PASSWORD", action="ignore")
+RESULT_CACHE_RECENT_TTL_SECONDS = int(
+    getenv_or_action("RESULT_CACHE_RECENT_TTL_SECONDS", default="300")
+)
+RESULT_CACHE_TTL_SECONDS = int(
+    getenv_or_action("RESULT_CACHE_TTL_SECONDS", default="604800")
+)
+# Where the chart data of each product is in BigQuery. The stability indices share a long table
+# told apart by `product_column`. Other products only have chart data once their table is set
+# in SATELLITE_DATA_SOURCES_{product}, a JSON object that also overrides any field of the
+# indices: `table`, `value_column` (defaults to the product's `column`), `product_column`,
+# `timestamp_column`, `latitude_column` and `longitude_column`. The `timestamp_type` (STRING,
+# DATETIME or TIMESTAMP), `partition_column` (a DATE column to prune partitions by) and
+# `cluster_columns` are read from the table on startup, unless they are set as well.
+SATELLITE_DATA_SOURCES = {
+    product: {
+        **(
+            {
+                "table": BIGQUERY_TABLE_METRICAS_GEOESPACIAIS,
+                "product_column": "produto_satelite",
+                "value_column": "valor",
+            }
+            if product
+            in [
+                SatelliteProductEnum.CAPE,
+                SatelliteProductEnum.K_INDEX,
+                SatelliteProductEnum.SHOWALTER_INDEX,
+                SatelliteProductEnum.LIFTED_INDEX,
+                SatelliteProductEnum.TOTALS_TOTALS_INDEX,
+            ]
+            else {}
+        ),
+        **json.loads(
+            getenv_or_action(f"SATELLITE_DATA_SOURCES_{product.name}", default="{}")
+        ),
+    }
+    for product in SatelliteProductEnum
+}
 SATELLITE_GIF_MAX_ALLOWED_RANGE_SECONDS = int(
     getenv_or_action("SATELLITE_GIF_MAX_ALLOWED_RANGE_SECONDS", default="86400")
 )
@@ -171,7 +429,25 @@ SATELLITE_PRODUCTS_MAPPING = {
         "gcs_prefix": "SST",
     },
 }
+SHAPEFILE_NEIGHBORHOOD_NAME_FIELD = getenv_or_action(
+    "SHAPEFILE_NEIGHBORHOOD_NAME_FIELD", default="NOME"
+)
+# Shapefiles are read from SHAPEFILES_DIR, downloaded first from SHAPEFILES_GCS_PREFIX in
+# GCS_BUCKET_NAME if they aren't there. The neighborhoods are `Limite_Bairros_RJ.*`.
+SHAPEFILES_DIR = getenv_or_action("SHAPEFILES_DIR", default="/tmp/shapefiles")
+SHAPEFILES_GCS_PREFIX = getenv_or_action(
+    "SHAPEFILES_GCS_PREFIX", default="plataforma-clima-api/shapefiles/"
+)
 SENTRY_ENABLE = getenv_or_action("SENTRY_ENABLE", default="false").lower() == "true"
+SPATIAL_GRID_EXTENT = [
+    float(value)
+    for value in getenv_list_or_action(
+        "SPATIAL_GRID_EXTENT", default="-43.8,-23.1,-43.1,-22.75"
+    )
+]
+SPATIAL_GRID_RESOLUTION = float(
+    getenv_or_action("SPATIAL_GRID_RESOLUTION", default="0.04")
+)
 TIMEZONE = getenv_or_action("TIMEZONE", default="America/Sao_Paulo")
 if SENTRY_ENABLE:
     SENTRY_DSN = getenv_or_action("SENTRY_DSN")
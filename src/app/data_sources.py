@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the BigQuery tables holding the chart data of each product.
+
+A product is either one of several in a long table, told apart by a product column (as in
+`metricas_geoespaciais`), or has a value column of its own. Timestamps may be stored as
+TIMESTAMP, DATETIME or formatted STRING. Native timestamps are compared with typed parameters,
+so BigQuery prunes the partitions of tables partitioned on them, and tables partitioned on a
+separate DATE column are filtered on it as well. Conditions on clustering columns come first,
+in clustering order. The timestamp type, partitioning and clustering of each table are read
+from its metadata on startup, unless configured. Every query built from a source selects the
+timestamp as a local `YYYY-MM-DD HH:mm:ss` string in `data_medicao` and the value in `valor`,
+the shape the rest of the app expects whatever the table.
+"""
+
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from google.cloud import bigquery
+from google.cloud.bigquery.query import _AbstractQueryParameter
+from google.cloud.bigquery.retry import DEFAULT_RETRY
+from loguru import logger
+from pendulum import DateTime
+
+from app import config
+from app.enums import SatelliteProductEnum, TimestampTypeEnum
+from app.utils import get_bigquery_client
+
+DATETIME_FORMAT = "YYYY-MM-DD HH:mm:ss"
+
+
+@dataclass(frozen=True)
+class DataSource:
+    product: SatelliteProductEnum
+    table: str
+    value_column: str
+    timestamp_column: str = "data_medicao"
+    timestamp_type: TimestampTypeEnum = TimestampTypeEnum.STRING
+    partition_column: Optional[str] = None
+    cluster_columns: Tuple[str, ...] = ()
+    product_column: Optional[str] = None
+    product_value: Optional[str] = None
+    latitude_column: str = config.BIGQUERY_LATITUDE_COLUMN
+    longitude_column: str = config.BIGQUERY_LONGITUDE_COLUMN
+    # Cleared on startup if the table has no such coordinate columns
+    has_coordinates: bool = True
+
+    @property
+    def group(self) -> tuple:
+        """Sources with the same group can be queried together, for several products."""
+        return (
+            self.table,
+            self.value_column,
+            self.timestamp_column,
+            self.timestamp_type,
+            self.partition_column,
+            self.product_column,
+        )
+
+    @property
+    def timestamp_expression(self) -> str:
+        """The timestamp as a local `YYYY-MM-DD HH:mm:ss` string."""
+        if self.timestamp_type == TimestampTypeEnum.TIMESTAMP:
+            return (
+                f"FORMAT_TIMESTAMP('%Y-%m-%d %H:%M:%S', {self.timestamp_column}, "
+                f"'{config.TIMEZONE}')"
+            )
+        if self.timestamp_type == TimestampTypeEnum.DATETIME:
+            return f"FORMAT_DATETIME('%Y-%m-%d %H:%M:%S', {self.timestamp_column})"
+        return self.timestamp_column
+
+    def get_time_parameter(
+        self, name: str, time: DateTime
+    ) -> bigquery.ScalarQueryParameter:
+        local_time = time.in_tz(config.TIMEZONE)
+        if self.timestamp_type == TimestampTypeEnum.TIMESTAMP:
+            return bigquery.ScalarQueryParameter(name, "TIMESTAMP", local_time)
+        if self.timestamp_type == TimestampTypeEnum.DATETIME:
+            return bigquery.ScalarQueryParameter(name, "DATETIME", local_time.naive())
+        return bigquery.ScalarQueryParameter(
+            name, "STRING", local_time.format(DATETIME_FORMAT)
+        )
+
+    def get_query_filter(
+        self,
+        start_time: DateTime,
+        end_time: DateTime,
+        *,
+        product_values: Optional[List[str]] = None,
+    ) -> Tuple[str, List[_AbstractQueryParameter]]:
+        """Build the conditions of a WHERE clause selecting the rows of the product between two
+        timestamps (inclusive), or of every product in `product_values` of the same table.
+        """
+        conditions = {
+            self.timestamp_column: f"{self.timestamp_column} BETWEEN @start_time AND @end_time"
+        }
+        query_params = [
+            self.get_time_parameter("start_time", start_time),
+            self.get_time_parameter("end_time", end_time),
+        ]
+        if self.partition_column:
+            conditions[self.partition_column] = (
+                f"{self.partition_column} BETWEEN @start_date AND @end_date"
+            )
+            # The partition dates may be UTC or local, so the range is one day wider on each
+            # side to prune partitions without ever dropping rows; the timestamps still filter
+            query_params += [
+                bigquery.ScalarQueryParameter(
+                    "start_date",
+                    "DATE",
+                    start_time.in_tz(config.TIMEZONE).subtract(days=1).date(),
+                ),
+                bigquery.ScalarQueryParameter(
+                    "end_date",
+                    "DATE",
+                    end_time.in_tz(config.TIMEZONE).add(days=1).date(),
+                ),
+            ]
+        if self.product_column:
+            if product_values is None:
+                conditions[self.product_column] = f"{self.product_column} = @product"
+                query_params.append(
+                    bigquery.ScalarQueryParameter(
+                        "product", "STRING", self.product_value
+                    )
+                )
+            else:
+                conditions[self.product_column] = (
+                    f"{self.product_column} IN UNNEST(@products)"
+                )
+                query_params.append(
+                    bigquery.ArrayQueryParameter("products", "STRING", product_values)
+                )
+        # The partition first, then the clustering columns in order
+        order = [self.partition_column, *self.cluster_columns]
+        columns = sorted(
+            conditions,
+            key=lambda column: order.index(column) if column in order else len(order),
+        )
+        return (
+            "\n        AND ".join(conditions[column] for column in columns),
+            query_params,
+        )
+
+
+def load_data_sources() -> Dict[SatelliteProductEnum, DataSource]:
+    data_sources = {}
+    for product, source in config.SATELLITE_DATA_SOURCES.items():
+        # Products without a table have no chart data yet
+        if not source.get("table"):
+            continue
+        column = config.SATELLITE_PRODUCTS_MAPPING[product]["column"]
+        source = {**source}
+        if not source.get("value_column"):
+            source["value_column"] = column
+        if source.get("product_column") and not source.get("product_value"):
+            source["product_value"] = column
+        if source.get("timestamp_type"):
+            source["timestamp_type"] = TimestampTypeEnum(source["timestamp_type"])
+        if source.get("cluster_columns"):
+            source["cluster_columns"] = tuple(source["cluster_columns"])
+        data_sources[product] = DataSource(product=product, **source)
+    return data_sources
+
+
+data_sources = load_data_sources()
+
+
+def get_table_layout(source: DataSource, table: bigquery.Table) -> dict:
+    """Read the timestamp type, the DATE partition column and the clustering columns of the
+    table of a source from its metadata."""
+    types = {field.name: field.field_type for field in table.schema}
+    layout = {}
+    if types.get(source.timestamp_column) in [type.value for type in TimestampTypeEnum]:
+        layout["timestamp_type"] = TimestampTypeEnum(types[source.timestamp_column])
+    # Tables partitioned on the timestamp itself are pruned by the timestamp condition
+    partitioning = table.time_partitioning
+    if (
+        partitioning is not None
+        and partitioning.field
+        and partitioning.field != source.timestamp_column
+        and types.get(partitioning.field) == "DATE"
+    ):
+        layout["partition_column"] = partitioning.field
+    if table.clustering_fields:
+        layout["cluster_columns"] = tuple(table.clustering_fields)
+    return layout
+
+
+def get_missing_columns(source: DataSource, table: bigquery.Table) -> List[str]:
+    """Columns of a source that aren't in the schema of its table."""
+    names = {field.name for field in table.schema}
+    columns = [
+        source.timestamp_column,
+        source.value_column,
+        source.product_column,
+        source.latitude_column,
+        source.longitude_column,
+    ]
+    return [column for column in columns if column and column not in names]
+
+
+def inspect_data_sources() -> None:
+    """Complete the sources with the layout of their tables, except for the fields that are
+    configured, and check their columns exist. Fetching table metadata is free and doesn't
+    start a job. Sources that can't be inspected keep their configuration, so this must run
+    before they are queried.
+    """
+    bq_client = get_bigquery_client()
+    tables: Dict[str, bigquery.Table] = {}
+    for product, source in list(data_sources.items()):
+        try:
+            if source.table not in tables:
+                tables[source.table] = bq_client.get_table(
+                    source.table,
+                    retry=DEFAULT_RETRY.with_timeout(
+                        config.HEALTHCHECK_TIMEOUT_SECONDS
+                    ),
+                    timeout=config.HEALTHCHECK_TIMEOUT_SECONDS,
+                )
+            layout = get_table_layout(source, tables[source.table])
+        except Exception as exc:
+            logger.warning(f"Failed to inspect the table of {product.value}: {exc}")
+            continue
+        configured = config.SATELLITE_DATA_SOURCES[product]
+        layout = {key: value for key, value in layout.items() if key not in configured}
+        missing = get_missing_columns(source, tables[source.table])
+        if missing:
+            logger.error(
+                f"The table {source.table} of {product.value} has no column "
+                f"{', '.join(missing)}. Set them in SATELLITE_DATA_SOURCES_{product.name}, or "
+                "BIGQUERY_LATITUDE_COLUMN and BIGQUERY_LONGITUDE_COLUMN for the coordinates."
+            )
+        if source.latitude_column in missing or source.longitude_column in missing:
+            # Location filters are turned down rather than failing in BigQuery
+            layout["has_coordinates"] = False
+        if layout:
+            data_sources[product] = replace(source, **layout)
+            logger.info(f"Read the layout of the table of {product.value}: {layout}")
+
+
+def get_chart_products() -> List[SatelliteProductEnum]:
+    return [product for product in SatelliteProductEnum if product in data_sources]
+
+
+def get_data_source(product: SatelliteProductEnum) -> DataSource:
+    """
+    Raises:
+        HTTPException: If the product has no chart data.
+    """
+    source = data_sources.get(product)
+    if source is None:
+        raise HTTPException(
+            status_code=501, detail="This product is not implemented yet."
+        )
+    return source
+
+
+def group_data_sources(products: List[SatelliteProductEnum]) -> List[List[DataSource]]:
+    """Group the sources of some products into the ones that can be queried together."""
+    groups: Dict[tuple, List[DataSource]] = {}
+    for product in products:
+        source = get_data_source(product)
+        # Products with a table or a value column of their own are queried alone
+        key = source.group if source.product_column else (source.group, product)
+        groups.setdefault(key, []).append(source)
+    return list(groups.values())
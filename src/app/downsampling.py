@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Shape-preserving downsampling of chart series, with Largest-Triangle-Three-Buckets.
+
+The points between the first and the last are split into buckets of consecutive points, and
+each bucket keeps the point forming the largest triangle with the point kept from the previous
+bucket and the average of the next one. Unlike averaging each bucket, this keeps the peaks.
+Choosing a point depends on the previous choice, so buckets are walked in order, but the areas
+of each bucket are computed at once.
+"""
+
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """Select at most `max_points` of a series sorted by `x`, which must have no NaN.
+
+    Returns:
+        np.ndarray: The indexes of the selected points, in order.
+    """
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+
+    # Bucket boundaries over the points between the first and the last, which are always
+    # kept. There are fewer buckets than points, so no bucket is empty.
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    sums_x = np.concatenate([[0], np.cumsum(x)])
+    sums_y = np.concatenate([[0], np.cumsum(y)])
+    counts = np.diff(edges)
+    # The average of the next bucket of each bucket, the last point for the last bucket
+    next_x = np.append((sums_x[edges[2:]] - sums_x[edges[1:-1]]) / counts[1:], x[-1])
+    next_y = np.append((sums_y[edges[2:]] - sums_y[edges[1:-1]]) / counts[1:], y[-1])
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        areas = np.abs(
+            (x[a] - next_x[bucket]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (next_y[bucket] - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        selected[bucket + 1] = a
+    return selected
+
+
+def downsample_points(points: List[dict], max_points: int) -> List[dict]:
+    """Downsample JSON-decoded chart points (`timestamp` and `value`). Series that already fit
+    are returned untouched. Points without a value can't be placed in a triangle, so each run of
+    them is kept as a single point, which keeps the gap in the chart, and the points with a value
+    around it are downsampled with the rest of the budget (at least 3 points)."""
+    if len(points) <= max_points:
+        return points
+    timestamps = pd.to_datetime([point["timestamp"] for point in points], utc=True)
+    order = np.argsort(timestamps.asi8, kind="stable")
+    has_value = np.array([points[index]["value"] is not None for index in order])
+    # The first point of each run without a value
+    gaps = np.flatnonzero(~has_value & np.append(True, has_value[:-1]))
+    valued = np.flatnonzero(has_value)
+    if len(valued):
+        # Seconds from the first point, so the areas don't lose precision
+        x = (timestamps.asi8[order[valued]] - timestamps.asi8[order[valued[0]]]) / 1e9
+        y = np.array([points[order[index]]["value"] for index in valued], dtype=float)
+        budget = max(max_points - len(gaps), 3)
+        valued = valued[lttb_indices(x, y, budget)]
+    return [points[order[index]] for index in np.sort(np.concatenate([valued, gaps]))]
@@ -10,3 +10,33 @@ class SatelliteProductEnum(str, Enum):
     TOTALS_TOTALS_INDEX = "tt"
     RAIN_RATE = "rr"
     OCEAN_TEMPERATURE = "sst"
+
+
+class EventDirectionEnum(str, Enum):
+    ABOVE = "above"
+    BELOW = "below"
+
+
+class ImageFormatEnum(str, Enum):
+    WEBP = "webp"
+    AVIF = "avif"
+    PNG = "png"
+
+
+class ProfileFormatEnum(str, Enum):
+    JSON = "json"
+    COLLAPSED = "collapsed"
+
+
+class RadarEnum(str, Enum):
+    MENDANHA = "mendanha"
+
+
+class RadarProductEnum(str, Enum):
+    HORIZONTAL_REFLECTIVITY = "refletividade_horizontal"
+
+
+class TimestampTypeEnum(str, Enum):
+    STRING = "STRING"
+    DATETIME = "DATETIME"
+    TIMESTAMP = "TIMESTAMP"
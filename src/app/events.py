@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the intervals when a product crossed its alert levels.
+
+The readings of a product are reduced to one value per timestamp, the most unstable over the
+whole area (the maximum for levels crossed from below, the minimum for levels crossed from
+above), and scanned for the intervals beyond each level. The intervals of each day are kept in
+Redis like the cached chart results: keyed by the version of the `metrics:{product}` series for
+that day, so BigQuery load notifications invalidate them, and with a short TTL for the current
+day, which is still being loaded. Past days are computed once, and only the current day is
+recomputed as new rows come in. Events spanning midnight are joined back at query time.
+"""
+
+import asyncio
+from typing import Dict, List, Optional
+
+import numpy as np
+import orjson as json
+import pandas as pd
+import pendulum
+from fastapi import HTTPException
+from loguru import logger
+from pendulum import DateTime
+
+from app import config
+from app.data_sources import get_data_source
+from app.enums import EventDirectionEnum, SatelliteProductEnum
+from app.live_updates import live_updates_broker
+from app.pydantic_models import ThresholdEventOut
+from app.query_executor import execute_query_async
+from app.result_cache import get_day_runs, get_days, get_ttl, get_versions
+from app.utils import get_redis_client
+
+
+def get_thresholds(product: SatelliteProductEnum) -> dict:
+    """
+    Raises:
+        HTTPException: If the product has no alert levels.
+    """
+    thresholds = config.EVENTS_THRESHOLDS.get(product)
+    if not thresholds:
+        raise HTTPException(status_code=501, detail="This product has no alert levels.")
+    return thresholds
+
+
+def find_events(
+    timestamps: pd.DatetimeIndex,
+    values: np.ndarray,
+    level: float,
+    direction: EventDirectionEnum,
+) -> List[dict]:
+    """Find the intervals when sorted readings were beyond a level. Intervals touching the first
+    or last reading are flagged, so they can be joined with those of the neighbouring days.
+    """
+    if direction == EventDirectionEnum.ABOVE:
+        beyond = values >= level
+    else:
+        beyond = values <= level
+    events = []
+    current = None
+    for index, (timestamp, value, is_beyond) in enumerate(
+        zip(timestamps, values, beyond)
+    ):
+        if current is not None and (
+            not is_beyond
+            or (timestamp - current["end"]).total_seconds()
+            > config.EVENTS_MAX_GAP_SECONDS
+        ):
+            events.append(current)
+            current = None
+        if not is_beyond:
+            continue
+        if current is None:
+            current = {
+                "level": level,
+                "start": timestamp,
+                "end": timestamp,
+                "peak_time": timestamp,
+                "peak_value": float(value),
+                "open_start": index == 0,
+                "open_end": False,
+            }
+        current["end"] = timestamp
+        if (value > current["peak_value"]) == (
+            direction == EventDirectionEnum.ABOVE
+        ) and value != current["peak_value"]:
+            current["peak_time"] = timestamp
+            current["peak_value"] = float(value)
+    if current is not None:
+        current["open_end"] = True
+        events.append(current)
+    return events
+
+
+def join_events(events: List[dict], direction: EventDirectionEnum) -> List[dict]:
+    """Join the events of consecutive days that are the same event split at midnight."""
+    joined: Dict[float, dict] = {}
+    result = []
+    for event in sorted(events, key=lambda event: (event["level"], event["start"])):
+        previous = joined.get(event["level"])
+        if (
+            previous is not None
+            and previous["open_end"]
+            and event["open_start"]
+            and (event["start"] - previous["end"]).total_seconds()
+            <= config.EVENTS_MAX_GAP_SECONDS
+        ):
+            previous["end"] = event["end"]
+            previous["open_end"] = event["open_end"]
+            if (event["peak_value"] > previous["peak_value"]) == (
+                direction == EventDirectionEnum.ABOVE
+            ) and event["peak_value"] != previous["peak_value"]:
+                previous["peak_time"] = event["peak_time"]
+                previous["peak_value"] = event["peak_value"]
+            continue
+        event = dict(event)
+        joined[event["level"]] = event
+        result.append(event)
+    return sorted(result, key=lambda event: (event["start"], event["level"]))
+
+
+async def query_values(
+    product: SatelliteProductEnum, first_day: str, last_day: str, aggregate: str
+) -> pd.Series:
+    """Query the most unstable reading of each timestamp between two days (inclusive)."""
+    source = get_data_source(product)
+    query_filter, query_params = source.get_query_filter(
+        pendulum.parse(first_day, tz=config.TIMEZONE),
+        pendulum.parse(last_day, tz=config.TIMEZONE).end_of("day"),
+    )
+    query = f"""
+    SELECT
+        {source.timestamp_expression} AS data_medicao,
+        {aggregate}({source.value_column}) AS valor
+    FROM {source.table}
+    WHERE
+        {query_filter}
+    GROUP BY 1
+    """
+    data = await execute_query_async(
+        query=query, query_params=query_params, product=product.value
+    )
+
+    data["valor"] = pd.to_numeric(data["valor"], errors="coerce")
+    data = data.dropna(subset=["valor"])
+    values = data.groupby("data_medicao")["valor"].agg(aggregate.lower())
+    # Times skipped or repeated by DST changes are resolved like get_chart_points does
+    timestamps = pd.to_datetime(values.index).tz_localize(
+        config.TIMEZONE, ambiguous=False, nonexistent=pd.Timedelta(hours=1)
+    )
+    return pd.Series(values.to_numpy(), index=timestamps, dtype=float)
+
+
+async def compute_events(
+    product: SatelliteProductEnum, days: List[str]
+) -> Dict[str, List[dict]]:
+    """Compute the events of a product on each of the given days, with one query per run of
+    consecutive days, so indexed days between them aren't scanned again."""
+    thresholds = get_thresholds(product)
+    direction = thresholds["direction"]
+    aggregate = "MAX" if direction == EventDirectionEnum.ABOVE else "MIN"
+    values = await asyncio.gather(
+        *[
+            query_values(product, run[0], run[-1], aggregate)
+            for run in get_day_runs(days)
+        ]
+    )
+    by_day = pd.concat(values).sort_index()
+
+    events = {day: [] for day in days}
+    for day, day_values in by_day.groupby(by_day.index.strftime("%Y-%m-%d")):
+        if day not in events:
+            continue
+        for level in thresholds["levels"]:
+            events[day] += find_events(
+                day_values.index, day_values.to_numpy(), level, direction
+            )
+    return events
+
+
+def dump_events(events: List[dict]) -> bytes:
+    return json.dumps(
+        [
+            {
+                **event,
+                "start": event["start"].isoformat(),
+                "end": event["end"].isoformat(),
+                "peak_time": event["peak_time"].isoformat(),
+            }
+            for event in events
+        ]
+    )
+
+
+def load_events(content: bytes) -> List[dict]:
+    return [
+        {
+            **event,
+            "start": pd.Timestamp(event["start"]),
+            "end": pd.Timestamp(event["end"]),
+            "peak_time": pd.Timestamp(event["peak_time"]),
+        }
+        for event in json.loads(content)
+    ]
+
+
+async def get_events(
+    product: SatelliteProductEnum,
+    start_time: DateTime,
+    end_time: DateTime,
+    level: Optional[float] = None,
+) -> List[ThresholdEventOut]:
+    """Get the events of a product overlapping a time range, computing only the days that
+    aren't indexed yet.
+
+    Raises:
+        HTTPException: If the product has no alert levels, or `level` isn't one of them.
+    """
+    thresholds = get_thresholds(product)
+    if level is not None and level not in thresholds["levels"]:
+        levels = ", ".join(f"{value:g}" for value in thresholds["levels"])
+        raise HTTPException(status_code=400, detail=f"level must be one of: {levels}")
+
+    series = f"metrics:{product.value}"
+    days = get_days(start_time, end_time)
+    redis = get_redis_client()
+    try:
+        versions = await get_versions(series, days)
+        entry_keys = [
+            f"events:{product.value}:{day}:{version}"
+            for day, version in zip(days, versions)
+        ]
+        entries = await redis.mget(entry_keys)
+    except Exception as exc:
+        logger.warning(f"Failed to read indexed events of {product.value}: {exc}")
+        entry_keys, entries = None, [None] * len(days)
+
+    events: List[dict] = []
+    missing_days = [day for day, entry in zip(days, entries) if entry is None]
+    computed = await compute_events(product, missing_days) if missing_days else {}
+    for index, (day, entry) in enumerate(zip(days, entries)):
+        if entry is not None:
+            events += load_events(entry)
+            continue
+        events += computed[day]
+        if entry_keys is not None:
+            try:
+                await redis.set(
+                    entry_keys[index], dump_events(computed[day]), ex=get_ttl([day])
+                )
+            except Exception as exc:
+                logger.warning(f"Failed to index events of {product.value}: {exc}")
+
+    start, end = pd.Timestamp(start_time), pd.Timestamp(end_time)
+    return [
+        ThresholdEventOut(
+            level=event["level"],
+            start=event["start"].to_pydatetime(),
+            end=event["end"].to_pydatetime(),
+            peak_time=event["peak_time"].to_pydatetime(),
+            peak_value=event["peak_value"],
+        )
+        for event in join_events(events, thresholds["direction"])
+        if event["end"] >= start
+        and event["start"] <= end
+        and (level is None or event["level"] == level)
+    ]
+
+
+class EventIndexWarmer:
+    """Keeps the recent days of every product indexed, so dashboards never wait for BigQuery.
+    Only the replica leading the live updates does it."""
+
+    def __init__(self, *, days: int, refresh_seconds: int):
+        self.days = days
+        self.refresh_seconds = refresh_seconds
+        self._task: asyncio.Task = None
+
+    async def warm(self) -> None:
+        end_time = pendulum.now(config.TIMEZONE)
+        start_time = end_time.subtract(days=self.days)
+        for product in config.EVENTS_THRESHOLDS:
+            try:
+                await get_events(product, start_time, end_time)
+            except Exception as exc:
+                logger.error(f"Failed to index events of {product.value}: {exc}")
+
+    async def _run(self) -> None:
+        while True:
+            if live_updates_broker.is_leader:
+                await self.warm()
+            await asyncio.sleep(self.refresh_seconds)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+event_index_warmer = EventIndexWarmer(
+    days=config.EVENTS_WARM_DAYS, refresh_seconds=config.EVENTS_REFRESH_SECONDS
+)
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Access to the local cache of gridded GOES-16 products.
+
+Each product is a Zarr store at `{GRIDDED_DATA_CACHE_DIR}/{gcs_prefix}.zarr`, holding a single
+data variable named after the product column (e.g. `cape`) with `time`, `lat` and `lon`
+dimensions. Times are naive UTC. Stores are opened lazily and their chunk files are memory
+mapped, so a query only pages in the chunks it touches.
+
+The stores are synced from the ones the pipeline publishes to GCS. Each published version is
+downloaded to its own directory, reusing the files that didn't change, and the store path is a
+symlink swapped to it once it's complete, so queries never see a partially synced store.
+"""
+
+import asyncio
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pendulum
+import xarray as xr
+import zarr
+from fastapi import HTTPException
+from google.cloud import storage
+from loguru import logger
+
+from app import config
+from app.enums import SatelliteProductEnum
+from app.pydantic_models import SatelliteChartDataOut
+from app.utils import get_gcs_client
+
+# Versions of each store kept on disk: the current one, and the previous one, which datasets
+# opened before the swap may still be reading
+KEPT_STORE_VERSIONS = 2
+
+
+class MemoryMappedDirectoryStore(zarr.DirectoryStore):
+    def _fromfile(self, fn):
+        with open(fn, "rb") as fh:
+            # Empty files can't be mapped. They're chunks still being written by whatever
+            # fills the directory, so they're read as missing, like chunks never written.
+            if os.fstat(fh.fileno()).st_size == 0:
+                raise KeyError(fn)
+            return memoryview(mmap.mmap(fh.fileno(), 0, prot=mmap.PROT_READ))
+
+    def getitems(self, keys, *, contexts):
+        # The default checks that each key exists before reading it, so a chunk skipped by
+        # `_fromfile` would raise instead of being read as missing
+        items = {}
+        for key in keys:
+            try:
+                items[key] = self[key]
+            except KeyError:
+                pass
+        return items
+
+
+_datasets: Dict[Path, Tuple[str, xr.Dataset]] = {}
+_datasets_lock = Lock()
+
+
+def get_store_path(product: SatelliteProductEnum) -> Path:
+    mapping = config.SATELLITE_PRODUCTS_MAPPING[product]
+    return Path(config.GRIDDED_DATA_CACHE_DIR) / f"{mapping['gcs_prefix']}.zarr"
+
+
+def get_store_version(path: Path) -> str:
+    """Version of a store. Synced stores are named after the generation they were published
+    with, the same on every replica. Otherwise, it's the modification time of the store
+    metadata, which changes whenever frames are appended."""
+    if path.is_symlink():
+        return path.resolve().name
+    for name in (".zmetadata", "time/.zarray", ".zgroup"):
+        candidate = path / name
+        if candidate.exists():
+            return f"{path.name}@{candidate.stat().st_mtime}"
+    return f"{path.name}@{path.stat().st_mtime}"
+
+
+def open_versioned_dataset(
+    product: SatelliteProductEnum,
+) -> Optional[Tuple[str, xr.Dataset]]:
+    """Open the cached store of a product. Only metadata is read here; opened datasets are
+    kept and reopened only when the store is updated.
+
+    Returns:
+        Optional[Tuple[str, xr.Dataset]]: The version of the store and its dataset, or None if
+            the product isn't cached locally.
+    """
+    path = get_store_path(product)
+    if not path.exists():
+        return None
+    version = get_store_version(path)
+    with _datasets_lock:
+        cached = _datasets.get(path)
+        if cached and cached[0] == version:
+            return cached
+        # Opened at the directory the store resolves to, so chunks read after a swap still
+        # come from the version the metadata was read from
+        dataset = xr.open_zarr(
+            MemoryMappedDirectoryStore(os.fspath(path.resolve())),
+            chunks=None,
+            consolidated=None,
+        )
+        _datasets[path] = (version, dataset)
+        return version, dataset
+
+
+def open_gridded_dataset(product: SatelliteProductEnum) -> Optional[xr.Dataset]:
+    """Same as `open_versioned_dataset`, without the version."""
+    opened = open_versioned_dataset(product)
+    return opened[1] if opened else None
+
+
+def _coordinate_slice(coordinate: xr.DataArray, lower: float, upper: float) -> slice:
+    # Coordinates may be stored in descending order (latitude usually is)
+    if coordinate.size > 1 and coordinate[0] > coordinate[-1]:
+        return slice(upper, lower)
+    return slice(lower, upper)
+
+
+def _within(coordinate: xr.DataArray, value: float) -> bool:
+    return float(coordinate.min()) <= value <= float(coordinate.max())
+
+
+def sample_gridded_values(
+    product: SatelliteProductEnum,
+    start_time: pendulum.DateTime,
+    end_time: pendulum.DateTime,
+    *,
+    lat: Optional[float] = None,
+    lon: Optional[float] = None,
+    bbox: Optional[List[float]] = None,
+) -> List[SatelliteChartDataOut]:
+    """Sample the cached grid of a product over a time range, either at the grid point nearest
+    to (`lat`, `lon`) or averaged over a `bbox` given as [min_lon, min_lat, max_lon, max_lat].
+
+    Raises:
+        HTTPException: If the product isn't cached or the location is outside the grid.
+
+    Returns:
+        List[SatelliteChartDataOut]: One value per frame in the time range.
+    """
+    dataset = open_gridded_dataset(product)
+    if dataset is None:
+        raise HTTPException(
+            status_code=501, detail="This product is not available as gridded data."
+        )
+    variable = config.SATELLITE_PRODUCTS_MAPPING[product]["column"]
+    data = dataset[variable]
+
+    start = np.datetime64(start_time.in_tz("UTC").naive())
+    end = np.datetime64(end_time.in_tz("UTC").naive())
+    data = data.sel(time=slice(start, end))
+
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        data = data.sel(
+            lat=_coordinate_slice(data.lat, min_lat, max_lat),
+            lon=_coordinate_slice(data.lon, min_lon, max_lon),
+        )
+        if data.lat.size == 0 or data.lon.size == 0:
+            raise HTTPException(
+                status_code=400, detail="The bbox doesn't contain any grid point."
+            )
+        # Only the selected window is read from disk here
+        values = data.mean(dim=("lat", "lon"), skipna=True).values
+    else:
+        if not (_within(dataset.lat, lat) and _within(dataset.lon, lon)):
+            raise HTTPException(
+                status_code=400, detail="The location is outside the covered area."
+            )
+        values = data.sel(lat=lat, lon=lon, method="nearest").values
+
+    timestamps = (
+        pd.DatetimeIndex(data.time.values)
+        .tz_localize("UTC")
+        .tz_convert(config.TIMEZONE)
+        .to_pydatetime()
+    )
+    return [
+        SatelliteChartDataOut(
+            timestamp=timestamp,
+            value=None if np.isnan(value) else float(value),
+        )
+        for timestamp, value in zip(timestamps, values.tolist())
+    ]
+
+
+def select_gridded_frame(
+    product: SatelliteProductEnum, timestamp: pendulum.DateTime
+) -> Tuple[pendulum.DateTime, xr.DataArray, str]:
+    """Select the latest frame of a product at or before `timestamp`, with the north in the
+    first row and the west in the first column. Its values are only read from disk once
+    accessed.
+
+    Raises:
+        HTTPException: If the product isn't cached or has no frame before `timestamp`.
+
+    Returns:
+        Tuple[pendulum.DateTime, xr.DataArray, str]: The time of the frame, its grid and the
+            version of the store it was read from.
+    """
+    opened = open_versioned_dataset(product)
+    if opened is None:
+        raise HTTPException(
+            status_code=501, detail="This product is not available as gridded data."
+        )
+    version, dataset = opened
+    variable = config.SATELLITE_PRODUCTS_MAPPING[product]["column"]
+    data = dataset[variable]
+
+    time = np.datetime64(timestamp.in_tz("UTC").naive())
+    if data.time.size == 0 or data.time.values[0] > time:
+        raise HTTPException(status_code=404, detail="No frame before this time.")
+    frame = data.sel(time=time, method="pad")
+    if frame.lat.size > 1 and frame.lat[0] < frame.lat[-1]:
+        frame = frame.isel(lat=slice(None, None, -1))
+    if frame.lon.size > 1 and frame.lon[0] > frame.lon[-1]:
+        frame = frame.isel(lon=slice(None, None, -1))
+
+    frame_time = pendulum.instance(
+        pd.Timestamp(frame.time.values).to_pydatetime(), tz="UTC"
+    ).in_tz(config.TIMEZONE)
+    return frame_time, frame, version
+
+
+def download_gridded_store(
+    blobs: Dict[str, storage.Blob], previous_dir: Optional[Path], version_dir: Path
+) -> None:
+    """Download the files of a store version aside, linking the ones whose generation didn't
+    change from the previous version, and move it into place once complete."""
+    previous_generations = {}
+    if previous_dir is not None:
+        try:
+            previous_generations = json.loads(Path(f"{previous_dir}.json").read_text())
+        except (OSError, ValueError):
+            pass
+
+    temporary_dir = Path(tempfile.mkdtemp(dir=version_dir.parent, suffix=".tmp"))
+    try:
+        for key, blob in blobs.items():
+            target = temporary_dir / key
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if previous_generations.get(key) == blob.generation:
+                try:
+                    os.link(previous_dir / key, target)
+                    continue
+                except OSError:
+                    pass
+            blob.download_to_filename(os.fspath(target))
+        Path(f"{version_dir}.json").write_text(
+            json.dumps({key: blob.generation for key, blob in blobs.items()})
+        )
+        os.replace(temporary_dir, version_dir)
+    except Exception:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        raise
+
+
+def sync_gridded_store(product: SatelliteProductEnum) -> bool:
+    """Download the latest version of a store published by the pipeline, if it isn't synced
+    already. The generation of its `.zmetadata`, uploaded last, identifies the version.
+
+    Returns:
+        bool: Whether a new version was synced.
+    """
+    path = get_store_path(product)
+    prefix = f"{config.GRIDDED_DATA_GCS_PREFIX}{path.name}/"
+    blobs = {
+        blob.name[len(prefix) :]: blob
+        for blob in get_gcs_client().list_blobs(config.GCS_BUCKET_NAME, prefix=prefix)
+        if not blob.name.endswith("/")
+    }
+    if ".zmetadata" not in blobs:
+        logger.warning(f"No gridded store of {product.value} is published at {prefix}")
+        return False
+    if path.exists() and not path.is_symlink():
+        logger.warning(f"{path} is left alone, as it isn't a synced store")
+        return False
+
+    versions_dir = path.parent / ".versions"
+    version_dir = versions_dir / f"{path.name}.{blobs['.zmetadata'].generation}"
+    if path.is_symlink() and path.resolve() == version_dir.resolve():
+        return False
+    versions_dir.mkdir(parents=True, exist_ok=True)
+    # A version synced before, and published again, is only swapped back in
+    if not version_dir.exists():
+        download_gridded_store(
+            blobs, path.resolve() if path.is_symlink() else None, version_dir
+        )
+
+    # A symlink is swapped in a single rename, unlike a directory
+    temporary_link = versions_dir / f"{path.name}.link.tmp"
+    temporary_link.unlink(missing_ok=True)
+    temporary_link.symlink_to(version_dir)
+    os.replace(temporary_link, path)
+    logger.info(f"Synced the gridded store of {product.value} to {version_dir.name}")
+
+    stale_dirs = sorted(
+        (
+            candidate
+            for candidate in versions_dir.glob(f"{path.name}.*")
+            if candidate.is_dir()
+            and not candidate.is_symlink()
+            and candidate.suffix != ".tmp"
+            and candidate != version_dir
+        ),
+        key=lambda candidate: candidate.stat().st_mtime,
+        reverse=True,
+    )[KEPT_STORE_VERSIONS - 1 :]
+    for stale_dir in stale_dirs:
+        shutil.rmtree(stale_dir, ignore_errors=True)
+        Path(f"{stale_dir}.json").unlink(missing_ok=True)
+    return True
+
+
+class GriddedDataSync:
+    def __init__(self, products: List[SatelliteProductEnum], *, sync_seconds: int):
+        self.products = products
+        self.sync_seconds = sync_seconds
+        self._task: asyncio.Task = None
+
+    async def sync(self) -> None:
+        for product in self.products:
+            try:
+                await asyncio.to_thread(sync_gridded_store, product)
+            except Exception as exc:
+                logger.error(
+                    f"Failed to sync the gridded store of {product.value}: {exc}"
+                )
+
+    async def _run(self) -> None:
+        while True:
+            await self.sync()
+            await asyncio.sleep(self.sync_seconds)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def check_gridded_stores() -> None:
+    """Raise unless the store of every product in GRIDDED_DATA_PRODUCTS is synced."""
+    missing = [
+        product.value
+        for product in config.GRIDDED_DATA_PRODUCTS
+        if not get_store_path(product).exists()
+    ]
+    if missing:
+        raise RuntimeError(f"Gridded stores not synced yet: {', '.join(missing)}")
+
+
+gridded_data_sync = GriddedDataSync(
+    config.GRIDDED_DATA_PRODUCTS, sync_seconds=config.GRIDDED_DATA_SYNC_SECONDS
+)
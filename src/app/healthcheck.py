@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from google.cloud.bigquery.retry import DEFAULT_RETRY as BIGQUERY_DEFAULT_RETRY
+from google.cloud.storage.retry import DEFAULT_RETRY as GCS_DEFAULT_RETRY
+from loguru import logger
+from pendulum import DateTime
+
+from app import config
+from app.gridded_data import check_gridded_stores
+from app.pydantic_models import DependencyStatus
+from app.utils import get_bigquery_client, get_gcs_client, get_redis_client
+
+
+# The worker threads of the probes can't be cancelled, so the calls themselves give up in time
+async def probe_bigquery() -> None:
+    # Fetching table metadata is free and doesn't start a job
+    await asyncio.to_thread(
+        get_bigquery_client().get_table,
+        config.BIGQUERY_TABLE_METRICAS_GEOESPACIAIS,
+        retry=BIGQUERY_DEFAULT_RETRY.with_timeout(config.HEALTHCHECK_TIMEOUT_SECONDS),
+        timeout=config.HEALTHCHECK_TIMEOUT_SECONDS,
+    )
+
+
+async def probe_gcs() -> None:
+    await asyncio.to_thread(
+        get_gcs_client().get_bucket,
+        config.GCS_BUCKET_NAME,
+        retry=GCS_DEFAULT_RETRY.with_timeout(config.HEALTHCHECK_TIMEOUT_SECONDS),
+        timeout=config.HEALTHCHECK_TIMEOUT_SECONDS,
+    )
+
+
+async def probe_gridded_data() -> None:
+    await asyncio.to_thread(check_gridded_stores)
+
+
+async def probe_redis() -> None:
+    await get_redis_client().ping()
+
+
+class DependencyProber:
+    """Periodically probes the app dependencies in the background and keeps their last known
+    status, so health endpoints can answer from memory without touching any dependency.
+    """
+
+    def __init__(
+        self,
+        probes: Dict[str, Callable[[], Awaitable[None]]],
+        *,
+        interval_seconds: int,
+        timeout_seconds: int,
+    ):
+        self.probes = probes
+        self.interval_seconds = interval_seconds
+        self.timeout_seconds = timeout_seconds
+        self._statuses: Dict[str, DependencyStatus] = {
+            name: DependencyStatus(
+                name=name,
+                healthy=False,
+                latency_ms=None,
+                checked_at=None,
+                error="Not checked yet",
+            )
+            for name in probes
+        }
+        self._running: Dict[str, asyncio.Task] = {}
+        self._task: asyncio.Task = None
+
+    @property
+    def statuses(self) -> List[DependencyStatus]:
+        return list(self._statuses.values())
+
+    def is_ready(self, required: List[str]) -> bool:
+        """Whether all the `required` dependencies were healthy on a recent enough probe. A
+        status older than three probe intervals is considered stale, and thus unhealthy.
+        """
+        now = DateTime.now(tz=config.TIMEZONE)
+        for name in required:
+            status = self._statuses.get(name)
+            if not status or not status.healthy or not status.checked_at:
+                return False
+            age = (now - status.checked_at).total_seconds()
+            if age > 3 * self.interval_seconds:
+                return False
+        return True
+
+    async def _probe(self, name: str, probe: Callable[[], Awaitable[None]]) -> None:
+        # A probe that timed out may still hold a worker thread. It's left to finish rather
+        # than joined by another one every interval, which could exhaust the shared executor.
+        running = self._running.get(name)
+        if running is not None and not running.done():
+            error = "The previous probe is still running"
+            logger.warning(f"Dependency {name} is unhealthy: {error}")
+            self._statuses[name] = DependencyStatus(
+                name=name,
+                healthy=False,
+                latency_ms=None,
+                checked_at=DateTime.now(tz=config.TIMEZONE),
+                error=error,
+            )
+            return
+
+        task = self._running[name] = asyncio.create_task(probe())
+        # Its outcome is reported below, or dropped if it completes after timing out
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        started = time.perf_counter()
+        error = None
+        try:
+            # Shielded, so the task tells whether the probe is still running after a timeout
+            await asyncio.wait_for(asyncio.shield(task), timeout=self.timeout_seconds)
+        except asyncio.TimeoutError:
+            error = f"Timed out after {self.timeout_seconds} seconds"
+        except Exception as exc:
+            error = str(exc) or exc.__class__.__name__
+        if error:
+            logger.warning(f"Dependency {name} is unhealthy: {error}")
+        self._statuses[name] = DependencyStatus(
+            name=name,
+            healthy=error is None,
+            latency_ms=(time.perf_counter() - started) * 1000,
+            checked_at=DateTime.now(tz=config.TIMEZONE),
+            error=error,
+        )
+
+    async def probe_all(self) -> None:
+        await asyncio.gather(
+            *(self._probe(name, probe) for name, probe in self.probes.items())
+        )
+
+    async def _run(self) -> None:
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self.interval_seconds)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in self._running.values():
+            task.cancel()
+        self._running = {}
+
+
+dependency_prober = DependencyProber(
+    {
+        "bigquery": probe_bigquery,
+        "gcs": probe_gcs,
+        "gridded_data": probe_gridded_data,
+        "redis": probe_redis,
+    },
+    interval_seconds=config.HEALTHCHECK_INTERVAL_SECONDS,
+    timeout_seconds=config.HEALTHCHECK_TIMEOUT_SECONDS,
+)
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Resized and transcoded copies of the images in the bucket.
+
+Renditions are keyed by the BLOB generation, so a rendition is never stale: overwriting a BLOB
+gives it a new generation and therefore new keys. Generations are remembered for a short while,
+so cached renditions are served without asking the bucket first. They are cached on local disk,
+bounded to `IMAGE_PROXY_CACHE_MAX_BYTES` with least-recently-used eviction, and in Redis, where
+they are shared between replicas and bounded by a TTL, a maximum entry size and a total of
+`IMAGE_PROXY_REDIS_MAX_BYTES`, with least-recently-used eviction as well. Frames rendered with
+a custom palette by `app.palettes` go through the same caches.
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from fastapi import HTTPException
+from google.api_core.exceptions import NotFound
+from loguru import logger
+from PIL import Image
+from redis.commands.core import AsyncScript
+from starlette.concurrency import run_in_threadpool
+
+from app import config
+from app.enums import ImageFormatEnum
+from app.pydantic_models import ImageSliderOut
+from app.utils import get_gcs_client, get_redis_client
+
+MEDIA_TYPES = {
+    ImageFormatEnum.WEBP: "image/webp",
+    ImageFormatEnum.AVIF: "image/avif",
+    ImageFormatEnum.PNG: "image/png",
+}
+
+# AVIF needs a Pillow build with the AVIF plugin
+SUPPORTED_FORMATS = [
+    image_format
+    for image_format in ImageFormatEnum
+    if f".{image_format.value}" in Image.registered_extensions()
+]
+
+REDIS_KEY_PREFIX = "image-proxy:"
+# Renditions in Redis by last use, their sizes and the sum of their sizes
+REDIS_INDEX_KEY = "image-proxy-index"
+REDIS_SIZES_KEY = "image-proxy-sizes"
+REDIS_BYTES_KEY = "image-proxy-bytes"
+
+# Stores the rendition ARGV[1] in KEYS[1] for ARGV[2] seconds, used at ARGV[3], in the index
+# KEYS[2] and the sizes KEYS[3], adding to the total KEYS[4]. Then, while the total is over
+# ARGV[4] bytes, evicts the least recently used renditions. Expired ones are only dropped from
+# the index when evicted, so the total is an upper bound of what Redis holds. Returns the total.
+CACHE_RENDITION_SCRIPT = """
+-- cache_rendition
+local size = string.len(ARGV[1])
+local previous = tonumber(redis.call("HGET", KEYS[3], KEYS[1])) or 0
+redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+redis.call("ZADD", KEYS[2], ARGV[3], KEYS[1])
+redis.call("HSET", KEYS[3], KEYS[1], size)
+local total = redis.call("INCRBY", KEYS[4], size - previous)
+while total > tonumber(ARGV[4]) do
+    local oldest = redis.call("ZPOPMIN", KEYS[2])
+    if #oldest == 0 then
+        break
+    end
+    local evicted = tonumber(redis.call("HGET", KEYS[3], oldest[1])) or 0
+    redis.call("HDEL", KEYS[3], oldest[1])
+    redis.call("DEL", oldest[1])
+    total = redis.call("DECRBY", KEYS[4], evicted)
+end
+return total
+"""
+
+
+@dataclass(frozen=True)
+class Rendition:
+    content: bytes
+    media_type: str
+    etag: str
+
+
+class DiskCache:
+    """Byte-bounded least-recently-used cache of files in a directory."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = Lock()
+
+    def _load(self) -> None:
+        # Files left by a previous run are reused, oldest first in eviction order
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = sorted(
+            (entry.stat().st_mtime, entry.name, entry.stat().st_size)
+            for entry in os.scandir(self.directory)
+            if entry.is_file() and not entry.name.endswith(".tmp")
+        )
+        for _, name, size in entries:
+            self._sizes[name] = size
+            self._total_bytes += size
+        self._loaded = True
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and self._sizes:
+            name, size = self._sizes.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                (self.directory / name).unlink()
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if key not in self._sizes:
+                return None
+            self._sizes.move_to_end(key)
+        try:
+            return (self.directory / key).read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                self._total_bytes -= self._sizes.pop(key, 0)
+            return None
+
+    def set(self, key: str, content: bytes) -> None:
+        if len(content) > self.max_bytes:
+            return
+        path = self.directory / key
+        temporary_path = path.with_name(f"{key}.{os.getpid()}.tmp")
+        with self._lock:
+            if not self._loaded:
+                self._load()
+        temporary_path.write_bytes(content)
+        os.replace(temporary_path, path)
+        with self._lock:
+            self._total_bytes -= self._sizes.pop(key, 0)
+            self._sizes[key] = len(content)
+            self._total_bytes += len(content)
+            self._evict()
+
+
+disk_cache = DiskCache(config.IMAGE_PROXY_CACHE_DIR, config.IMAGE_PROXY_CACHE_MAX_BYTES)
+_inflight: Dict[str, asyncio.Future] = {}
+
+GENERATIONS_MAX_ENTRIES = 10000
+# Generation of recently requested BLOBs and when it was read, least recently used first
+_generations: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+
+
+async def get_generation(path: str) -> Optional[int]:
+    """Get the generation of a BLOB, reading it from the bucket at most once per
+    `IMAGE_PROXY_GENERATION_TTL_SECONDS`.
+
+    Returns:
+        Optional[int]: The generation, or None if the BLOB doesn't exist.
+    """
+    entry = _generations.get(path)
+    if (
+        entry is not None
+        and time.monotonic() - entry[1] < config.IMAGE_PROXY_GENERATION_TTL_SECONDS
+    ):
+        _generations.move_to_end(path)
+        return entry[0]
+    bucket = get_gcs_client().bucket(config.GCS_BUCKET_NAME)
+    blob = await run_in_threadpool(bucket.get_blob, path)
+    if blob is None:
+        _generations.pop(path, None)
+        return None
+    _generations[path] = (blob.generation, time.monotonic())
+    _generations.move_to_end(path)
+    while len(_generations) > GENERATIONS_MAX_ENTRIES:
+        _generations.popitem(last=False)
+    return blob.generation
+
+
+def check_image_path(path: str) -> None:
+    """Only the image series served by the API can be proxied, not the whole bucket."""
+    allowed_prefixes = [config.GOES16_GCS_PATH_PREFIX] + [
+        mapping["gcs_path_prefix"] for mapping in config.RADARS_MAPPING.values()
+    ]
+    if ".." in path.split("/") or not any(
+        path.startswith(prefix) for prefix in allowed_prefixes
+    ):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+
+def check_rendition(width: Optional[int], image_format: ImageFormatEnum) -> None:
+    if width is not None and width not in config.IMAGE_PROXY_ALLOWED_WIDTHS:
+        allowed_widths = ", ".join(str(w) for w in config.IMAGE_PROXY_ALLOWED_WIDTHS)
+        raise HTTPException(
+            status_code=400, detail=f"width must be one of: {allowed_widths}"
+        )
+    if image_format not in SUPPORTED_FORMATS:
+        raise HTTPException(
+            status_code=501,
+            detail=f"The {image_format.value} format is not supported by this server.",
+        )
+
+
+def get_rendition_key(
+    path: str, generation: int, width: Optional[int], image_format: ImageFormatEnum
+) -> str:
+    identity = (
+        f"{config.GCS_BUCKET_NAME}/{path}#{generation}:{width}:{image_format.value}"
+    )
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+def render_image(
+    content: bytes, width: Optional[int], image_format: ImageFormatEnum
+) -> bytes:
+    """Downscale an image to `width` pixels wide, keeping its aspect ratio, and encode it."""
+    with Image.open(io.BytesIO(content)) as image:
+        image.load()
+        if width is not None and image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            # Palette images could only be resized with nearest-neighbour resampling
+            if image.mode == "P":
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            # Reducing by an integer factor first is much faster and barely noticeable
+            image = image.resize(
+                (width, height), Image.Resampling.LANCZOS, reducing_gap=3.0
+            )
+        return encode_image(image, image_format)
+
+
+def encode_image(image: Image.Image, image_format: ImageFormatEnum) -> bytes:
+    output = io.BytesIO()
+    if image_format == ImageFormatEnum.PNG:
+        image.save(output, format="PNG", optimize=True)
+    else:
+        image.save(
+            output,
+            format=image_format.value.upper(),
+            quality=config.IMAGE_PROXY_QUALITY,
+        )
+    return output.getvalue()
+
+
+async def get_rendition(
+    path: str, width: Optional[int], image_format: ImageFormatEnum
+) -> Rendition:
+    """Get an image from the bucket, resized and transcoded, going through the disk and Redis
+    caches.
+
+    Raises:
+        HTTPException: If the path, width or format isn't allowed, or the image doesn't exist.
+
+    Returns:
+        Rendition: The encoded image, its media type and an ETag.
+    """
+    check_image_path(path)
+    check_rendition(width, image_format)
+
+    generation = await get_generation(path)
+    if generation is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    key = get_rendition_key(path, generation, width, image_format)
+
+    async def render() -> bytes:
+        bucket = get_gcs_client().bucket(config.GCS_BUCKET_NAME)
+        blob = bucket.blob(path, generation=generation)
+        try:
+            original = await run_in_threadpool(blob.download_as_bytes)
+        except NotFound:
+            # Overwritten or deleted since its generation was read
+            _generations.pop(path, None)
+            raise HTTPException(status_code=404, detail="Image not found")
+        try:
+            return await run_in_threadpool(render_image, original, width, image_format)
+        except Exception as exc:
+            logger.error(f"Failed to render {blob.name}: {exc}")
+            raise HTTPException(status_code=502, detail="Failed to render the image")
+
+    return await get_cached_rendition(key, image_format, render)
+
+
+async def get_cached_rendition(
+    key: str, image_format: ImageFormatEnum, render: Callable[[], Awaitable[bytes]]
+) -> Rendition:
+    """Get a rendition from the disk or Redis cache, or render and cache it. `key` must
+    identify everything the rendition depends on."""
+    task = _inflight.get(key)
+    if task is None:
+        # Concurrent requests for the same rendition share a single fetch and render
+        task = asyncio.ensure_future(_fetch_rendition(key, render))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    content = await asyncio.shield(task)
+    return Rendition(
+        content=content, media_type=MEDIA_TYPES[image_format], etag=f'"{key[:32]}"'
+    )
+
+
+@lru_cache(maxsize=1)
+def get_cache_rendition_script() -> AsyncScript:
+    return get_redis_client().register_script(CACHE_RENDITION_SCRIPT)
+
+
+async def get_redis_rendition(redis_key: str) -> Optional[bytes]:
+    pipeline = get_redis_client().pipeline(transaction=False)
+    pipeline.get(redis_key)
+    # Marks it as used, unless it was evicted meanwhile
+    pipeline.zadd(REDIS_INDEX_KEY, {redis_key: time.time()}, xx=True)
+    content, _ = await pipeline.execute()
+    return content
+
+
+async def set_redis_rendition(redis_key: str, content: bytes) -> None:
+    await get_cache_rendition_script()(
+        keys=[redis_key, REDIS_INDEX_KEY, REDIS_SIZES_KEY, REDIS_BYTES_KEY],
+        args=[
+            content,
+            config.IMAGE_PROXY_REDIS_TTL_SECONDS,
+            time.time(),
+            config.IMAGE_PROXY_REDIS_MAX_BYTES,
+        ],
+    )
+
+
+async def _fetch_rendition(key: str, render: Callable[[], Awaitable[bytes]]) -> bytes:
+    content = await run_in_threadpool(disk_cache.get, key)
+    if content is not None:
+        return content
+
+    redis_key = f"{REDIS_KEY_PREFIX}{key}"
+    try:
+        content = await get_redis_rendition(redis_key)
+    except Exception as exc:
+        logger.warning(f"Failed to read rendition from Redis: {exc}")
+        content = None
+    if content is None:
+        content = await render()
+        if len(content) <= config.IMAGE_PROXY_REDIS_MAX_ITEM_BYTES:
+            try:
+                await set_redis_rendition(redis_key, content)
+            except Exception as exc:
+                logger.warning(f"Failed to write rendition to Redis: {exc}")
+    await run_in_threadpool(disk_cache.set, key, content)
+    return content
+
+
+def get_proxy_url(
+    base_url: str,
+    image_url: str,
+    width: Optional[int],
+    image_format: ImageFormatEnum,
+) -> str:
+    """Turn the public URL of a BLOB into the URL of its rendition in the image proxy."""
+    public_prefix = f"https://storage.googleapis.com/{config.GCS_BUCKET_NAME}/"
+    if not image_url.startswith(public_prefix):
+        return image_url
+    path = image_url[len(public_prefix) :]
+    params = {"format": image_format.value}
+    if width is not None:
+        params["width"] = width
+    return f"{base_url.rstrip('/')}/images/{path}?{urlencode(params)}"
+
+
+def to_proxy_urls(
+    frames: List[ImageSliderOut],
+    base_url: str,
+    width: Optional[int],
+    image_format: Optional[ImageFormatEnum],
+) -> List[ImageSliderOut]:
+    """Point the frames of a listing at the image proxy, if a width or format was requested.
+
+    Raises:
+        HTTPException: If the width or format isn't allowed.
+    """
+    if width is None and image_format is None:
+        return frames
+    image_format = image_format or ImageFormatEnum.WEBP
+    check_rendition(width, image_format)
+    return [
+        ImageSliderOut(
+            timestamp=frame.timestamp,
+            image_url=get_proxy_url(base_url, frame.image_url, width, image_format),
+        )
+        for frame in frames
+    ]
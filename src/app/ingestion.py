@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Handling of ingestion events: new or deleted images in the bucket, and data loaded into
+BigQuery. Each event is mapped to the series and days it affects, whose cached results are then
+invalidated.
+"""
+
+import base64
+from typing import List, Optional
+
+import orjson as json
+from loguru import logger
+from pendulum import DateTime
+
+from app import config
+from app.availability import availability_index
+from app.data_sources import get_chart_products, get_data_source
+from app.pydantic_models import (
+    BigQueryLoadNotification,
+    ImageSliderOut,
+    InvalidatedSeries,
+    PubSubPushEnvelope,
+    StorageObjectNotification,
+)
+from app.result_cache import bump_versions, get_days
+from app.utils import get_gcs_client
+
+OBJECT_FINALIZE = "OBJECT_FINALIZE"
+OBJECT_DELETE = "OBJECT_DELETE"
+
+
+def parse_pubsub_envelope(
+    envelope: PubSubPushEnvelope,
+) -> Optional[StorageObjectNotification]:
+    """Extract the object of a GCS notification delivered by a Pub/Sub push subscription.
+
+    Returns:
+        Optional[StorageObjectNotification]: The object, or None if the message isn't about a
+            created or deleted object.
+    """
+    attributes = envelope.message.attributes
+    if attributes.get("eventType") not in [OBJECT_FINALIZE, OBJECT_DELETE]:
+        return None
+    if "bucketId" in attributes and "objectId" in attributes:
+        return StorageObjectNotification(
+            bucket=attributes["bucketId"],
+            name=attributes["objectId"],
+            generation=attributes.get("objectGeneration"),
+        )
+    if envelope.message.data:
+        return StorageObjectNotification.parse_obj(
+            json.loads(base64.b64decode(envelope.message.data))
+        )
+    return None
+
+
+async def handle_object_event(
+    notification: StorageObjectNotification, event_type: str = OBJECT_FINALIZE
+) -> List[InvalidatedSeries]:
+    """Invalidate the frame listings of the day of a created or deleted image, and record new
+    images in the availability index."""
+    if notification.bucket != config.GCS_BUCKET_NAME:
+        return []
+    match = availability_index.match_blob(notification.name)
+    if match is None:
+        logger.debug(f"Ignoring event for {notification.name}")
+        return []
+    key, timestamp = match
+    series = f"frames:{key}"
+    days = get_days(timestamp, timestamp)
+    await bump_versions(series, days)
+    if event_type == OBJECT_FINALIZE and availability_index.add(key, timestamp):
+        blob = get_gcs_client().bucket(notification.bucket).blob(notification.name)
+        await availability_index.notify(
+            key, [ImageSliderOut(timestamp=timestamp, image_url=blob.public_url)]
+        )
+    return [InvalidatedSeries(series=series, days=days)]
+
+
+def is_same_table(table: str, other: str) -> bool:
+    """Compare table names, which may or may not include the project, as `dataset.table`."""
+
+    def dataset_and_table(name: str) -> List[str]:
+        return name.replace(":", ".").strip("`").split(".")[-2:]
+
+    return dataset_and_table(table) == dataset_and_table(other)
+
+
+async def handle_load_event(
+    notification: BigQueryLoadNotification,
+) -> List[InvalidatedSeries]:
+    """Invalidate the chart results of the products and days covered by a BigQuery load."""
+    products = [
+        product
+        for product in get_chart_products()
+        if is_same_table(notification.table, get_data_source(product).table)
+    ]
+    if notification.products:
+        products = [product for product in products if product in notification.products]
+    days = get_days(
+        DateTime.instance(notification.start_time, tz=config.TIMEZONE),
+        DateTime.instance(notification.end_time, tz=config.TIMEZONE),
+    )
+    invalidated = []
+    for product in products:
+        series = f"metrics:{product.value}"
+        await bump_versions(series, days)
+        invalidated.append(InvalidatedSeries(series=series, days=days))
+    return invalidated
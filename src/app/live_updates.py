@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Push of new satellite frames, radar frames and metric points to subscribed clients.
+
+Every replica detects new frames through the availability index, and one replica at a time
+(the holder of a lease in Redis) also polls BigQuery for new metric rows. Only the lease holder
+publishes what it finds to a single Redis channel. Every replica subscribes to that channel
+once and fans messages out, in-process, to its own clients. The latest published timestamp of
+each product is kept in Redis next to the lease, so a new lease holder polls from where the
+previous one stopped.
+"""
+
+import asyncio
+import uuid
+from dataclasses import dataclass, field
+from math import isnan
+from typing import Dict, List, Optional, Set
+
+import orjson as json
+from fastapi.encoders import jsonable_encoder
+from loguru import logger
+from pendulum import DateTime, parse as pendulum_parse
+
+from app import config
+from app.availability import availability_index
+from app.data_sources import get_chart_products, group_data_sources
+from app.enums import SatelliteProductEnum
+from app.pydantic_models import ImageSliderOut, SatelliteChartDataOut
+from app.query_executor import execute_query_async
+from app.radars import get_radar_layers
+from app.utils import get_redis_client
+
+LIVE_UPDATES_CHANNEL = "plataforma-clima:live-updates"
+LEADER_LEASE_KEY = "plataforma-clima:live-updates:leader"
+METRICS_WATERMARKS_KEY = "plataforma-clima:live-updates:metrics-watermarks"
+
+
+def get_frames_topic(availability_key: str) -> str:
+    if availability_key in {layer.key for layer in get_radar_layers()}:
+        return f"radar/{availability_key}"
+    return f"satellite/goes16/gif/{availability_key}"
+
+
+def get_chart_topic(product: SatelliteProductEnum) -> str:
+    return f"satellite/goes16/chart/{product.value}"
+
+
+def get_topics() -> Set[str]:
+    topics = {get_frames_topic(key) for key in availability_index.sources}
+    topics |= {get_chart_topic(product) for product in get_chart_products()}
+    return topics
+
+
+@dataclass(eq=False)
+class Subscriber:
+    topics: Set[str]
+    queue: asyncio.Queue = field(
+        default_factory=lambda: asyncio.Queue(
+            maxsize=config.LIVE_UPDATES_SUBSCRIBER_QUEUE_SIZE
+        )
+    )
+    # Set when the subscriber couldn't keep up and was dropped
+    overflowed: bool = False
+
+
+class LiveUpdatesBroker:
+    def __init__(self):
+        self.replica_id = uuid.uuid4().hex
+        self.is_leader = False
+        self.subscribers: Set[Subscriber] = set()
+        self._last_metrics: Dict[SatelliteProductEnum, DateTime] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    # Local fan-out
+
+    def subscribe(self, topics: Set[str]) -> Subscriber:
+        subscriber = Subscriber(topics=topics)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self.subscribers.discard(subscriber)
+
+    def dispatch(self, message: dict) -> None:
+        for subscriber in list(self.subscribers):
+            if message["topic"] not in subscriber.topics:
+                continue
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Slow consumers are dropped rather than slowing everyone else down
+                subscriber.overflowed = True
+                self.unsubscribe(subscriber)
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = get_redis_client().pubsub()
+            try:
+                await pubsub.subscribe(LIVE_UPDATES_CHANNEL)
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0
+                    )
+                    if message is not None:
+                        self.dispatch(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error(f"Live updates subscription failed: {exc}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    # Publishing
+
+    async def publish(self, topic: str, items: list) -> None:
+        if not self.is_leader or not items:
+            return
+        message = {"topic": topic, "items": jsonable_encoder(items)}
+        await get_redis_client().publish(LIVE_UPDATES_CHANNEL, json.dumps(message))
+
+    async def publish_frames(
+        self, availability_key: str, frames: List[ImageSliderOut]
+    ) -> None:
+        await self.publish(get_frames_topic(availability_key), frames)
+
+    async def _renew_lease(self) -> None:
+        redis = get_redis_client()
+        lease_ms = config.LIVE_UPDATES_LEADER_LEASE_SECONDS * 1000
+        while True:
+            try:
+                if self.is_leader:
+                    # Only extend the lease if it's still ours
+                    owner = await redis.get(LEADER_LEASE_KEY)
+                    self.is_leader = owner == self.replica_id.encode()
+                    if self.is_leader:
+                        await redis.set(
+                            LEADER_LEASE_KEY, self.replica_id, px=lease_ms, xx=True
+                        )
+                if not self.is_leader:
+                    self.is_leader = bool(
+                        await redis.set(
+                            LEADER_LEASE_KEY, self.replica_id, px=lease_ms, nx=True
+                        )
+                    )
+                    if self.is_leader:
+                        logger.info("This replica is now publishing live updates")
+                        await self._load_watermarks()
+            except Exception as exc:
+                logger.error(f"Failed to renew the live updates lease: {exc}")
+                self.is_leader = False
+            await asyncio.sleep(config.LIVE_UPDATES_LEADER_LEASE_SECONDS / 3)
+
+    async def _load_watermarks(self) -> None:
+        """Resume from the latest points published by the previous lease holder."""
+        try:
+            content = await get_redis_client().get(METRICS_WATERMARKS_KEY)
+        except Exception as exc:
+            logger.error(f"Failed to read the live updates watermarks: {exc}")
+            return
+        if content is None:
+            return
+        for value, timestamp in json.loads(content).items():
+            product = SatelliteProductEnum(value)
+            if product in self._last_metrics:
+                self._last_metrics[product] = pendulum_parse(timestamp).in_tz(
+                    config.TIMEZONE
+                )
+
+    async def _save_watermarks(self) -> None:
+        await get_redis_client().set(
+            METRICS_WATERMARKS_KEY,
+            json.dumps(
+                {
+                    product.value: timestamp.isoformat()
+                    for product, timestamp in self._last_metrics.items()
+                }
+            ),
+        )
+
+    async def _fetch_new_metrics(self) -> Dict[SatelliteProductEnum, list]:
+        products = get_chart_products()
+        start_time = min(self._last_metrics[product] for product in products)
+        end_time = DateTime.now(tz=config.TIMEZONE)
+
+        # Products sharing a table are polled with a single query
+        rows = []
+        for sources in group_data_sources(products):
+            source = sources[0]
+            products_by_value = {
+                source.product_value: source.product for source in sources
+            }
+            query_filter, query_params = source.get_query_filter(
+                start_time,
+                end_time,
+                product_values=list(products_by_value)
+                if source.product_column
+                else None,
+            )
+            product_column = (
+                f"{source.product_column} AS produto_satelite,"
+                if source.product_column
+                else ""
+            )
+            query = f"""
+            SELECT
+                {product_column}
+                {source.timestamp_expression} AS data_medicao,
+                {source.value_column} AS valor
+            FROM {source.table}
+            WHERE
+                {query_filter}
+            """
+            data = await execute_query_async(
+                query, query_params, product="live-updates"
+            )
+            data.drop_duplicates(inplace=True)
+            for row in data.itertuples(index=False):
+                product = (
+                    products_by_value.get(row.produto_satelite)
+                    if source.product_column
+                    else source.product
+                )
+                if product is not None:
+                    rows.append((product, row.data_medicao, row.valor))
+
+        new_points: Dict[SatelliteProductEnum, list] = {}
+        for product, data_medicao, valor in rows:
+            timestamp = pendulum_parse(data_medicao, tz=config.TIMEZONE)
+            if timestamp <= self._last_metrics[product]:
+                continue
+            value = valor if valor and not isnan(float(valor)) else None
+            new_points.setdefault(product, []).append(
+                SatelliteChartDataOut(timestamp=timestamp, value=value)
+            )
+        for product, points in new_points.items():
+            points.sort(key=lambda point: point.timestamp)
+            self._last_metrics[product] = points[-1].timestamp
+        return new_points
+
+    async def _watch_metrics(self) -> None:
+        while True:
+            await asyncio.sleep(config.LIVE_UPDATES_METRICS_POLL_SECONDS)
+            if not self.is_leader:
+                continue
+            try:
+                new_points = await self._fetch_new_metrics()
+                for product, points in new_points.items():
+                    await self.publish(get_chart_topic(product), points)
+                # Saved once published, so a handover may repeat points but never skip any
+                if new_points and self.is_leader:
+                    await self._save_watermarks()
+            except Exception as exc:
+                logger.error(f"Failed to poll new metrics: {exc}")
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        availability_index.listeners.append(self.publish_frames)
+        # Set before the lease can be taken, which replaces them with the saved ones
+        now = DateTime.now(tz=config.TIMEZONE)
+        self._last_metrics = {product: now for product in get_chart_products()}
+        self._tasks = [
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._renew_lease()),
+            asyncio.create_task(self._watch_metrics()),
+        ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.publish_frames in availability_index.listeners:
+            availability_index.listeners.remove(self.publish_frames)
+        if self.is_leader:
+            try:
+                await get_redis_client().delete(LEADER_LEASE_KEY)
+            except Exception as exc:
+                logger.error(f"Failed to release the live updates lease: {exc}")
+            self.is_leader = False
+
+
+live_updates_broker = LiveUpdatesBroker()
+
+
+def format_sse_message(message: Optional[dict]) -> bytes:
+    """Format a message as a Server-Sent Event, or a keep-alive comment if there's none."""
+    if message is None:
+        return b": keep-alive\n\n"
+    return (
+        b"event: "
+        + message["topic"].encode()
+        + b"\ndata: "
+        + json.dumps(message["items"])
+        + b"\n\n"
+    )
@@ -1,22 +1,42 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import sys
+from contextlib import asynccontextmanager
 
-import orjson as json
 import sentry_sdk
 from fastapi import FastAPI, Request, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.redis import RedisBackend
 from fastapi_pagination import add_pagination
 from loguru import logger
-from redis.asyncio import Redis
 from starlette.responses import JSONResponse
 
 from app import config
-from app.pydantic_models import HealthCheck
-
-from app.routers import radar, satellite
+from app.availability import availability_index
+from app.data_sources import inspect_data_sources
+from app.events import event_index_warmer
+from app.gridded_data import gridded_data_sync
+from app.healthcheck import dependency_prober
+from app.live_updates import live_updates_broker
+from app.metrics_mirror import metrics_mirror
+from app.profiling import ProfilingMiddleware
+from app.pydantic_models import HealthCheck, ReadinessCheck
+from app.rate_limit import RateLimitMiddleware
+from app.result_cache import invalidate_frames
+from app.routers import (
+    catalog,
+    images,
+    ingestion,
+    live,
+    profiling,
+    radar,
+    satellite,
+)
+from app.spatial_index import load_spatial_index
+from app.utils import get_redis_client
 
 logger.remove()
 logger.add(sys.stdout, level=config.LOG_LEVEL)
@@ -29,10 +49,46 @@ if config.SENTRY_ENABLE:
     )
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    dependency_prober.start()
+    # Before anything queries the sources, so they are queried with the layout of their tables
+    await asyncio.to_thread(inspect_data_sources)
+    # Registered before the live updates, so streamed frames are already listed by the API
+    availability_index.listeners.append(invalidate_frames)
+    availability_index.start()
+    live_updates_broker.start()
+    event_index_warmer.start()
+    if config.METRICS_MIRROR_ENABLE:
+        metrics_mirror.start()
+    if config.GRIDDED_DATA_SYNC_ENABLE:
+        gridded_data_sync.start()
+    # Reading the shapefile takes a while, so the index is built without delaying startup
+    spatial_index_task = asyncio.create_task(asyncio.to_thread(load_spatial_index))
+    yield
+    await spatial_index_task
+    await gridded_data_sync.stop()
+    await metrics_mirror.stop()
+    await event_index_warmer.stop()
+    await live_updates_broker.stop()
+    await availability_index.stop()
+    availability_index.listeners.remove(invalidate_frames)
+    await dependency_prober.stop()
+    await get_redis_client().aclose()
+
+
 app = FastAPI(
     title="Plataforma Clima API",
+    lifespan=lifespan,
 )
 
+# Innermost, so profiles only cover the requests that are actually served
+if config.PROFILING_TOKEN:
+    app.add_middleware(ProfilingMiddleware)
+
+# Added before CORS, so CORS wraps it and rejected requests still get CORS headers
+app.add_middleware(RateLimitMiddleware)
+
 logger.debug("Configuring CORS with the following settings:")
 allow_origins = config.ALLOWED_ORIGINS if config.ALLOWED_ORIGINS else ()
 logger.debug(f"ALLOWED_ORIGINS: {allow_origins}")
@@ -50,54 +106,60 @@ app.add_middleware(
     allow_methods=config.ALLOWED_METHODS,
     allow_headers=config.ALLOWED_HEADERS,
     allow_credentials=config.ALLOW_CREDENTIALS,
+    expose_headers=[config.CURSOR_HEADER],
 )
 
+app.include_router(catalog.router)
+app.include_router(images.router)
+app.include_router(ingestion.router)
+app.include_router(live.router)
+app.include_router(profiling.router)
 app.include_router(radar.router)
 app.include_router(satellite.router)
 
 add_pagination(app)
 
 
-FastAPICache.init(
-    RedisBackend(
-        Redis(
-            host=config.REDIS_HOST,
-            port=config.REDIS_PORT,
-            db=config.REDIS_DB,
-            password=config.REDIS_PASSWORD,
-        )
-    )
-)
+FastAPICache.init(RedisBackend(get_redis_client()))
 
 
 @app.get(
     "/health",
     tags=["Healthcheck"],
-    summary="Performs a health check",
+    summary="Performs a liveness check",
     responses={
         200: {"status": "OK"},
         429: {"error": "Rate limit exceeded"},
-        503: {"status": "Service Unavailable"},
     },
     response_model=HealthCheck,
 )
-async def healthcheck(request: Request):
-    # Check if Redis is available
-    try:
-        r = Redis(
-            host=config.REDIS_HOST,
-            port=config.REDIS_PORT,
-            db=config.REDIS_DB,
-            password=config.REDIS_PASSWORD,
-        )
-        await r.ping()
-    except Exception as exc:
-        logger.error(f"Failed to ping Redis: {exc}")
+async def healthcheck():
+    # Liveness only tells whether the process is serving requests. It must not depend on any
+    # external service, otherwise a slow dependency would get every pod restarted.
+    return {"status": "OK"}
+
+
+@app.get(
+    "/health/ready",
+    tags=["Healthcheck"],
+    summary="Performs a readiness check",
+    responses={
+        200: {"status": "OK"},
+        429: {"error": "Rate limit exceeded"},
+        503: {"status": "Service Unavailable"},
+    },
+    response_model=ReadinessCheck,
+)
+async def readiness_check():
+    # Dependency statuses are collected by a background prober, so this never opens a
+    # connection by itself.
+    dependencies = jsonable_encoder(dependency_prober.statuses)
+    if not dependency_prober.is_ready(config.HEALTHCHECK_REQUIRED_DEPENDENCIES):
         return JSONResponse(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            content=json.dumps({"status": "Service Unavailable"}),
+            content={"status": "Service Unavailable", "dependencies": dependencies},
         )
-    return {"status": "OK"}
+    return {"status": "OK", "dependencies": dependencies}
 
 
 @app.exception_handler(RequestValidationError)
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Local Parquet mirror of the geospatial metrics table, serving the chart ranges that are too long
+to be queried from BigQuery.
+
+Each past day of each product is one file at
+`{root}/produto_satelite={column}/dia={YYYY-MM-DD}/v{version}.parquet`, where `version` is the
+result cache version of the `metrics:{product}` series for that day. A BigQuery load
+notification bumps that version, so every replica downloads the day again before querying it.
+Days are downloaded one at a time, from the most recent, which bounds memory to a single day of
+a product. With a shared bucket, the replica that claims a version of a day in Redis queries it
+from BigQuery and uploads its file, and the others download that file instead. Queries only
+open the files of the requested days, and the time and bounding box filters are pushed down to
+their row groups. Days that aren't synced yet are left to BigQuery by the callers.
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pendulum
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from google.api_core.exceptions import NotFound
+from loguru import logger
+from pendulum import DateTime
+
+from app import config
+from app.data_sources import get_chart_products, get_data_source
+from app.enums import SatelliteProductEnum
+from app.query_executor import execute_query
+from app.result_cache import get_days, get_versions
+from app.spatial_index import spatial_index
+from app.utils import get_gcs_client, get_redis_client
+
+DATETIME_FORMAT = "YYYY-MM-DD HH:mm:ss"
+CLAIM_KEY_PREFIX = "plataforma-clima:metrics-mirror:claim"
+# Long enough for the query and the upload. A claim left by a replica that went away expires,
+# and the day is claimed again by the next sync.
+CLAIM_SECONDS = 600
+
+
+class MetricsMirror:
+    def __init__(
+        self,
+        root: str,
+        *,
+        days: int,
+        sync_seconds: int,
+        gcs_bucket: Optional[str] = None,
+        gcs_prefix: str = "",
+    ):
+        self.root = Path(root)
+        self.days = days
+        self.sync_seconds = sync_seconds
+        self.gcs_bucket = gcs_bucket
+        self.gcs_prefix = gcs_prefix
+        self.replica_id = uuid.uuid4().hex
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self._task: asyncio.Task = None
+
+    def get_day_dir(self, column: str, day: str) -> Path:
+        return self.root / f"produto_satelite={column}" / f"dia={day}"
+
+    def get_blob_name(self, column: str, day: str, version: int) -> str:
+        return (
+            f"{self.gcs_prefix}produto_satelite={column}/dia={day}/v{version}.parquet"
+        )
+
+    def get_file(self, column: str, day: str) -> Optional[Path]:
+        """The most recent file of a day, if it was synced."""
+        files = self.get_day_dir(column, day).glob("v*.parquet")
+        return max(files, key=lambda path: int(path.stem[1:]), default=None)
+
+    def get_sync_days(self) -> List[str]:
+        """Days kept in the mirror, from the most recent. The current day is always left to
+        BigQuery since it is still being loaded."""
+        today = pendulum.now(config.TIMEZONE).start_of("day")
+        return [
+            today.subtract(days=offset).format("YYYY-MM-DD")
+            for offset in range(1, self.days + 1)
+        ]
+
+    def download_day(
+        self, product: SatelliteProductEnum, column: str, day: str, version: int
+    ) -> None:
+        source = get_data_source(product)
+        query_filter, query_params = source.get_query_filter(
+            pendulum.parse(day, tz=config.TIMEZONE),
+            pendulum.parse(day, tz=config.TIMEZONE).end_of("day"),
+        )
+        coordinates = (
+            f"{source.latitude_column} AS latitude, {source.longitude_column} AS longitude"
+            if source.has_coordinates
+            else "CAST(NULL AS FLOAT64) AS latitude, CAST(NULL AS FLOAT64) AS longitude"
+        )
+        query = f"""
+        SELECT
+            {source.timestamp_expression} AS data_medicao,
+            {source.value_column} AS valor,
+            {coordinates}
+        FROM {source.table}
+        WHERE
+            {query_filter}
+        """
+        data = execute_query(
+            query=query, query_params=query_params, product=product.value
+        )
+        data["valor"] = pd.to_numeric(data["valor"], errors="coerce")
+        data = data.drop_duplicates().sort_values("data_medicao")
+        table = pa.Table.from_pandas(
+            data,
+            schema=pa.schema(
+                [
+                    ("data_medicao", pa.string()),
+                    ("valor", pa.float64()),
+                    ("latitude", pa.float64()),
+                    ("longitude", pa.float64()),
+                ]
+            ),
+            preserve_index=False,
+        )
+
+        temporary_path = self.get_temporary_path(column, day)
+        pq.write_table(table, temporary_path, compression="zstd")
+        if self.gcs_bucket:
+            try:
+                get_gcs_client().bucket(self.gcs_bucket).blob(
+                    self.get_blob_name(column, day, version)
+                ).upload_from_filename(temporary_path)
+            except Exception as exc:
+                logger.error(f"Failed to share {column} on {day}: {exc}")
+        self.install(column, day, version, temporary_path)
+
+    def download_shared_day(self, column: str, day: str, version: int) -> bool:
+        """Download the file of a day uploaded by another replica.
+
+        Returns:
+            bool: Whether it was uploaded already.
+        """
+        temporary_path = self.get_temporary_path(column, day)
+        try:
+            get_gcs_client().bucket(self.gcs_bucket).blob(
+                self.get_blob_name(column, day, version)
+            ).download_to_filename(temporary_path)
+        except NotFound:
+            Path(temporary_path).unlink(missing_ok=True)
+            return False
+        except Exception:
+            Path(temporary_path).unlink(missing_ok=True)
+            raise
+        self.install(column, day, version, temporary_path)
+        return True
+
+    def get_temporary_path(self, column: str, day: str) -> str:
+        day_dir = self.get_day_dir(column, day)
+        day_dir.mkdir(parents=True, exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=day_dir, suffix=".tmp")
+        os.close(descriptor)
+        return temporary_path
+
+    def install(self, column: str, day: str, version: int, temporary_path: str) -> None:
+        """Move a file written aside into place, so queries never see a partial file."""
+        day_dir = self.get_day_dir(column, day)
+        path = day_dir / f"v{version}.parquet"
+        os.replace(temporary_path, path)
+        for old_path in day_dir.glob("v*.parquet"):
+            if old_path != path:
+                old_path.unlink(missing_ok=True)
+
+    def prune(self, column: str, days: List[str]) -> None:
+        """Remove the days of a product that are no longer kept."""
+        kept = set(days)
+        for day_dir in (self.root / f"produto_satelite={column}").glob("dia=*"):
+            if day_dir.name[len("dia=") :] not in kept:
+                shutil.rmtree(day_dir, ignore_errors=True)
+
+    async def claim(self, column: str, day: str, version: int) -> bool:
+        """Claim the query of a version of a day for this replica."""
+        try:
+            return bool(
+                await get_redis_client().set(
+                    f"{CLAIM_KEY_PREFIX}:{column}:{day}:v{version}",
+                    self.replica_id,
+                    nx=True,
+                    ex=CLAIM_SECONDS,
+                )
+            )
+        except Exception as exc:
+            # Querying it here as well beats not having the day at all
+            logger.warning(f"Failed to claim {column} on {day}: {exc}")
+            return True
+
+    async def release(self, column: str, day: str, version: int) -> None:
+        """Let another replica query a day this replica failed to."""
+        try:
+            await get_redis_client().delete(
+                f"{CLAIM_KEY_PREFIX}:{column}:{day}:v{version}"
+            )
+        except Exception as exc:
+            logger.warning(f"Failed to release {column} on {day}: {exc}")
+
+    async def download(
+        self, product: SatelliteProductEnum, day: str, version: int
+    ) -> None:
+        """Download a day, unless it was just downloaded by a concurrent sync or query. With a
+        shared bucket, a day that isn't uploaded yet and was claimed by another replica is left
+        for a later sync."""
+        column = config.SATELLITE_PRODUCTS_MAPPING[product]["column"]
+        async with self._locks.setdefault((column, day), asyncio.Lock()):
+            path = self.get_file(column, day)
+            if path is not None and path.stem == f"v{version}":
+                return
+            if self.gcs_bucket:
+                if await asyncio.to_thread(
+                    self.download_shared_day, column, day, version
+                ):
+                    return
+                if not await self.claim(column, day, version):
+                    return
+            try:
+                await asyncio.to_thread(
+                    self.download_day, product, column, day, version
+                )
+            except Exception:
+                if self.gcs_bucket:
+                    await self.release(column, day, version)
+                raise
+
+    async def get_outdated_days(
+        self, product: SatelliteProductEnum, days: List[str]
+    ) -> List[Tuple[str, int, bool]]:
+        """Find the days that were never downloaded, or were reloaded since they were.
+
+        Returns:
+            List[Tuple[str, int, bool]]: The day, its current version and whether it is
+                missing, for each outdated day.
+        """
+        column = config.SATELLITE_PRODUCTS_MAPPING[product]["column"]
+        try:
+            versions = await get_versions(f"metrics:{product.value}", days)
+        except Exception as exc:
+            # Without versions, the days already downloaded are assumed up to date
+            logger.warning(f"Failed to get versions of {product.value}: {exc}")
+            versions = [None] * len(days)
+        outdated = []
+        for day, version in zip(days, versions):
+            path = self.get_file(column, day)
+            if path is None:
+                outdated.append((day, version or 0, True))
+            elif version is not None and path.stem != f"v{version}":
+                outdated.append((day, version, False))
+        return outdated
+
+    async def prepare(
+        self, product: SatelliteProductEnum, days: List[str]
+    ) -> List[str]:
+        """Download the days that were reloaded since they were downloaded, before they are
+        queried. Those are usually a few recent days, unlike the days never downloaded which
+        are left to the sync.
+
+        Returns:
+            List[str]: The days that can't be queried, as they were never downloaded.
+        """
+        outdated = await self.get_outdated_days(product, days)
+        for day, version, missing in outdated:
+            if not missing:
+                await self.download(product, day, version)
+        return [day for day, _, missing in outdated if missing]
+
+    async def sync(self) -> None:
+        """Download the days that are missing or were reloaded since they were downloaded, the
+        most recent first, so a new replica and a new day are served from the mirror soonest."""
+        days = self.get_sync_days()
+        outdated = []
+        for product in get_chart_products():
+            for day, version, _ in await self.get_outdated_days(product, days):
+                outdated.append((day, product, version))
+        # Stable, so the products of a day keep their order
+        outdated.sort(key=lambda item: item[0], reverse=True)
+        for day, product, version in outdated:
+            try:
+                await self.download(product, day, version)
+            except Exception as exc:
+                logger.error(f"Failed to mirror {product.value} on {day}: {exc}")
+        for product in get_chart_products():
+            column = config.SATELLITE_PRODUCTS_MAPPING[product]["column"]
+            await asyncio.to_thread(self.prune, column, days)
+
+    def get_sleep_seconds(self) -> float:
+        """Seconds until the next sync, which is brought forward to the start of the next day,
+        so the day that just ended is synced right away."""
+        now = pendulum.now(config.TIMEZONE)
+        until_next_day = (now.add(days=1).start_of("day") - now).total_seconds()
+        return min(self.sync_seconds, until_next_day + 1)
+
+    def query(
+        self,
+        column: str,
+        start_time: DateTime,
+        end_time: DateTime,
+        cells: Optional[List[int]] = None,
+        point: Optional[Tuple[float, float]] = None,
+    ) -> pd.DataFrame:
+        """Get the `data_medicao` and `valor` of a product between two timestamps (inclusive),
+        restricted to a set of grid cells if given, and to the measurement point nearest to a
+        (lat, lon) `point` within them if given, as the chart query would.
+        """
+        files = [self.get_file(column, day) for day in get_days(start_time, end_time)]
+        paths = [str(path) for path in files if path is not None]
+        if not paths:
+            return pd.DataFrame({"data_medicao": [], "valor": []})
+        dataset = ds.dataset(paths, format="parquet")
+
+        data_medicao = ds.field("data_medicao")
+        expression = (
+            data_medicao >= start_time.in_tz(config.TIMEZONE).format(DATETIME_FORMAT)
+        ) & (data_medicao <= end_time.in_tz(config.TIMEZONE).format(DATETIME_FORMAT))
+        columns = ["data_medicao", "valor"]
+        if cells is not None:
+            min_lon, min_lat, max_lon, max_lat = spatial_index.cell_bounds(cells)
+            expression &= (
+                (ds.field("latitude") >= min_lat)
+                & (ds.field("latitude") <= max_lat)
+                & (ds.field("longitude") >= min_lon)
+                & (ds.field("longitude") <= max_lon)
+            )
+            columns += ["latitude", "longitude"]
+        data = dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+        if cells is not None:
+            in_cells = np.isin(
+                spatial_index.cells_of(
+                    data["latitude"].to_numpy(), data["longitude"].to_numpy()
+                ),
+                cells,
+            )
+            data = data.loc[in_cells]
+            if point is not None:
+                return spatial_index.select_nearest(data, *point)
+            data = data[["data_medicao", "valor"]]
+        return data
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sync()
+            except Exception as exc:
+                logger.error(f"Failed to sync the metrics mirror: {exc}")
+            await asyncio.sleep(self.get_sleep_seconds())
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+metrics_mirror = MetricsMirror(
+    config.METRICS_MIRROR_DIR,
+    days=config.METRICS_MIRROR_DAYS,
+    sync_seconds=config.METRICS_MIRROR_SYNC_SECONDS,
+    gcs_bucket=config.METRICS_MIRROR_GCS_BUCKET,
+    gcs_prefix=config.METRICS_MIRROR_GCS_PREFIX,
+)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of gridded frames with a palette chosen by the caller.
+
+Values are quantized into 255 bins over the `values_range` of the product, and the last index
+is kept for missing values. A palette is a 256-entry RGBA lookup table over those indexes, so
+rendering a frame is a single `lut[indexes]` pass. A threshold mask is just a palette whose
+entries outside the threshold are transparent.
+"""
+
+import hashlib
+import re
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+from pendulum import DateTime
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+
+from app.enums import ImageFormatEnum, SatelliteProductEnum
+from app.gridded_data import select_gridded_frame
+from app.image_proxy import (
+    Rendition,
+    check_rendition,
+    encode_image,
+    get_cached_rendition,
+)
+from app.products_info import PRODUCTS_INFO
+
+NO_DATA_INDEX = 255
+MAX_COLOR_STOPS = 32
+
+ColorStops = Tuple[Tuple[float, str], ...]
+
+
+def get_legend_stops(product: SatelliteProductEnum) -> ColorStops:
+    return tuple(
+        (float(stop["value"]), stop["color"])
+        for stop in PRODUCTS_INFO[product]["legend"]["colors"]
+    )
+
+
+def get_legend_opacity(product: SatelliteProductEnum) -> float:
+    return float(PRODUCTS_INFO[product]["legend"].get("opacity", 1.0))
+
+
+def parse_color_stops(colors: str) -> ColorStops:
+    """Parse color stops given as `value:#RRGGBB` pairs, e.g. `0:#0000FF,2000:#FF0000`.
+
+    Raises:
+        HTTPException: If the stops are malformed, too many or not in increasing order.
+    """
+    stops = []
+    for item in colors.split(","):
+        match = re.fullmatch(r"\s*(-?[0-9.]+)\s*:\s*(#[0-9A-Fa-f]{6})\s*", item)
+        if not match:
+            raise HTTPException(
+                status_code=400,
+                detail="colors must be formatted as value:#RRGGBB pairs, e.g. 0:#0000FF,2000:#FF0000.",
+            )
+        try:
+            value = float(match.group(1))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid value: {item}")
+        stops.append((value, match.group(2).upper()))
+    if len(stops) > MAX_COLOR_STOPS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_COLOR_STOPS} colors can be given.",
+        )
+    if any(current[0] <= previous[0] for previous, current in zip(stops, stops[1:])):
+        raise HTTPException(
+            status_code=400, detail="The color values must be increasing."
+        )
+    return tuple(stops)
+
+
+def get_bin_centers(values_range: Tuple[float, float]) -> np.ndarray:
+    min_value, max_value = values_range
+    return min_value + (np.arange(NO_DATA_INDEX) + 0.5) * (
+        (max_value - min_value) / NO_DATA_INDEX
+    )
+
+
+@lru_cache(maxsize=256)
+def build_lut(
+    stops: ColorStops,
+    values_range: Tuple[float, float],
+    min_value: Optional[float] = None,
+    max_value: Optional[float] = None,
+    opacity: float = 1.0,
+) -> np.ndarray:
+    """Build the lookup table of a palette: colors are interpolated linearly between the
+    stops, and bins outside [`min_value`, `max_value`] or without data are transparent.
+
+    Returns:
+        np.ndarray: A read-only (256, 4) array of RGBA colors.
+    """
+    centers = get_bin_centers(values_range)
+    stop_values = np.array([value for value, _ in stops])
+    stop_colors = np.array(
+        [[int(color[i : i + 2], 16) for i in (1, 3, 5)] for _, color in stops]
+    )
+    lut = np.zeros((NO_DATA_INDEX + 1, 4), dtype=np.uint8)
+    for channel in range(3):
+        lut[:NO_DATA_INDEX, channel] = np.rint(
+            np.interp(centers, stop_values, stop_colors[:, channel])
+        )
+    visible = np.ones(NO_DATA_INDEX, dtype=bool)
+    if min_value is not None:
+        visible &= centers >= min_value
+    if max_value is not None:
+        visible &= centers <= max_value
+    lut[:NO_DATA_INDEX, 3] = np.where(visible, round(opacity * 255), 0)
+    lut.flags.writeable = False
+    return lut
+
+
+def quantize(values: np.ndarray, values_range: Tuple[float, float]) -> np.ndarray:
+    """Map values to their bin indexes, with `NO_DATA_INDEX` for missing values."""
+    min_value, max_value = values_range
+    scaled = (values - min_value) * (NO_DATA_INDEX / (max_value - min_value))
+    np.clip(scaled, 0, NO_DATA_INDEX - 1, out=scaled)
+    return np.nan_to_num(scaled, nan=NO_DATA_INDEX).astype(np.uint8)
+
+
+def render_values(
+    values: np.ndarray,
+    lut: np.ndarray,
+    values_range: Tuple[float, float],
+    width: Optional[int],
+    image_format: ImageFormatEnum,
+) -> bytes:
+    image = Image.fromarray(lut[quantize(values, values_range)], "RGBA")
+    if width is not None and image.width != width:
+        # Grid cells are kept sharp rather than blurred into each other
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.Resampling.NEAREST)
+    return encode_image(image, image_format)
+
+
+async def render_frame(
+    product: SatelliteProductEnum,
+    timestamp: DateTime,
+    *,
+    stops: Optional[ColorStops],
+    min_value: Optional[float],
+    max_value: Optional[float],
+    opacity: Optional[float],
+    width: Optional[int],
+    image_format: ImageFormatEnum,
+) -> Rendition:
+    """Render the latest frame of a product at or before `timestamp` with a palette, going
+    through the image proxy caches. Without `stops`, the legend palette is used, and so is the
+    legend opacity unless `opacity` is given.
+
+    Raises:
+        HTTPException: If the product has no gridded data or frame, or the rendition isn't
+            allowed.
+
+    Returns:
+        Rendition: The encoded image, its media type and an ETag.
+    """
+    check_rendition(width, image_format)
+    values_range = (
+        float(PRODUCTS_INFO[product]["values_range"]["min"]),
+        float(PRODUCTS_INFO[product]["values_range"]["max"]),
+    )
+    if opacity is None:
+        opacity = 1.0 if stops else get_legend_opacity(product)
+    stops = stops or get_legend_stops(product)
+    lut = build_lut(stops, values_range, min_value, max_value, opacity)
+    frame_time, frame, version = await run_in_threadpool(
+        select_gridded_frame, product, timestamp
+    )
+
+    # Frames may be rewritten by a new version of the store, so both identify their values
+    identity = (
+        f"{product.value}@{frame_time.isoformat()}:{version}:{values_range}:"
+        f"{hashlib.sha1(lut.tobytes()).hexdigest()}:"
+        f"{width}:{image_format.value}"
+    )
+    key = hashlib.sha256(identity.encode()).hexdigest()
+
+    async def render() -> bytes:
+        values = await run_in_threadpool(lambda: frame.values)
+        return await run_in_threadpool(
+            render_values, values, lut, values_range, width, image_format
+        )
+
+    return await get_cached_rendition(key, image_format, render)
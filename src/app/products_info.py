@@ -223,7 +223,7 @@ PRODUCTS_INFO = {
             ],
         },
     },
-    SatelliteProductEnum.SEA_SURFACE_TEMPERATURE: {
+    SatelliteProductEnum.OCEAN_TEMPERATURE: {
         "product": {
             "name": "SST (Sea Surface Temperature)",
             "description": "A Temperatura da Superfície do Mar (SST) é uma medida da temperatura da água na superfície dos oceanos. Este parâmetro é fundamental para o monitoramento climático, previsão meteorológica e estudos oceanográficos, afetando padrões climáticos globais e a saúde dos ecossistemas marinhos.",
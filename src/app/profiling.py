@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand profiling of requests.
+
+A profiled request is sampled by a background thread, which reads the stack of every thread of
+the process at a fixed interval, so the work handed to the thread pool (BigQuery calls, blob
+listings, image encoding) is captured along with the event loop. Samples are aggregated as
+collapsed stacks, the input of flamegraph.pl and speedscope, and kept in Redis by profile id.
+
+Requests are profiled when they carry the profiling token in `PROFILING_HEADER`, or at random
+with `PROFILING_SAMPLE_RATE` outside of `PROFILING_EXCLUDED_PATHS`. The middleware is only
+installed when `PROFILING_TOKEN` is set, so it costs nothing otherwise, and a replica profiles
+one request at a time: other requests are served as usual meanwhile, although their stacks may
+show up in the profile. Profiles are cut after `PROFILING_MAX_SECONDS`, so a long request
+doesn't keep the sampler running.
+"""
+
+import asyncio
+import random
+import secrets
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Optional
+
+import orjson as json
+from loguru import logger
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app import config
+from app.utils import get_redis_client
+
+# Leaf frames of threads waiting for work, which are left out of the samples
+IDLE_FRAMES = (
+    "selectors.",
+    "threading.Condition.wait",
+    "concurrent.futures.thread._worker",
+)
+
+
+def get_profile_key(profile_id: str) -> str:
+    return f"profile:{profile_id}"
+
+
+def get_frame_label(frame) -> str:
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_qualname}"
+
+
+class StackSampler:
+    """Counts the stacks of every thread, sampled every `interval_seconds` until stopped."""
+
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+
+    def sample(self) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self._thread.ident:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(get_frame_label(frame))
+                frame = frame.f_back
+            if not labels or labels[0].startswith(IDLE_FRAMES):
+                continue
+            labels.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(labels))] += 1
+        self.samples += 1
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval_seconds):
+            self.sample()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="profiling-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+
+async def store_profile(profile_id: str, profile: dict) -> None:
+    try:
+        await get_redis_client().set(
+            get_profile_key(profile_id),
+            json.dumps(profile),
+            ex=config.PROFILING_TTL_SECONDS,
+        )
+    except Exception as exc:
+        logger.warning(f"Failed to store profile {profile_id}: {exc}")
+
+
+async def get_profile(profile_id: str) -> Optional[dict]:
+    content = await get_redis_client().get(get_profile_key(profile_id))
+    return json.loads(content) if content is not None else None
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.header = config.PROFILING_HEADER.lower().encode("latin-1")
+        self.token = config.PROFILING_TOKEN.encode()
+        self.busy = False
+
+    def is_requested(self, scope: Scope) -> bool:
+        for name, value in scope.get("headers", []):
+            if name == self.header:
+                return secrets.compare_digest(value, self.token)
+        if scope["path"].startswith(tuple(config.PROFILING_EXCLUDED_PATHS)):
+            return False
+        return random.random() < config.PROFILING_SAMPLE_RATE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or self.busy or not self.is_requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        # The event loop is single-threaded, so the flag can't be taken twice
+        self.busy = True
+        profile_id = uuid.uuid4().hex
+        status_code = None
+
+        async def send_with_profile_id(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message = {
+                    **message,
+                    "headers": [
+                        *message["headers"],
+                        (b"x-profile-id", profile_id.encode()),
+                    ],
+                }
+            await send(message)
+
+        sampler = StackSampler(config.PROFILING_INTERVAL_SECONDS)
+        started_at = time.perf_counter()
+        finished = False
+
+        async def finish(truncated: bool) -> None:
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            sampler.stop()
+            self.busy = False
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+            logger.info(
+                f"Profiled {scope['method']} {scope['path']} as {profile_id}: "
+                f"status={status_code}, elapsed_ms={elapsed_ms:.0f}, "
+                f"samples={sampler.samples}, truncated={truncated}"
+            )
+            await store_profile(
+                profile_id,
+                {
+                    "id": profile_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "query_string": scope.get("query_string", b"").decode("latin-1"),
+                    "status_code": status_code,
+                    "elapsed_ms": elapsed_ms,
+                    "truncated": truncated,
+                    "interval_seconds": sampler.interval_seconds,
+                    "samples": sampler.samples,
+                    "stacks": dict(sampler.stacks),
+                },
+            )
+
+        timeout_task: asyncio.Task = None
+
+        def on_timeout() -> None:
+            nonlocal timeout_task
+            timeout_task = asyncio.create_task(finish(truncated=True))
+
+        timer = asyncio.get_running_loop().call_later(
+            config.PROFILING_MAX_SECONDS, on_timeout
+        )
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            timer.cancel()
+            if timeout_task is not None:
+                await timeout_task
+            await finish(truncated=False)
@@ -1,19 +1,113 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 
+from app.enums import SatelliteProductEnum
+
+
+class AvailabilityGap(BaseModel):
+    start: datetime
+    end: datetime
+
+
+class DataAvailability(BaseModel):
+    earliest: Optional[datetime]
+    latest: Optional[datetime]
+    gaps: List[AvailabilityGap]
+    updated_at: Optional[datetime]
+
+
+class CatalogProductOut(BaseModel):
+    product: str
+    info: dict
+    availability: DataAvailability
+
+
+class CatalogRadarOut(BaseModel):
+    radar: str
+    product: str
+    background: bool
+    availability: DataAvailability
+
+
+class CatalogOut(BaseModel):
+    products: List[CatalogProductOut]
+    radars: List[CatalogRadarOut]
+
+
+class DependencyStatus(BaseModel):
+    name: str
+    healthy: bool
+    latency_ms: Optional[float]
+    checked_at: Optional[datetime]
+    error: Optional[str]
+
 
 class HealthCheck(BaseModel):
     status: str
 
 
+class ReadinessCheck(BaseModel):
+    status: str
+    dependencies: List[DependencyStatus]
+
+
+class StorageObjectNotification(BaseModel):
+    """A GCS object resource, as in the payload of an object change notification."""
+
+    bucket: str
+    name: str
+    generation: Optional[str]
+
+
+class PubSubMessage(BaseModel):
+    attributes: Dict[str, str] = {}
+    data: Optional[str]
+    message_id: Optional[str]
+
+
+class PubSubPushEnvelope(BaseModel):
+    message: PubSubMessage
+    subscription: Optional[str]
+
+
+class BigQueryLoadNotification(BaseModel):
+    table: str
+    start_time: datetime
+    end_time: datetime
+    products: Optional[List[SatelliteProductEnum]]
+
+
+class InvalidatedSeries(BaseModel):
+    series: str
+    days: List[str]
+
+
+class IngestionResult(BaseModel):
+    invalidated: List[InvalidatedSeries]
+
+
 class ImageSliderOut(BaseModel):
     timestamp: datetime
     image_url: str
 
 
+class RadarCompositeFrameOut(BaseModel):
+    timestamp: datetime
+    # Latest frame of each radar within the bucket starting at `timestamp`
+    radars: Dict[str, ImageSliderOut]
+
+
 class SatelliteChartDataOut(BaseModel):
     timestamp: datetime
     value: Optional[float]
+
+
+class ThresholdEventOut(BaseModel):
+    level: float
+    start: datetime
+    end: datetime
+    peak_time: datetime
+    peak_value: float
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import re
+import time
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import pandas as pd
+from fastapi import HTTPException
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud import bigquery
+from google.cloud.bigquery.query import _AbstractQueryParameter
+from loguru import logger
+from starlette.concurrency import run_in_threadpool
+
+from app import config
+from app.utils import get_bigquery_client
+
+
+@dataclass
+class QueryStatistics:
+    jobs: int = 0
+    cache_hits: int = 0
+    bytes_processed: int = 0
+    bytes_billed: int = 0
+    slot_ms: int = 0
+    elapsed_ms: float = 0
+
+
+# Reasons of the errors of jobs cancelled by `job_timeout_ms`, or stopped for going over
+# `maximum_bytes_billed`, which BigQuery reports as internal errors otherwise
+TIMEOUT_ERROR_REASONS = {"timeout"}
+BYTES_BILLED_ERROR_REASONS = {"bytesBilledLimitExceeded"}
+
+# Cumulative job statistics, keyed by (product, query shape)
+query_statistics: Dict[Tuple[str, str], QueryStatistics] = {}
+
+
+def get_query_shape(query: str) -> str:
+    """Identify a query by its text with whitespace normalized. Parameter values are not part of
+    the text, so every request for the same kind of query shares the same shape.
+    """
+    normalized = re.sub(r"\s+", " ", query).strip()
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def estimate_query_bytes(
+    query: str,
+    query_params: List[_AbstractQueryParameter] = None,
+    bigquery_client: bigquery.Client = None,
+) -> int:
+    """Estimate the bytes a query would process through a dry run, which is free.
+
+    Args:
+        query (str): The query.
+        query_params (List[_AbstractQueryParameter], optional): The query parameters.
+            Defaults to None.
+        bigquery_client (bigquery.Client, optional): The BigQuery client. Defaults to None.
+
+    Returns:
+        int: The estimated number of bytes processed.
+    """
+    bq_client = bigquery_client or get_bigquery_client()
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=query_params,
+        dry_run=True,
+        use_query_cache=False,
+    )
+    query_job = bq_client.query(query, job_config=job_config)
+    return query_job.total_bytes_processed or 0
+
+
+def get_error_reasons(exc: GoogleAPICallError, query_job: bigquery.QueryJob) -> set:
+    reasons = {error.get("reason") for error in exc.errors or []}
+    if query_job.error_result:
+        reasons.add(query_job.error_result.get("reason"))
+    return reasons
+
+
+def record_query_statistics(
+    query_job: bigquery.QueryJob, *, product: str, shape: str, elapsed_ms: float
+) -> None:
+    statistics = query_statistics.setdefault((product, shape), QueryStatistics())
+    statistics.jobs += 1
+    statistics.cache_hits += int(bool(query_job.cache_hit))
+    statistics.bytes_processed += query_job.total_bytes_processed or 0
+    statistics.bytes_billed += query_job.total_bytes_billed or 0
+    statistics.slot_ms += query_job.slot_millis or 0
+    statistics.elapsed_ms += elapsed_ms
+    logger.info(
+        f"BigQuery job {query_job.job_id} (product={product}, shape={shape}): "
+        f"cache_hit={query_job.cache_hit}, "
+        f"bytes_processed={query_job.total_bytes_processed}, "
+        f"bytes_billed={query_job.total_bytes_billed}, "
+        f"slot_ms={query_job.slot_millis}, elapsed_ms={elapsed_ms:.0f} | "
+        f"cumulative: jobs={statistics.jobs}, cache_hits={statistics.cache_hits}, "
+        f"bytes_billed={statistics.bytes_billed}, slot_ms={statistics.slot_ms}"
+    )
+
+
+def execute_query(
+    query: str,
+    query_params: List[_AbstractQueryParameter] = None,
+    *,
+    product: str = "unknown",
+    bigquery_client: bigquery.Client = None,
+) -> pd.DataFrame:
+    """Run a query with cost and latency guards, and record its job statistics.
+
+    The query is dry-run first and rejected if it would process more than
+    `BIGQUERY_MAXIMUM_BYTES_BILLED`. The actual job is then capped to that same amount of
+    billed bytes and to `BIGQUERY_JOB_TIMEOUT_SECONDS`, and uses the query cache unless
+    `BIGQUERY_USE_QUERY_CACHE` is disabled.
+
+    Args:
+        query (str): The query.
+        query_params (List[_AbstractQueryParameter], optional): The query parameters.
+            Defaults to None.
+        product (str, optional): The product the query is for, used to group the job
+            statistics. Defaults to "unknown".
+        bigquery_client (bigquery.Client, optional): The BigQuery client. Defaults to None.
+
+    Raises:
+        HTTPException: With status 400 if the query would process or bill too many bytes,
+            or with status 504 if the job doesn't complete in time, whether it is given up on
+            here or cancelled by BigQuery.
+
+    Returns:
+        pd.DataFrame: The query results.
+    """
+    bq_client = bigquery_client or get_bigquery_client()
+    shape = get_query_shape(query)
+
+    if config.BIGQUERY_DRY_RUN_ENABLE:
+        estimated_bytes = estimate_query_bytes(
+            query, query_params, bigquery_client=bq_client
+        )
+        logger.debug(f"Estimated bytes for shape {shape}: {estimated_bytes}")
+        if estimated_bytes > config.BIGQUERY_MAXIMUM_BYTES_BILLED:
+            logger.warning(
+                f"Rejected query (product={product}, shape={shape}) estimated at "
+                f"{estimated_bytes} bytes"
+            )
+            raise HTTPException(
+                status_code=400,
+                detail="This query would scan too much data. Try a smaller time range.",
+            )
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=query_params,
+        use_query_cache=config.BIGQUERY_USE_QUERY_CACHE,
+        maximum_bytes_billed=config.BIGQUERY_MAXIMUM_BYTES_BILLED,
+        job_timeout_ms=config.BIGQUERY_JOB_TIMEOUT_SECONDS * 1000,
+    )
+    started = time.perf_counter()
+    query_job = bq_client.query(query, job_config=job_config)
+    try:
+        query_job.result(timeout=config.BIGQUERY_JOB_TIMEOUT_SECONDS)
+    except FuturesTimeoutError:
+        logger.warning(
+            f"BigQuery job {query_job.job_id} (product={product}, shape={shape}) "
+            f"timed out after {config.BIGQUERY_JOB_TIMEOUT_SECONDS} seconds"
+        )
+        raise HTTPException(
+            status_code=504, detail="The query took too long to complete."
+        )
+    except GoogleAPICallError as exc:
+        reasons = get_error_reasons(exc, query_job)
+        if reasons & TIMEOUT_ERROR_REASONS:
+            logger.warning(
+                f"BigQuery job {query_job.job_id} (product={product}, shape={shape}) "
+                f"was cancelled by its timeout: {exc}"
+            )
+            raise HTTPException(
+                status_code=504, detail="The query took too long to complete."
+            )
+        if reasons & BYTES_BILLED_ERROR_REASONS:
+            logger.warning(
+                f"BigQuery job {query_job.job_id} (product={product}, shape={shape}) "
+                f"went over the bytes billed limit: {exc}"
+            )
+            raise HTTPException(
+                status_code=400,
+                detail="This query would scan too much data. Try a smaller time range.",
+            )
+        raise
+    data = query_job.to_dataframe()
+    record_query_statistics(
+        query_job,
+        product=product,
+        shape=shape,
+        elapsed_ms=(time.perf_counter() - started) * 1000,
+    )
+    return data
+
+
+async def execute_query_async(
+    query: str,
+    query_params: List[_AbstractQueryParameter] = None,
+    *,
+    product: str = "unknown",
+) -> pd.DataFrame:
+    """Same as `execute_query`, but runs in a worker thread so the BigQuery round trips
+    don't block the event loop."""
+    return await run_in_threadpool(execute_query, query, query_params, product=product)
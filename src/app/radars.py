@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from dataclasses import dataclass
+from typing import List
+
+from fastapi import HTTPException
+
+from app import config
+from app.enums import RadarEnum, RadarProductEnum
+
+
+def get_background_directory(background: bool) -> str:
+    return "with_background" if background else "without_background"
+
+
+@dataclass(frozen=True)
+class RadarLayer:
+    """A series of images of a radar: one product, with or without the map background."""
+
+    radar: RadarEnum
+    product: RadarProductEnum
+    background: bool = False
+
+    @property
+    def key(self) -> str:
+        """Identifies the layer in the availability index, e.g.
+        `mendanha/refletividade_horizontal/without_background`."""
+        return "/".join(
+            [
+                self.radar.value,
+                self.product.value,
+                get_background_directory(self.background),
+            ]
+        )
+
+    @property
+    def path_prefix(self) -> str:
+        mapping = config.RADARS_MAPPING[self.radar]
+        return (
+            f"{mapping['gcs_path_prefix']}{self.product.value}/"
+            f"{get_background_directory(self.background)}/without_colorbar/"
+        )
+
+    @property
+    def timestamp_format(self) -> str:
+        return config.RADARS_MAPPING[self.radar]["timestamp_format"]
+
+
+def get_radar_layers() -> List[RadarLayer]:
+    return [
+        RadarLayer(radar=radar, product=product, background=background)
+        for radar, mapping in config.RADARS_MAPPING.items()
+        for product in mapping["products"]
+        for background in [False, True]
+    ]
+
+
+def get_radar_layer(
+    radar: RadarEnum, product: RadarProductEnum, background: bool
+) -> RadarLayer:
+    """Get a layer of a radar.
+
+    Raises:
+        HTTPException: If the radar doesn't provide the product.
+    """
+    mapping = config.RADARS_MAPPING.get(radar)
+    if not mapping:
+        raise HTTPException(status_code=400, detail="Invalid radar")
+    if product not in mapping["products"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"The {radar.value} radar doesn't provide {product.value}.",
+        )
+    return RadarLayer(radar=radar, product=product, background=background)
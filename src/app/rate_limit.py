@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limiting and admission control.
+
+Every client gets a token bucket in Redis, shared by all replicas, keyed by its address and, if
+it sends one, by its API key as well. Requests spend tokens according to how expensive their
+route is, so a chart over a whole day costs more than a product's info. Independently, each
+replica caps how many expensive requests it serves at once and turns away the excess right
+away, so a burst can't pile up on the event loop and the BigQuery quota. Streams are capped
+the same way, apart, for as long as they're open. Cheap routes, and the health checks, are
+always let through.
+"""
+
+import hashlib
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import orjson as json
+import pendulum
+from loguru import logger
+from redis.commands.core import AsyncScript
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app import config
+from app.utils import get_redis_client
+
+# Token bucket over every key in KEYS, refilled at ARGV[1] tokens per second up to ARGV[2]
+# tokens. The request costs ARGV[3] tokens and is admitted only if every bucket can pay for it.
+# Returns whether it was admitted, the tokens left in the emptiest bucket and, if it wasn't,
+# the seconds until it would be.
+TOKEN_BUCKET_SCRIPT = """
+-- token_bucket
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local ttl = math.ceil(capacity / rate)
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local state = redis.call("HMGET", key, "tokens", "updated_at")
+    local available = tonumber(state[1]) or capacity
+    local updated_at = tonumber(state[2]) or now
+    available = math.min(capacity, available + math.max(0, now - updated_at) * rate)
+    tokens[i] = available
+    if available < cost then
+        wait = math.max(wait, (cost - available) / rate)
+    end
+end
+local remaining = capacity
+for i, key in ipairs(KEYS) do
+    local available = tokens[i]
+    if wait == 0 then
+        available = available - cost
+    end
+    redis.call("HSET", key, "tokens", available, "updated_at", now)
+    redis.call("EXPIRE", key, ttl)
+    remaining = math.min(remaining, available)
+end
+return {wait == 0 and 1 or 0, tostring(remaining), tostring(wait)}
+"""
+
+
+@dataclass(frozen=True)
+class RouteCost:
+    """Tokens a route costs: `base`, plus `per_hour` for each hour between the `start_time` and
+    `end_time` query parameters. Expensive routes are subject to admission control, and stream
+    routes take one of the open stream slots until the client goes away."""
+
+    base: float = 1
+    per_hour: float = 0
+    expensive: bool = False
+    stream: bool = False
+
+
+# Matched by path prefix, in order. Routes mapped to None are never limited.
+ROUTE_COSTS: List[Tuple[str, Optional[RouteCost]]] = [
+    ("/health", None),
+    ("/docs", None),
+    ("/redoc", None),
+    ("/openapi.json", None),
+    # Authenticated, and called by the ingestion pipelines only
+    ("/ingestion/", None),
+    # Authenticated, and used to diagnose the pods only
+    ("/profiling/", None),
+    ("/satellite/goes16/chart/", RouteCost(base=2, per_hour=1, expensive=True)),
+    ("/satellite/goes16/value/", RouteCost(base=2, per_hour=0.1, expensive=True)),
+    ("/satellite/goes16/gif/", RouteCost(base=2, per_hour=0.5, expensive=True)),
+    ("/satellite/goes16/render/", RouteCost(base=2, expensive=True)),
+    # Scans every reading of the area, but only for the days that aren't indexed yet
+    ("/satellite/goes16/events/", RouteCost(base=2, per_hour=0.25, expensive=True)),
+    ("/radar/", RouteCost(base=2, per_hour=0.5, expensive=True)),
+    ("/images/", RouteCost(base=1, expensive=True)),
+    # Paid once per connection, so clients reconnecting in a loop run out of tokens
+    ("/live/", RouteCost(base=10, stream=True)),
+]
+DEFAULT_ROUTE_COST = RouteCost()
+
+
+def get_route_cost(path: str) -> Optional[RouteCost]:
+    for prefix, cost in ROUTE_COSTS:
+        if path.startswith(prefix):
+            return cost
+    return DEFAULT_ROUTE_COST
+
+
+def get_request_cost(route_cost: RouteCost, query_string: bytes) -> float:
+    if not route_cost.per_hour:
+        return route_cost.base
+    params = parse_qs(query_string.decode("latin-1"))
+    try:
+        start_time = pendulum.parse(params["start_time"][0])
+        end_time = pendulum.parse(params["end_time"][0])
+        hours = max(0.0, (end_time - start_time).total_seconds() / 3600)
+    except Exception:
+        # Invalid or missing parameters are rejected by the endpoint itself
+        hours = 0.0
+    return route_cost.base + route_cost.per_hour * hours
+
+
+def get_client_address(scope: Scope) -> str:
+    """Address of the client, from the X-Forwarded-For entry appended by the outermost trusted
+    proxy. Entries to the left of it come from the client and are ignored."""
+    if config.RATE_LIMIT_TRUSTED_PROXY_HOPS > 0:
+        # Repeated headers are one list, in order
+        forwarded_for = [
+            entry.strip()
+            for name, value in scope.get("headers", [])
+            if name.lower() == b"x-forwarded-for"
+            for entry in value.decode("latin-1").split(",")
+            if entry.strip()
+        ]
+        if forwarded_for:
+            return forwarded_for[
+                max(0, len(forwarded_for) - config.RATE_LIMIT_TRUSTED_PROXY_HOPS)
+            ]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def get_client_keys(scope: Scope) -> List[str]:
+    """Rate limiting keys of a request: one for the client address and, if an API key is
+    sent, one for the key, so rotating keys doesn't get around the address limit."""
+    keys = [f"rate-limit:address:{get_client_address(scope)}"]
+    headers = {
+        name.decode("latin-1").lower(): value.decode("latin-1")
+        for name, value in scope.get("headers", [])
+    }
+    api_key = headers.get(config.RATE_LIMIT_API_KEY_HEADER.lower())
+    if api_key:
+        digest = hashlib.sha256(api_key.encode()).hexdigest()[:32]
+        keys.append(f"rate-limit:api-key:{digest}")
+    return keys
+
+
+@lru_cache(maxsize=1)
+def get_token_bucket_script() -> AsyncScript:
+    return get_redis_client().register_script(TOKEN_BUCKET_SCRIPT)
+
+
+async def take_tokens(keys: List[str], cost: float) -> Tuple[bool, float, float]:
+    """Take `cost` tokens from every bucket in `keys`.
+
+    Returns:
+        Tuple[bool, float, float]: Whether the request is admitted, the tokens left and the
+            seconds to wait before retrying.
+    """
+    capacity = config.RATE_LIMIT_BURST
+    admitted, remaining, wait = await get_token_bucket_script()(
+        keys=keys,
+        # A request costing more than the whole bucket could never be admitted
+        args=[config.RATE_LIMIT_TOKENS_PER_SECOND, capacity, min(cost, capacity)],
+    )
+    return bool(int(admitted)), float(remaining), float(wait)
+
+
+async def send_error(
+    send: Send, status_code: int, detail: str, headers: List[Tuple[bytes, bytes]]
+) -> None:
+    body = json.dumps({"detail": detail})
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                *headers,
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.inflight_expensive = 0
+        self.open_streams = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        route_cost = get_route_cost(scope["path"])
+        if route_cost is None:
+            await self.app(scope, receive, send)
+            return
+
+        # Admission control is checked first, as it doesn't need a round trip to Redis. The
+        # slot is taken right away, so concurrent requests can't all slip through.
+        if (
+            route_cost.expensive
+            and self.inflight_expensive >= config.ADMISSION_MAX_INFLIGHT_EXPENSIVE
+        ) or (
+            route_cost.stream and self.open_streams >= config.ADMISSION_MAX_OPEN_STREAMS
+        ):
+            await send_error(
+                send,
+                503,
+                "Server busy, please retry shortly",
+                [
+                    (
+                        b"retry-after",
+                        str(config.ADMISSION_RETRY_AFTER_SECONDS).encode(),
+                    )
+                ],
+            )
+            return
+        if route_cost.expensive:
+            self.inflight_expensive += 1
+        if route_cost.stream:
+            self.open_streams += 1
+        try:
+            if config.RATE_LIMIT_ENABLE:
+                cost = get_request_cost(route_cost, scope.get("query_string", b""))
+                try:
+                    admitted, remaining, wait = await take_tokens(
+                        get_client_keys(scope), cost
+                    )
+                except Exception as exc:
+                    # Redis being unavailable shouldn't take the API down with it
+                    logger.warning(
+                        f"Rate limiter unavailable, admitting request: {exc}"
+                    )
+                else:
+                    if not admitted:
+                        await send_error(
+                            send,
+                            429,
+                            "Rate limit exceeded",
+                            [
+                                (b"retry-after", str(math.ceil(wait)).encode()),
+                                (b"x-ratelimit-remaining", b"0"),
+                            ],
+                        )
+                        return
+                    send = self._with_headers(
+                        send,
+                        [(b"x-ratelimit-remaining", str(int(remaining)).encode())],
+                    )
+            await self.app(scope, receive, send)
+        finally:
+            if route_cost.expensive:
+                self.inflight_expensive -= 1
+            if route_cost.stream:
+                self.open_streams -= 1
+
+    @staticmethod
+    def _with_headers(send: Send, headers: List[Tuple[bytes, bytes]]) -> Send:
+        async def send_with_headers(message) -> None:
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message["headers"], *headers]}
+            await send(message)
+
+        return send_with_headers
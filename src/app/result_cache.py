@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Redis cache of frame listings and chart results, invalidated by ingestion events.
+
+Cached data is split by series (e.g. the frames of a product, or its metrics) and by local day.
+Each (series, day) pair has a version counter in Redis, and the version of every day a result
+covers is part of its cache key. An ingestion event only bumps the versions of the days it
+touches, which orphans exactly the entries built from them. So past days can be cached for a
+long time while new data still shows up as soon as it is announced. Results covering the
+current day get a short TTL as well, as a safety net for missed events.
+"""
+
+import hashlib
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import orjson as json
+import pendulum
+from fastapi.encoders import jsonable_encoder
+from loguru import logger
+from pendulum import DateTime
+from starlette.concurrency import run_in_threadpool
+
+from app import config
+from app.availability import availability_index
+from app.pydantic_models import ImageSliderOut
+from app.utils import get_redis_client
+
+
+def get_days(start_time: DateTime, end_time: DateTime) -> List[str]:
+    """Local days, as `YYYY-MM-DD`, between two timestamps (inclusive)."""
+    day = start_time.in_tz(config.TIMEZONE).start_of("day")
+    last_day = end_time.in_tz(config.TIMEZONE).start_of("day")
+    days = []
+    while day <= last_day:
+        days.append(day.format("YYYY-MM-DD"))
+        day = day.add(days=1)
+    return days
+
+
+def get_day_runs(days: List[str]) -> List[List[str]]:
+    """Split sorted days into runs of consecutive days."""
+    runs: List[List[str]] = []
+    previous = None
+    for day in days:
+        current = pendulum.parse(day, tz=config.TIMEZONE)
+        if previous is None or current != previous.add(days=1):
+            runs.append([])
+        runs[-1].append(day)
+        previous = current
+    return runs
+
+
+def get_version_key(series: str, day: str) -> str:
+    return f"cache-version:{series}:{day}"
+
+
+def get_ttl(days: List[str]) -> int:
+    today = pendulum.now(config.TIMEZONE).format("YYYY-MM-DD")
+    if days and days[-1] >= today:
+        return config.RESULT_CACHE_RECENT_TTL_SECONDS
+    return config.RESULT_CACHE_TTL_SECONDS
+
+
+async def get_versions(series: str, days: List[str]) -> List[int]:
+    versions = await get_redis_client().mget(
+        [get_version_key(series, day) for day in days]
+    )
+    return [int(version or 0) for version in versions]
+
+
+async def bump_versions(series: str, days: Iterable[str]) -> None:
+    """Invalidate everything cached from the given days of a series."""
+    pipeline = get_redis_client().pipeline(transaction=False)
+    for day in days:
+        pipeline.incr(get_version_key(series, day))
+    await pipeline.execute()
+
+
+async def invalidate_frames(key: str, frames: List[ImageSliderOut]) -> None:
+    """Listener of the availability index, so cached listings of the current day pick up the
+    frames found by its refreshes, which don't go through the ingestion notifications."""
+    days = {
+        pendulum.instance(frame.timestamp).in_tz(config.TIMEZONE).format("YYYY-MM-DD")
+        for frame in frames
+    }
+    await bump_versions(f"frames:{key}", sorted(days))
+
+
+async def get_day_results(
+    series: str,
+    days: List[str],
+    params: str,
+    compute: Callable[[List[str]], Awaitable[Dict[str, list]]],
+) -> List[list]:
+    """Get the result of each day of a series, computing the days that aren't cached with a
+    single call. `params` must identify everything else the results depend on.
+
+    Returns:
+        List[list]: The JSON-decoded result of each day, in order.
+    """
+    if not days:
+        return []
+    digest = hashlib.sha256(params.encode()).hexdigest()[:32]
+    redis = get_redis_client()
+    try:
+        versions = await get_versions(series, days)
+        entry_keys = [
+            f"{series}:{digest}:{day}:{version}" for day, version in zip(days, versions)
+        ]
+        entries = await redis.mget(entry_keys)
+    except Exception as exc:
+        logger.warning(f"Failed to read cached results of {series}: {exc}")
+        entry_keys, entries = None, [None] * len(days)
+
+    missing_days = [day for day, entry in zip(days, entries) if entry is None]
+    computed = await compute(missing_days) if missing_days else {}
+    results = []
+    for index, (day, entry) in enumerate(zip(days, entries)):
+        if entry is not None:
+            results.append(json.loads(entry))
+            continue
+        result = jsonable_encoder(computed.get(day, []))
+        results.append(result)
+        if entry_keys is not None:
+            try:
+                await redis.set(
+                    entry_keys[index], json.dumps(result), ex=get_ttl([day])
+                )
+            except Exception as exc:
+                logger.warning(f"Failed to cache results of {series}: {exc}")
+    return results
+
+
+async def get_frames(
+    key: str,
+    start_time: DateTime,
+    end_time: DateTime,
+    since: Optional[DateTime] = None,
+) -> List[ImageSliderOut]:
+    """List the frames of a series of the availability index between two timestamps
+    (inclusive), listing the bucket only for the days that aren't cached. Given a cursor
+    `since`, only the frames after it are listed, which only reads the days after it.
+    """
+    if since is not None and since > start_time:
+        start_time = since
+
+    async def list_days(days: List[str]) -> Dict[str, List[ImageSliderOut]]:
+        return {
+            day: [
+                ImageSliderOut(timestamp=timestamp, image_url=image_url)
+                for timestamp, image_url in await run_in_threadpool(
+                    availability_index.list_frames, key, day
+                )
+            ]
+            for day in days
+        }
+
+    results = await get_day_results(
+        f"frames:{key}", get_days(start_time, end_time), "", list_days
+    )
+    frames = [ImageSliderOut.parse_obj(item) for result in results for item in result]
+    return [
+        frame
+        for frame in frames
+        if start_time <= frame.timestamp <= end_time
+        and (since is None or frame.timestamp > since)
+    ]
+
+
+async def get_cached_result(
+    series: str,
+    start_time: DateTime,
+    end_time: DateTime,
+    params: str,
+    compute: Callable[[], Awaitable[list]],
+    get_cursor: Callable[[list], Optional[str]] = lambda result: None,
+) -> Tuple[bytes, Optional[str]]:
+    """Get a JSON-encoded result covering a time range of a series, computing and caching it
+    if needed. `params` must identify everything else the result depends on.
+
+    The cursor `get_cursor` takes from the result is cached next to it, so it doesn't take
+    decoding the cached result again.
+
+    Returns:
+        Tuple[bytes, Optional[str]]: The JSON-encoded result and its cursor.
+    """
+    days = get_days(start_time, end_time)
+    identity = f"{start_time.isoformat()}|{end_time.isoformat()}|{params}"
+    digest = hashlib.sha256(identity.encode()).hexdigest()[:32]
+    redis = get_redis_client()
+    cache_key: Optional[str] = None
+    try:
+        versions = await get_versions(series, days)
+        cache_key = f"{series}:{digest}:{'.'.join(str(v) for v in versions)}"
+        cached, cursor = await redis.mget([cache_key, f"{cache_key}:cursor"])
+        if cached is not None and cursor is not None:
+            return cached, cursor.decode() or None
+    except Exception as exc:
+        logger.warning(f"Failed to read cached result of {series}: {exc}")
+
+    result = await compute()
+    cursor = get_cursor(result)
+    # Plain lists and dicts are encoded by orjson alone, which is much faster than going
+    # through jsonable_encoder for results of millions of points
+    content = json.dumps(result, default=jsonable_encoder)
+    if cache_key is not None:
+        try:
+            ttl = get_ttl(days)
+            pipeline = redis.pipeline(transaction=False)
+            pipeline.set(cache_key, content, ex=ttl)
+            # Empty if the result has no cursor, to tell it apart from a missing one
+            pipeline.set(f"{cache_key}:cursor", cursor or "", ex=ttl)
+            await pipeline.execute()
+        except Exception as exc:
+            logger.warning(f"Failed to cache result of {series}: {exc}")
+    return content, cursor
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from typing import Tuple
+
+import orjson as json
+from fastapi import APIRouter, Request, Response
+from fastapi.encoders import jsonable_encoder
+
+from app.availability import SeriesAvailability, availability_index
+from app.products_info import PRODUCTS_INFO
+from app.pydantic_models import (
+    AvailabilityGap,
+    CatalogOut,
+    CatalogProductOut,
+    CatalogRadarOut,
+    DataAvailability,
+)
+from app.radars import get_radar_layers
+
+router = APIRouter(
+    tags=["Catalog"],
+    responses={
+        429: {"error": "Rate limit exceeded"},
+    },
+)
+
+# Serialized catalog and its ETag, along with the index version they were built from
+_catalog_cache: Tuple[int, bytes, str] = (-1, b"", "")
+
+
+def to_data_availability(availability: SeriesAvailability) -> DataAvailability:
+    return DataAvailability(
+        earliest=availability.earliest,
+        latest=availability.latest,
+        gaps=[
+            AvailabilityGap(start=start, end=end) for start, end in availability.gaps
+        ],
+        updated_at=availability.updated_at,
+    )
+
+
+def build_catalog() -> CatalogOut:
+    products = [
+        CatalogProductOut(
+            product=product.value,
+            info=info,
+            availability=to_data_availability(availability_index.get(product.value)),
+        )
+        for product, info in PRODUCTS_INFO.items()
+    ]
+    radars = [
+        CatalogRadarOut(
+            radar=layer.radar.value,
+            product=layer.product.value,
+            background=layer.background,
+            availability=to_data_availability(availability_index.get(layer.key)),
+        )
+        for layer in get_radar_layers()
+    ]
+    return CatalogOut(products=products, radars=radars)
+
+
+def get_serialized_catalog() -> Tuple[bytes, str]:
+    """Serialize the catalog, only when the availability index changed since last time."""
+    global _catalog_cache
+    version, content, etag = _catalog_cache
+    if version != availability_index.version:
+        version = availability_index.version
+        content = json.dumps(jsonable_encoder(build_catalog()))
+        etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        _catalog_cache = (version, content, etag)
+    return content, etag
+
+
+@router.get(
+    "/catalog",
+    summary="Get all products and the time ranges where they have data",
+    response_model=CatalogOut,
+    responses={304: {"description": "Not Modified"}},
+)
+async def get_catalog(request: Request):
+    content, etag = get_serialized_catalog()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from typing import Optional
+
+from fastapi import APIRouter, Query, Request, Response
+
+from app import config
+from app.enums import ImageFormatEnum
+from app.image_proxy import get_rendition
+
+router = APIRouter(
+    prefix="/images",
+    tags=["Images"],
+    responses={
+        429: {"error": "Rate limit exceeded"},
+    },
+)
+
+
+@router.get(
+    "/{path:path}",
+    summary="Get an image from the bucket, resized and transcoded",
+    response_class=Response,
+    responses={200: {"content": {"image/webp": {}, "image/png": {}}}},
+)
+async def get_image(
+    request: Request,
+    path: str,
+    width: Optional[int] = Query(None, description="Width to downscale the image to"),
+    image_format: ImageFormatEnum = Query(ImageFormatEnum.WEBP, alias="format"),
+):
+    rendition = await get_rendition(path, width, image_format)
+    # Renditions only change if the BLOB is overwritten, which the URL doesn't tell, so clients
+    # reuse them for a while and then revalidate them with the ETag
+    headers = {
+        "ETag": rendition.etag,
+        "Cache-Control": f"public, max-age={config.IMAGE_PROXY_MAX_AGE_SECONDS}",
+    }
+    if request.headers.get("if-none-match") == rendition.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(
+        content=rendition.content, media_type=rendition.media_type, headers=headers
+    )
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import secrets
+from typing import Optional, Union
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+
+from app import config
+from app.ingestion import (
+    OBJECT_FINALIZE,
+    handle_load_event,
+    handle_object_event,
+    parse_pubsub_envelope,
+)
+from app.pydantic_models import (
+    BigQueryLoadNotification,
+    IngestionResult,
+    PubSubPushEnvelope,
+    StorageObjectNotification,
+)
+
+
+def verify_ingestion_token(
+    authorization: Optional[str] = Header(None),
+    token: Optional[str] = Query(
+        None,
+        description="Alternative to the Authorization header, for push subscriptions",
+    ),
+):
+    if not config.INGESTION_WEBHOOK_TOKEN:
+        raise HTTPException(
+            status_code=503, detail="The ingestion webhook is not configured."
+        )
+    if authorization and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer ") :]
+    if not token or not secrets.compare_digest(
+        token.encode(), config.INGESTION_WEBHOOK_TOKEN.encode()
+    ):
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+
+router = APIRouter(
+    prefix="/ingestion",
+    tags=["Ingestion"],
+    dependencies=[Depends(verify_ingestion_token)],
+    include_in_schema=False,
+)
+
+
+@router.post(
+    "/gcs",
+    summary="Notify new or deleted objects in the bucket",
+    response_model=IngestionResult,
+)
+async def notify_gcs_object(
+    notification: Union[PubSubPushEnvelope, StorageObjectNotification],
+):
+    # Pub/Sub push subscriptions wrap the notification in an envelope
+    event_type = OBJECT_FINALIZE
+    if isinstance(notification, PubSubPushEnvelope):
+        event_type = notification.message.attributes.get("eventType")
+        notification = parse_pubsub_envelope(notification)
+        if notification is None:
+            return IngestionResult(invalidated=[])
+    return IngestionResult(
+        invalidated=await handle_object_event(notification, event_type)
+    )
+
+
+@router.post(
+    "/bigquery",
+    summary="Notify data loaded into a BigQuery table",
+    response_model=IngestionResult,
+)
+async def notify_bigquery_load(notification: BigQueryLoadNotification):
+    return IngestionResult(invalidated=await handle_load_event(notification))
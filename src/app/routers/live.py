@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from app import config
+from app.live_updates import format_sse_message, get_topics, live_updates_broker
+
+router = APIRouter(
+    prefix="/live",
+    tags=["Live updates"],
+    responses={
+        429: {"error": "Rate limit exceeded"},
+    },
+)
+
+
+@router.get(
+    "/sse",
+    summary="Stream new frames and metric points as Server-Sent Events",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}}},
+)
+async def stream_live_updates(
+    topics: str = Query(
+        ...,
+        description=(
+            "Comma-separated topics, e.g. `satellite/goes16/gif/cp,"
+            "radar/mendanha/refletividade_horizontal/without_background` or "
+            "`satellite/goes16/chart/ki`"
+        ),
+    ),
+):
+    requested = {topic.strip() for topic in topics.split(",") if topic.strip()}
+    unknown = requested - get_topics()
+    if not requested or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid topics: {', '.join(sorted(unknown)) or topics}",
+        )
+
+    subscriber = live_updates_broker.subscribe(requested)
+
+    async def event_stream():
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        subscriber.queue.get(),
+                        timeout=config.LIVE_UPDATES_KEEPALIVE_SECONDS,
+                    )
+                except asyncio.TimeoutError:
+                    if subscriber.overflowed:
+                        # Dropped for falling behind; the client reconnects and
+                        # catches up through the regular endpoints
+                        return
+                    message = None
+                yield format_sse_message(message)
+        finally:
+            live_updates_broker.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import secrets
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+
+from app import config
+from app.enums import ProfileFormatEnum
+from app.profiling import get_profile
+
+
+def verify_profiling_token(authorization: Optional[str] = Header(None)):
+    if not config.PROFILING_TOKEN:
+        raise HTTPException(status_code=503, detail="Profiling is not configured.")
+    token = None
+    if authorization and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer ") :]
+    if not token or not secrets.compare_digest(
+        token.encode(), config.PROFILING_TOKEN.encode()
+    ):
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+
+router = APIRouter(
+    prefix="/profiling",
+    tags=["Profiling"],
+    dependencies=[Depends(verify_profiling_token)],
+    include_in_schema=False,
+)
+
+
+@router.get(
+    "/{profile_id}",
+    summary="Get the profile of a request",
+    response_model=dict,
+)
+async def get_request_profile(
+    profile_id: str,
+    profile_format: ProfileFormatEnum = Query(
+        ProfileFormatEnum.JSON,
+        alias="format",
+        description="`collapsed` returns the stacks for flamegraph.pl or speedscope",
+    ),
+):
+    profile = await get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if profile_format == ProfileFormatEnum.COLLAPSED:
+        content = "".join(
+            f"{stack} {count}\n" for stack, count in profile["stacks"].items()
+        )
+        return Response(content=content, media_type="text/plain")
+    return profile
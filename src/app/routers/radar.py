@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime
-from typing import List
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 
-from fastapi import APIRouter
+import orjson as json
+from fastapi import APIRouter, HTTPException, Query, Request, Response
 from pendulum import DateTime
 
 from app import config
-from app.pydantic_models import ImageSliderOut
-from app.utils import get_matching_blobs, sanity_check_time_range
+from app.enums import ImageFormatEnum, RadarEnum, RadarProductEnum
+from app.image_proxy import to_proxy_urls
+from app.pydantic_models import ImageSliderOut, RadarCompositeFrameOut
+from app.radars import get_radar_layer
+from app.result_cache import get_frames
+from app.utils import (
+    parse_datetime_to_pendulum_datetime,
+    sanity_check_time_range,
+    set_cursor,
+)
 
 router = APIRouter(
     prefix="/radar",
@@ -18,20 +28,14 @@ router = APIRouter(
 )
 
 
-@router.get(
-    "/mendanha",
-    summary="Get GIF from Mendanha Radar",
-    response_model=List[ImageSliderOut],
-)
-async def get_mendanha_radar_data(
-    start_time: datetime,
-    end_time: datetime,
-):
+def parse_time_range(
+    start_time: datetime, end_time: datetime
+) -> Tuple[DateTime, DateTime]:
     # Sanity checks
     start_time, end_time = sanity_check_time_range(
         start_time,
         end_time,
-        max_allowed_range_seconds=config.SATELLITE_GIF_MAX_ALLOWED_RANGE_SECONDS,
+        max_allowed_range_seconds=config.RADAR_DATA_MAX_ALLOWED_RANGE_SECONDS,
     )
 
     # Parse start_time and end_time to pendulum.DateTime
@@ -39,12 +43,165 @@ async def get_mendanha_radar_data(
     start_time = start_time.in_tz(config.TIMEZONE)
     end_time = DateTime.instance(end_time, tz=config.TIMEZONE)
     end_time = end_time.in_tz(config.TIMEZONE)
+    return start_time, end_time
 
-    # Get blob URLs list
-    path_prefix = "cor-clima-imagens/radar/mendanha/refletividade_horizontal/without_background/without_colorbar/"
-    return get_matching_blobs(
-        start_time=start_time,
-        end_time=end_time,
-        path_prefix=path_prefix,
-        timestamp_format="YYYY-MM-DD-HH-mm-ss",  # TODO: Modify this when the new format is set
+
+def parse_radars(radars: str) -> List[RadarEnum]:
+    """Parse a comma-separated list of radars, keeping their order and dropping repeats.
+
+    Raises:
+        HTTPException: If a radar is unknown.
+    """
+    parsed: List[RadarEnum] = []
+    for name in radars.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        try:
+            radar = RadarEnum(name)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Unknown radar: {name}")
+        if radar not in parsed:
+            parsed.append(radar)
+    if not parsed:
+        raise HTTPException(status_code=400, detail="No radar was given.")
+    return parsed
+
+
+def align_frames(frames: Dict[str, List[ImageSliderOut]], bucket_seconds: int) -> bytes:
+    """Merge the frames of several radars into one timeline of buckets of `bucket_seconds`,
+    keeping the latest frame of each radar within each bucket. Radars without a frame in a
+    bucket are left out of it.
+
+    Returns:
+        bytes: The timeline, JSON-encoded as a list of `RadarCompositeFrameOut`. It is built
+            from plain dicts since validating thousands of nested models takes longer than
+            listing the frames.
+    """
+    starts: Dict[int, datetime] = {}
+    buckets: Dict[int, Dict[str, ImageSliderOut]] = {}
+    for radar, radar_frames in frames.items():
+        for frame in radar_frames:
+            seconds = frame.timestamp.timestamp()
+            bucket = int(seconds // bucket_seconds)
+            if bucket not in starts:
+                # Shifting the frame's own timestamp keeps its timezone
+                starts[bucket] = frame.timestamp - timedelta(
+                    seconds=seconds - bucket * bucket_seconds
+                )
+            latest = buckets.setdefault(bucket, {}).get(radar)
+            if latest is None or frame.timestamp > latest.timestamp:
+                buckets[bucket][radar] = frame
+    return json.dumps(
+        [
+            {
+                "timestamp": starts[bucket].isoformat(),
+                "radars": {
+                    radar: {
+                        "timestamp": frame.timestamp.isoformat(),
+                        "image_url": frame.image_url,
+                    }
+                    for radar, frame in buckets[bucket].items()
+                },
+            }
+            for bucket in sorted(buckets)
+        ]
     )
+
+
+@router.get(
+    "/composite",
+    summary="Get the frames of several radars, aligned on a common timeline",
+    response_model=List[RadarCompositeFrameOut],
+)
+async def get_radar_composite_data(
+    request: Request,
+    start_time: datetime,
+    end_time: datetime,
+    since: Optional[datetime] = Query(
+        None,
+        description=(
+            "Only return the frames after this cursor, taken from the X-Cursor header "
+            "of a previous response"
+        ),
+    ),
+    radars: str = Query(
+        ...,
+        description="Comma-separated radars, e.g. `mendanha`",
+    ),
+    product: RadarProductEnum = RadarProductEnum.HORIZONTAL_REFLECTIVITY,
+    background: bool = Query(False, description="Images with the map background"),
+    bucket_seconds: int = Query(
+        300, ge=60, le=3600, description="Width of the timeline buckets"
+    ),
+    width: Optional[int] = Query(
+        None, description="Return image proxy URLs for this width"
+    ),
+    image_format: Optional[ImageFormatEnum] = Query(
+        None, alias="format", description="Return image proxy URLs for this format"
+    ),
+):
+    start_time, end_time = parse_time_range(start_time, end_time)
+    if since is not None:
+        since = parse_datetime_to_pendulum_datetime(since)
+    layers = [
+        get_radar_layer(radar, product, background) for radar in parse_radars(radars)
+    ]
+
+    # List every radar concurrently
+    listings = await asyncio.gather(
+        *[get_frames(layer.key, start_time, end_time, since) for layer in layers]
+    )
+    base_url = str(request.base_url)
+    frames = {
+        layer.radar.value: to_proxy_urls(listing, base_url, width, image_format)
+        for layer, listing in zip(layers, listings)
+    }
+    response = Response(
+        content=align_frames(frames, bucket_seconds), media_type="application/json"
+    )
+    set_cursor(
+        response,
+        [frame.timestamp for listing in listings for frame in listing],
+        since,
+    )
+    return response
+
+
+@router.get(
+    "/{radar}",
+    summary="Get GIF from a radar",
+    response_model=List[ImageSliderOut],
+)
+async def get_radar_data(
+    request: Request,
+    response: Response,
+    radar: RadarEnum,
+    start_time: datetime,
+    end_time: datetime,
+    since: Optional[datetime] = Query(
+        None,
+        description=(
+            "Only return the frames after this cursor, taken from the X-Cursor header "
+            "of a previous response"
+        ),
+    ),
+    product: RadarProductEnum = RadarProductEnum.HORIZONTAL_REFLECTIVITY,
+    background: bool = Query(False, description="Images with the map background"),
+    width: Optional[int] = Query(
+        None, description="Return image proxy URLs for this width"
+    ),
+    image_format: Optional[ImageFormatEnum] = Query(
+        None, alias="format", description="Return image proxy URLs for this format"
+    ),
+):
+    start_time, end_time = parse_time_range(start_time, end_time)
+    layer = get_radar_layer(radar, product, background)
+
+    if since is not None:
+        since = parse_datetime_to_pendulum_datetime(since)
+
+    # Get blob URLs list
+    frames = await get_frames(layer.key, start_time, end_time, since)
+    set_cursor(response, [frame.timestamp for frame in frames], since)
+    return to_proxy_urls(frames, str(request.base_url), width, image_format)
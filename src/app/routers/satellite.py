@@ -1,21 +1,44 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
-from math import isnan
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
-from fastapi import APIRouter, HTTPException
-from google.cloud import bigquery
+import orjson as json
+import pandas as pd
+import pendulum
+from fastapi import APIRouter, HTTPException, Query, Request, Response
 from loguru import logger
-from pendulum import DateTime, parse as pendulum_parse
+from pendulum import DateTime
+from starlette.concurrency import run_in_threadpool
 
 from app import config
-from app.enums import SatelliteProductEnum
-from app.pydantic_models import ImageSliderOut, SatelliteChartDataOut
+from app.data_sources import get_data_source
+from app.downsampling import downsample_points
+from app.enums import ImageFormatEnum, SatelliteProductEnum
+from app.events import get_events
+from app.gridded_data import sample_gridded_values
+from app.image_proxy import to_proxy_urls
+from app.metrics_mirror import metrics_mirror
+from app.palettes import parse_color_stops, render_frame
+from app.pydantic_models import (
+    ImageSliderOut,
+    SatelliteChartDataOut,
+    ThresholdEventOut,
+)
 from app.products_info import PRODUCTS_INFO
+from app.query_executor import execute_query_async
+from app.result_cache import (
+    get_cached_result,
+    get_day_results,
+    get_day_runs,
+    get_days,
+    get_frames,
+)
+from app.spatial_index import spatial_index
 from app.utils import (
-    get_data_from_bigquery,
-    get_matching_blobs,
+    get_chart_points,
+    parse_datetime_to_pendulum_datetime,
     sanity_check_time_range,
+    set_cursor,
 )
 
 router = APIRouter(
@@ -36,20 +59,36 @@ async def get_satellite_chart(
     product: SatelliteProductEnum,
     start_time: datetime,
     end_time: datetime,
+    since: Optional[datetime] = Query(
+        None,
+        description=(
+            "Only return the points after this cursor, taken from the X-Cursor header "
+            "of a previous response"
+        ),
+    ),
+    lat: Optional[float] = Query(None, description="Latitude of a point of interest"),
+    lon: Optional[float] = Query(None, description="Longitude of a point of interest"),
+    bairro: Optional[str] = Query(None, description="Name of a neighborhood"),
+    max_points: Optional[int] = Query(
+        None,
+        ge=3,
+        le=10000,
+        description=(
+            "Downsample the series to at most this many points, keeping its peaks. "
+            "Incremental refreshes with `since` return their new points as they are"
+        ),
+    ),
 ):
-    def map_to_models(row):
-        return SatelliteChartDataOut(
-            timestamp=pendulum_parse(row["data_medicao"], tz="America/Sao_Paulo"),
-            value=row["valor"]
-            if row["valor"] and not isnan(float(row["valor"]))
-            else None,
+    # Sanity checks. Ranges longer than BigQuery is queried for are read from the local mirror.
+    max_allowed_range_seconds = config.SATELLITE_GIF_MAX_ALLOWED_RANGE_SECONDS
+    if config.METRICS_MIRROR_ENABLE:
+        max_allowed_range_seconds = max(
+            max_allowed_range_seconds, config.METRICS_MIRROR_DAYS * 86400
         )
-
-    # Sanity checks
     start_time, end_time = sanity_check_time_range(
         start_time,
         end_time,
-        max_allowed_range_seconds=config.SATELLITE_GIF_MAX_ALLOWED_RANGE_SECONDS,
+        max_allowed_range_seconds=max_allowed_range_seconds,
     )
 
     # Parse start_time and end_time to pendulum.DateTime
@@ -57,51 +96,205 @@ async def get_satellite_chart(
     start_time = start_time.in_tz(config.TIMEZONE)
     end_time = DateTime.instance(end_time, tz=config.TIMEZONE)
     end_time = end_time.in_tz(config.TIMEZONE)
+    use_mirror = (
+        end_time - start_time
+    ).total_seconds() > config.SATELLITE_GIF_MAX_ALLOWED_RANGE_SECONDS
+
+    # Resolve the requested location, if any, into grid cells. Points are answered with the
+    # nearest measurement point within their cells, so the point is part of the results' key.
+    cells = spatial_index.resolve_cells(lat=lat, lon=lon, bairro=bairro)
+    lat_lon = (lat, lon) if lat is not None else None
+    location = f"cells={cells}" if lat_lon is None else f"cells={cells}|point={lat_lon}"
 
-    # If it's RR or SST, we still got no data
-    if product in [
-        SatelliteProductEnum.RAIN_RATE,
-        SatelliteProductEnum.OCEAN_TEMPERATURE,
-    ]:
+    source = get_data_source(product)
+    column = config.SATELLITE_PRODUCTS_MAPPING[product]["column"]
+    location_filter, location_params = "", []
+    if cells is not None and not source.has_coordinates:
         raise HTTPException(
-            status_code=501, detail="This product is not implemented yet."
+            status_code=501,
+            detail="Location filters are not available for this product.",
+        )
+    if cells is not None:
+        location_filter, location_params = spatial_index.get_query_filter(
+            cells,
+            lat_column=source.latitude_column,
+            lon_column=source.longitude_column,
         )
 
-    table = config.BIGQUERY_TABLE_METRICAS_GEOESPACIAIS
-    mapping = config.SATELLITE_PRODUCTS_MAPPING.get(product, None)
-    if not mapping:
-        raise HTTPException(status_code=400, detail="Invalid product")
-    column = mapping.get("column")
-    if not column:
+    async def query_bigquery(start: DateTime, end: DateTime) -> pd.DataFrame:
+        query_filter, query_params = source.get_query_filter(start, end)
+        coordinates = ""
+        if lat_lon is not None:
+            coordinates = (
+                f", {source.latitude_column} AS latitude, "
+                f"{source.longitude_column} AS longitude"
+            )
+        query = f"""
+        SELECT
+            {source.timestamp_expression} AS data_medicao,
+            {source.value_column} AS valor{coordinates}
+        FROM {source.table}
+        WHERE
+            {query_filter}
+            {location_filter}
+        """
+        query_params += location_params
+        logger.debug(f"Query: {query}")
+        logger.debug(f"Query Params: {query_params}")
+        data = await execute_query_async(
+            query=query, query_params=query_params, product=product.value
+        )
+        if lat_lon is not None:
+            data = spatial_index.select_nearest(data, *lat_lon)
+        return data
+
+    async def query_mirror() -> pd.DataFrame:
+        # The mirror has the past days, the current one is still being loaded into BigQuery
+        today = pendulum.now(config.TIMEZONE).start_of("day")
+        frames = []
+        if start_time < today:
+            history_end = min(end_time, today.subtract(microseconds=1))
+            days = get_days(start_time, history_end)
+            if days[0] < metrics_mirror.get_sync_days()[-1]:
+                raise HTTPException(
+                    status_code=400,
+                    detail=(
+                        f"Only the last {config.METRICS_MIRROR_DAYS} days are available "
+                        "for long time ranges."
+                    ),
+                )
+            missing_days = await metrics_mirror.prepare(product, days)
+            frames.append(
+                await run_in_threadpool(
+                    metrics_mirror.query,
+                    column,
+                    start_time,
+                    history_end,
+                    cells,
+                    lat_lon,
+                )
+            )
+            # Days not synced yet, such as the one that just ended or every day on a new
+            # replica, are queried from BigQuery, within the same budget as any query
+            for run in get_day_runs(missing_days):
+                run_start = pendulum.parse(run[0], tz=config.TIMEZONE)
+                run_end = pendulum.parse(run[-1], tz=config.TIMEZONE).end_of("day")
+                try:
+                    frames.append(
+                        await query_bigquery(
+                            max(start_time, run_start), min(history_end, run_end)
+                        )
+                    )
+                except HTTPException as exc:
+                    if exc.status_code != 400:
+                        raise
+                    raise HTTPException(
+                        status_code=503,
+                        detail="This time range is still being synced. Try again later.",
+                    )
+        if end_time >= today:
+            frames.append(await query_bigquery(max(start_time, today), end_time))
+        return pd.concat(frames, ignore_index=True)
+
+    async def run_query() -> List[dict]:
+        if use_mirror:
+            data = await query_mirror()
+        else:
+            data = await query_bigquery(start_time, end_time)
+        data.drop_duplicates(inplace=True)
+
+        logger.debug(f"Data:\n{data}")
+
+        return await run_in_threadpool(get_chart_points, data)
+
+    def get_timestamp(point: dict) -> datetime:
+        return datetime.fromisoformat(point["timestamp"])
+
+    def get_cursor(points: List[dict]) -> Optional[str]:
+        cursor = max((get_timestamp(point) for point in points), default=None)
+        return cursor.isoformat() if cursor is not None else None
+
+    async def get_points() -> Tuple[bytes, Optional[str]]:
+        # Results are kept until new data for the days they cover is ingested
+        return await get_cached_result(
+            f"metrics:{product.value}",
+            start_time,
+            end_time,
+            location,
+            run_query,
+            get_cursor,
+        )
+
+    async def run_downsampling() -> List[dict]:
+        content, _ = await get_points()
+        return await run_in_threadpool(
+            downsample_points, json.loads(content), max_points
+        )
+
+    if since is None:
+        if max_points is None:
+            content, cursor = await get_points()
+        else:
+            # Downsampled series are built from the full one, and cached alongside it
+            content, cursor = await get_cached_result(
+                f"metrics:{product.value}",
+                start_time,
+                end_time,
+                f"{location}|max_points={max_points}",
+                run_downsampling,
+                get_cursor,
+            )
+        response = Response(content=content, media_type="application/json")
+        if cursor is not None:
+            response.headers[config.CURSOR_HEADER] = cursor
+        return response
+
+    # Incremental refreshes are served from the points of each day, shared by every client
+    # polling the same product and location, so they only cost what is new
+    since = parse_datetime_to_pendulum_datetime(since)
+    refresh_start = max(start_time, since)
+    if (
+        end_time - refresh_start
+    ).total_seconds() > config.SATELLITE_GIF_MAX_ALLOWED_RANGE_SECONDS:
         raise HTTPException(
-            status_code=501, detail="This product is not implemented yet."
+            status_code=400,
+            detail=(
+                "since must be less than or equal to "
+                f"{config.SATELLITE_GIF_MAX_ALLOWED_RANGE_SECONDS} seconds before end_time."
+            ),
         )
-    query = f"""
-    SELECT
-        data_medicao,
-        valor
-    FROM {table}
-    WHERE
-        data_medicao BETWEEN @start_time AND @end_time
-        AND produto_satelite = @column
-    """
-    query_params = [
-        bigquery.ScalarQueryParameter(
-            "start_time", "STRING", start_time.format("YYYY-MM-DD HH:mm:ss")
-        ),
-        bigquery.ScalarQueryParameter(
-            "end_time", "STRING", end_time.format("YYYY-MM-DD HH:mm:ss")
-        ),
-        bigquery.ScalarQueryParameter("column", "STRING", column),
-    ]
-    logger.debug(f"Query: {query}")
-    logger.debug(f"Query Params: {query_params}")
-    data = get_data_from_bigquery(query=query, query_params=query_params)
-    data.drop_duplicates(inplace=True)
 
-    logger.debug(f"Data:\n{data}")
+    async def query_days(days: List[str]) -> Dict[str, List[dict]]:
+        data = await query_bigquery(
+            pendulum.parse(days[0], tz=config.TIMEZONE),
+            pendulum.parse(days[-1], tz=config.TIMEZONE).end_of("day"),
+        )
+        data.drop_duplicates(inplace=True)
+        if data.empty:
+            return {}
+        data.sort_values("data_medicao", kind="stable", inplace=True)
+        points: Dict[str, List[dict]] = {}
+        for point in await run_in_threadpool(get_chart_points, data):
+            # Timestamps are local, so they start with their day
+            points.setdefault(point["timestamp"][:10], []).append(point)
+        return points
 
-    return data.apply(map_to_models, axis=1).tolist()
+    results = await get_day_results(
+        f"metrics:{product.value}",
+        get_days(refresh_start, end_time),
+        location,
+        query_days,
+    )
+    points = [
+        point
+        for result in results
+        for point in result
+        if since < get_timestamp(point)
+        and refresh_start <= get_timestamp(point) <= end_time
+    ]
+    response = Response(content=json.dumps(points), media_type="application/json")
+    set_cursor(response, [get_timestamp(point) for point in points], since)
+    return response
 
 
 @router.get(
@@ -110,9 +303,24 @@ async def get_satellite_chart(
     response_model=List[ImageSliderOut],
 )
 async def get_satellite_gif(
+    request: Request,
+    response: Response,
     product: SatelliteProductEnum,
     start_time: datetime,
     end_time: datetime,
+    since: Optional[datetime] = Query(
+        None,
+        description=(
+            "Only return the frames after this cursor, taken from the X-Cursor header "
+            "of a previous response"
+        ),
+    ),
+    width: Optional[int] = Query(
+        None, description="Return image proxy URLs for this width"
+    ),
+    image_format: Optional[ImageFormatEnum] = Query(
+        None, alias="format", description="Return image proxy URLs for this format"
+    ),
 ):
     # Sanity checks
     start_time, end_time = sanity_check_time_range(
@@ -136,13 +344,158 @@ async def get_satellite_gif(
         raise HTTPException(
             status_code=501, detail="This product is not implemented yet."
         )
-    path_prefix = "cor-clima-imagens/satelite/goes16/without_background/"
-    blob_name_prefix = f"{gcs_product_prefix}_"
-    return get_matching_blobs(
-        start_time=start_time,
-        end_time=end_time,
-        path_prefix=path_prefix,
-        blob_name_prefix=blob_name_prefix,
+    if since is not None:
+        since = parse_datetime_to_pendulum_datetime(since)
+    frames = await get_frames(product.value, start_time, end_time, since)
+    set_cursor(response, [frame.timestamp for frame in frames], since)
+    return to_proxy_urls(frames, str(request.base_url), width, image_format)
+
+
+@router.get(
+    "/goes16/value/{product}",
+    summary="Get values of a GOES16 product at a point or small area",
+    response_model=List[SatelliteChartDataOut],
+)
+async def get_satellite_value(
+    product: SatelliteProductEnum,
+    start_time: datetime,
+    end_time: datetime,
+    lat: Optional[float] = Query(None, description="Latitude of the point"),
+    lon: Optional[float] = Query(None, description="Longitude of the point"),
+    bbox: Optional[str] = Query(
+        None,
+        description="Area to average over, as min_lon,min_lat,max_lon,max_lat",
+    ),
+):
+    # Sanity checks
+    start_time, end_time = sanity_check_time_range(
+        start_time,
+        end_time,
+        max_allowed_range_seconds=config.GRIDDED_DATA_MAX_ALLOWED_RANGE_SECONDS,
+    )
+    if (lat is None) != (lon is None):
+        raise HTTPException(
+            status_code=400, detail="Both lat and lon must be provided."
+        )
+    if (lat is None) == (bbox is None):
+        raise HTTPException(
+            status_code=400, detail="Either lat/lon or bbox must be provided."
+        )
+    bbox_values = None
+    if bbox is not None:
+        try:
+            bbox_values = [float(value) for value in bbox.split(",")]
+        except ValueError:
+            bbox_values = []
+        if len(bbox_values) != 4:
+            raise HTTPException(
+                status_code=400,
+                detail="bbox must be formatted as min_lon,min_lat,max_lon,max_lat.",
+            )
+        min_lon, min_lat, max_lon, max_lat = bbox_values
+        if min_lon >= max_lon or min_lat >= max_lat:
+            raise HTTPException(status_code=400, detail="Invalid bbox.")
+        if (
+            max_lon - min_lon > config.GRIDDED_DATA_MAX_BBOX_DEGREES
+            or max_lat - min_lat > config.GRIDDED_DATA_MAX_BBOX_DEGREES
+        ):
+            raise HTTPException(
+                status_code=400,
+                detail=f"The bbox is too large. Each side must be less than or equal to {config.GRIDDED_DATA_MAX_BBOX_DEGREES} degrees.",
+            )
+
+    # Reading from the local cache is blocking I/O
+    return await run_in_threadpool(
+        sample_gridded_values,
+        product,
+        start_time,
+        end_time,
+        lat=lat,
+        lon=lon,
+        bbox=bbox_values,
+    )
+
+
+@router.get(
+    "/goes16/events/{product}",
+    summary="Get the intervals when a GOES16 product crossed its alert levels",
+    response_model=List[ThresholdEventOut],
+)
+async def get_satellite_events(
+    product: SatelliteProductEnum,
+    start_time: datetime,
+    end_time: datetime,
+    level: Optional[float] = Query(
+        None, description="Only return the events of this alert level"
+    ),
+):
+    # Sanity checks
+    start_time, end_time = sanity_check_time_range(
+        start_time,
+        end_time,
+        max_allowed_range_seconds=config.EVENTS_MAX_ALLOWED_RANGE_SECONDS,
+    )
+
+    # Parse start_time and end_time to pendulum.DateTime
+    start_time = DateTime.instance(start_time, tz=config.TIMEZONE)
+    start_time = start_time.in_tz(config.TIMEZONE)
+    end_time = DateTime.instance(end_time, tz=config.TIMEZONE)
+    end_time = end_time.in_tz(config.TIMEZONE)
+
+    return await get_events(product, start_time, end_time, level)
+
+
+@router.get(
+    "/goes16/render/{product}",
+    summary="Render a GOES16 frame with a custom palette or threshold",
+    response_class=Response,
+    responses={200: {"content": {"image/webp": {}, "image/png": {}}}},
+)
+async def render_satellite_frame(
+    request: Request,
+    product: SatelliteProductEnum,
+    timestamp: datetime = Query(
+        ..., description="The latest frame at or before this time is rendered"
+    ),
+    colors: Optional[str] = Query(
+        None,
+        description=(
+            "Palette as value:#RRGGBB pairs, interpolated in between, e.g. "
+            "`0:#0000FF,2000:#FF0000`. Defaults to the product legend"
+        ),
+    ),
+    min_value: Optional[float] = Query(
+        None, description="Values below this one are left transparent"
+    ),
+    max_value: Optional[float] = Query(
+        None, description="Values above this one are left transparent"
+    ),
+    opacity: Optional[float] = Query(
+        None,
+        ge=0,
+        le=1,
+        description="Defaults to the legend opacity with the legend palette, 1 otherwise",
+    ),
+    width: Optional[int] = Query(None, description="Width to scale the image to"),
+    image_format: ImageFormatEnum = Query(ImageFormatEnum.WEBP, alias="format"),
+):
+    timestamp = DateTime.instance(timestamp, tz=config.TIMEZONE).in_tz(config.TIMEZONE)
+    stops = parse_color_stops(colors) if colors else None
+    rendition = await render_frame(
+        product,
+        timestamp,
+        stops=stops,
+        min_value=min_value,
+        max_value=max_value,
+        opacity=opacity,
+        width=width,
+        image_format=image_format,
+    )
+    headers = {"ETag": rendition.etag, "Cache-Control": "public, max-age=86400"}
+    if request.headers.get("if-none-match") == rendition.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(
+        content=rendition.content, media_type=rendition.media_type, headers=headers
     )
 
 
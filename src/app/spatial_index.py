@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import unicodedata
+from math import cos, floor, radians
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import cartopy.io.shapereader as shpreader
+import fiona
+import numpy as np
+import pandas as pd
+import shapely
+from fastapi import HTTPException
+from google.cloud import bigquery
+from google.cloud.bigquery.query import _AbstractQueryParameter
+from loguru import logger
+
+from app import config
+from app.utils import get_shapefile_path
+
+
+def normalize_name(name: str) -> str:
+    """Normalize a place name for lookups: no accents, case-insensitive and with single
+    spaces, so "Jacarepaguá", "jacarepagua" and "JACAREPAGUA " are the same neighborhood.
+    """
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(stripped.casefold().split())
+
+
+class SpatialIndex:
+    """Regular lat/lon grid over the city, plus the grid cells covered by each neighborhood.
+
+    Cells are identified by `row * n_cols + col`, where `row` and `col` are counted from the
+    south-west corner of the extent. The same formula is applied in BigQuery to the
+    measurement coordinates, so a query can be pruned to a set of cells.
+    """
+
+    def __init__(self, extent: List[float], resolution: float):
+        min_lon, min_lat, max_lon, max_lat = extent
+        self.resolution = resolution
+        # Snap the origin to the resolution so cell boundaries don't depend on the extent
+        self.origin_lon = floor(min_lon / resolution) * resolution
+        self.origin_lat = floor(min_lat / resolution) * resolution
+        self.n_cols = int(np.ceil((max_lon - self.origin_lon) / resolution))
+        self.n_rows = int(np.ceil((max_lat - self.origin_lat) / resolution))
+        self.neighborhoods: Dict[str, List[int]] = {}
+        self.neighborhoods_loaded = False
+
+    def cell_of(self, lat: float, lon: float) -> Optional[int]:
+        row = floor((lat - self.origin_lat) / self.resolution)
+        col = floor((lon - self.origin_lon) / self.resolution)
+        if not (0 <= row < self.n_rows and 0 <= col < self.n_cols):
+            return None
+        return row * self.n_cols + col
+
+    def neighbor_cells(self, cell: int) -> List[int]:
+        """A cell and its 8 neighbors, those within the grid."""
+        row, col = divmod(cell, self.n_cols)
+        return [
+            neighbor_row * self.n_cols + neighbor_col
+            for neighbor_row in range(max(row - 1, 0), min(row + 2, self.n_rows))
+            for neighbor_col in range(max(col - 1, 0), min(col + 2, self.n_cols))
+        ]
+
+    def cells_of(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Same as `cell_of` for arrays of coordinates, with -1 for points out of the grid."""
+        rows = np.floor((lats - self.origin_lat) / self.resolution).astype(np.int64)
+        cols = np.floor((lons - self.origin_lon) / self.resolution).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.n_rows) & (cols >= 0) & (cols < self.n_cols)
+        return np.where(inside, rows * self.n_cols + cols, -1)
+
+    def cell_bounds(self, cells: List[int]) -> Tuple[float, float, float, float]:
+        """Bounding box (min_lon, min_lat, max_lon, max_lat) of a set of cells."""
+        rows, cols = np.divmod(np.asarray(cells), self.n_cols)
+        return (
+            float(self.origin_lon + cols.min() * self.resolution),
+            float(self.origin_lat + rows.min() * self.resolution),
+            float(self.origin_lon + (cols.max() + 1) * self.resolution),
+            float(self.origin_lat + (rows.max() + 1) * self.resolution),
+        )
+
+    def load_neighborhoods(self, shapefile_path: Path, name_field: str) -> None:
+        """Compute the cells covered by each neighborhood polygon of a shapefile. A cell belongs
+        to a neighborhood when its center lies inside the polygon; neighborhoods smaller than
+        a cell get the cell of a point inside them.
+        """
+        fiona.os.environ["SHAPE_RESTORE_SHX"] = "YES"
+        reader = shpreader.Reader(shapefile_path)
+        rows, cols = np.mgrid[0 : self.n_rows, 0 : self.n_cols]
+        center_lats = self.origin_lat + (rows.ravel() + 0.5) * self.resolution
+        center_lons = self.origin_lon + (cols.ravel() + 0.5) * self.resolution
+        neighborhoods: Dict[str, List[int]] = {}
+        for record in reader.records():
+            name = normalize_name(str(record.attributes[name_field]))
+            geometry = record.geometry
+            inside = np.flatnonzero(
+                shapely.contains_xy(geometry, center_lons, center_lats)
+            )
+            cells = inside.tolist()
+            if not cells:
+                point = geometry.representative_point()
+                cell = self.cell_of(point.y, point.x)
+                cells = [cell] if cell is not None else []
+            neighborhoods[name] = sorted(set(neighborhoods.get(name, []) + cells))
+        self.neighborhoods = neighborhoods
+        self.neighborhoods_loaded = True
+        logger.info(f"Spatial index built for {len(neighborhoods)} neighborhoods")
+
+    def resolve_cells(
+        self,
+        *,
+        lat: Optional[float] = None,
+        lon: Optional[float] = None,
+        bairro: Optional[str] = None,
+    ) -> Optional[List[int]]:
+        """Resolve the location parameters of a request into grid cells. A point resolves to
+        its cell and the 8 around it: measurements are on a grid of their own, so the cell of
+        the point may have none, but the block reaches farther than half their spacing on
+        every side, so it has the nearest one, which `select_nearest` then keeps.
+
+        Raises:
+            HTTPException: If the parameters are inconsistent, out of the grid or unknown.
+
+        Returns:
+            Optional[List[int]]: The matching cells, or None if no location was requested.
+        """
+        if bairro is not None and (lat is not None or lon is not None):
+            raise HTTPException(
+                status_code=400,
+                detail="Either lat/lon or bairro must be provided, not both.",
+            )
+        if (lat is None) != (lon is None):
+            raise HTTPException(
+                status_code=400, detail="Both lat and lon must be provided."
+            )
+        if lat is not None:
+            cell = self.cell_of(lat, lon)
+            if cell is None:
+                raise HTTPException(
+                    status_code=400, detail="The location is outside the covered area."
+                )
+            return self.neighbor_cells(cell)
+        if bairro is not None:
+            if not self.neighborhoods_loaded:
+                raise HTTPException(
+                    status_code=503,
+                    detail="The neighborhood index is not available at the moment.",
+                )
+            cells = self.neighborhoods.get(normalize_name(bairro))
+            if not cells:
+                raise HTTPException(status_code=400, detail="Invalid bairro")
+            return cells
+        return None
+
+    @staticmethod
+    def select_nearest(data: pd.DataFrame, lat: float, lon: float) -> pd.DataFrame:
+        """Keep the `data_medicao` and `valor` of the measurement point nearest to a location
+        at each timestamp, out of rows with `latitude` and `longitude`."""
+        # Equirectangular distances, which rank points correctly at this scale
+        distances = (data["latitude"] - lat) ** 2 + (
+            (data["longitude"] - lon) * cos(radians(lat))
+        ) ** 2
+        nearest = (
+            data.assign(distance=distances)
+            .sort_values(["data_medicao", "distance"], kind="stable")
+            .drop_duplicates("data_medicao")
+        )
+        return nearest[["data_medicao", "valor"]].reset_index(drop=True)
+
+    def get_query_filter(
+        self,
+        cells: List[int],
+        *,
+        lat_column: str = config.BIGQUERY_LATITUDE_COLUMN,
+        lon_column: str = config.BIGQUERY_LONGITUDE_COLUMN,
+    ) -> Tuple[str, List[_AbstractQueryParameter]]:
+        """Build a WHERE clause fragment restricting rows to a set of cells. The bounding box
+        condition comes first so BigQuery can prune by the clustered coordinates before the
+        exact cell check.
+        """
+        min_lon, min_lat, max_lon, max_lat = self.cell_bounds(cells)
+        query_filter = f"""
+        AND {lat_column} BETWEEN @min_lat AND @max_lat
+        AND {lon_column} BETWEEN @min_lon AND @max_lon
+        AND CAST(FLOOR(({lat_column} - @grid_origin_lat) / @grid_resolution) AS INT64) * @grid_cols
+            + CAST(FLOOR(({lon_column} - @grid_origin_lon) / @grid_resolution) AS INT64)
+            IN UNNEST(@cells)
+        """
+        query_params = [
+            bigquery.ScalarQueryParameter("min_lat", "FLOAT64", min_lat),
+            bigquery.ScalarQueryParameter("max_lat", "FLOAT64", max_lat),
+            bigquery.ScalarQueryParameter("min_lon", "FLOAT64", min_lon),
+            bigquery.ScalarQueryParameter("max_lon", "FLOAT64", max_lon),
+            bigquery.ScalarQueryParameter(
+                "grid_origin_lat", "FLOAT64", self.origin_lat
+            ),
+            bigquery.ScalarQueryParameter(
+                "grid_origin_lon", "FLOAT64", self.origin_lon
+            ),
+            bigquery.ScalarQueryParameter(
+                "grid_resolution", "FLOAT64", self.resolution
+            ),
+            bigquery.ScalarQueryParameter("grid_cols", "INT64", self.n_cols),
+            bigquery.ArrayQueryParameter("cells", "INT64", cells),
+        ]
+        return query_filter, query_params
+
+
+spatial_index = SpatialIndex(
+    extent=config.SPATIAL_GRID_EXTENT, resolution=config.SPATIAL_GRID_RESOLUTION
+)
+
+
+def load_spatial_index() -> None:
+    """Load the neighborhoods into the spatial index. Failures are logged and leave the index
+    able to answer lat/lon lookups only."""
+    try:
+        spatial_index.load_neighborhoods(
+            get_shapefile_path("Limite_Bairros_RJ"),
+            config.SHAPEFILE_NEIGHBORHOOD_NAME_FIELD,
+        )
+    except Exception as exc:
+        logger.error(
+            f"Failed to load neighborhoods, bairro filters are disabled: {exc}"
+        )
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import base64
 import os
+import tempfile
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import cartopy.crs as ccrs
 import cartopy.io.shapereader as shpreader
@@ -14,13 +16,16 @@ import orjson as json
 import pandas as pd
 import pendulum
 import xarray as xr
-from fastapi import HTTPException
+from fastapi import HTTPException, Response
+from google.auth.credentials import with_scopes_if_required
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery, storage
-from google.cloud.bigquery.query import _AbstractQueryParameter
 from google.cloud.storage import Blob
 from google.oauth2 import service_account
 from loguru import logger
 from pendulum import DateTime
+from redis.asyncio import Redis
+from requests.adapters import HTTPAdapter
 
 from app import config
 from app.pydantic_models import ImageSliderOut
@@ -56,11 +61,8 @@ def create_and_save_image(data: xr.DataArray, info: dict, variable) -> Path:
     #     print("File not found.")
 
     # Add coastlines, borders and gridlines
-    shapefile_dir = Path(
-        "/opt/venv/lib/python3.9/site-packages/pipelines/utils/shapefiles"
-    )
-    shapefile_path_neighborhood = shapefile_dir / "Limite_Bairros_RJ.shp"
-    shapefile_path_state = shapefile_dir / "Limite_Estados_BR_IBGE.shp"
+    shapefile_path_neighborhood = get_shapefile_path("Limite_Bairros_RJ")
+    shapefile_path_state = get_shapefile_path("Limite_Estados_BR_IBGE")
 
     logger.info("\nImporting shapefiles")
     fiona.os.environ["SHAPE_RESTORE_SHX"] = "YES"
@@ -116,8 +118,9 @@ def create_and_save_image(data: xr.DataArray, info: dict, variable) -> Path:
     return save_image_path
 
 
+@lru_cache(maxsize=1)
 def get_bigquery_client() -> bigquery.Client:
-    """Get the BigQuery client.
+    """Get the BigQuery client. The client is created once and shared by the whole process.
 
     Returns:
         bigquery.Client: The BigQuery client.
@@ -126,25 +129,28 @@ def get_bigquery_client() -> bigquery.Client:
     return bigquery.Client(credentials=credentials, project=credentials.project_id)
 
 
+@lru_cache(maxsize=1)
 def get_gcs_client() -> storage.Client:
-    """Get the Google Cloud Storage client.
+    """Get the Google Cloud Storage client. The client is created once and shared by the whole
+    process.
 
     Returns:
         storage.Client: The Google Cloud Storage client.
     """
     credentials = get_gcp_credentials()
-    return storage.Client(credentials=credentials, project=credentials.project_id)
-
-
-def get_data_from_bigquery(
-    query: str,
-    query_params: List[_AbstractQueryParameter] = None,
-    bigquery_client: bigquery.Client = None,
-) -> pd.DataFrame:
-    bq_client = bigquery_client or get_bigquery_client()
-    job_config = bigquery.QueryJobConfig(query_parameters=query_params)
-    query_job = bq_client.query(query, job_config=job_config)
-    return query_job.to_dataframe()
+    # The default session keeps only 10 connections per host, which concurrent downloads
+    # exhaust, so the client gets a session with a larger pool
+    session = AuthorizedSession(
+        with_scopes_if_required(credentials, storage.Client.SCOPE)
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config.GCS_HTTP_POOL_SIZE,
+        pool_maxsize=config.GCS_HTTP_POOL_SIZE,
+    )
+    session.mount("https://", adapter)
+    return storage.Client(
+        credentials=credentials, project=credentials.project_id, _http=session
+    )
 
 
 def get_gcp_credentials(scopes: List[str] = None) -> service_account.Credentials:
@@ -223,20 +229,15 @@ def get_matching_blobs(
     matching_urls: List[ImageSliderOut] = []
 
     for blob in blobs:
-        blob_name: str = blob.name
-        logger.debug(f"Blob name: {blob_name}")
-        # Extract the date and time from the BLOB name
-        parts = blob_name.split("/")
-        logger.debug(f"Parts: {parts}")
-        if len(parts) < 2:
-            continue
-        timestamp_str = (
-            parts[-1].replace(blob_extension, "").replace(blob_name_prefix, "")
+        timestamp = parse_blob_timestamp(
+            blob.name,
+            blob_name_prefix=blob_name_prefix,
+            blob_extension=blob_extension,
+            timestamp_format=timestamp_format,
+            timezone=timezone,
         )
-        logger.debug(f"Timestamp str: {timestamp_str}")
-        # Parse the timestamp with America/Sao_Paulo timezone
-        logger.debug(f"Timestamp str: {timestamp_str}")
-        timestamp = pendulum.from_format(timestamp_str, timestamp_format, tz=timezone)
+        if timestamp is None:
+            continue
 
         # Check if the product matches and the timestamp is within the specified range
         if start_time <= timestamp <= end_time:
@@ -247,6 +248,92 @@ def get_matching_blobs(
     return matching_urls
 
 
+def get_shapefile_path(name: str) -> Path:
+    """Get the path of a shapefile in `SHAPEFILES_DIR`, downloading its files from
+    `SHAPEFILES_GCS_PREFIX` first if it isn't there.
+
+    Args:
+        name (str): The name of the shapefile, without extension.
+
+    Raises:
+        FileNotFoundError: If the shapefile isn't in the bucket either.
+
+    Returns:
+        Path: The path of its `.shp` file.
+    """
+    shapefile_dir = Path(config.SHAPEFILES_DIR)
+    path = shapefile_dir / f"{name}.shp"
+    if path.exists():
+        return path
+    prefix = f"{config.SHAPEFILES_GCS_PREFIX}{name}."
+    blobs = list(get_gcs_client().list_blobs(config.GCS_BUCKET_NAME, prefix=prefix))
+    if not any(blob.name.endswith(".shp") for blob in blobs):
+        raise FileNotFoundError(
+            f"Shapefile {name} is neither in {shapefile_dir} nor at "
+            f"gs://{config.GCS_BUCKET_NAME}/{prefix}shp"
+        )
+    shapefile_dir.mkdir(parents=True, exist_ok=True)
+    # The .shp goes last, so a shapefile that exists is complete
+    for blob in sorted(blobs, key=lambda blob: blob.name.endswith(".shp")):
+        target = shapefile_dir / blob.name[len(config.SHAPEFILES_GCS_PREFIX) :]
+        descriptor, temporary_path = tempfile.mkstemp(dir=shapefile_dir, suffix=".tmp")
+        os.close(descriptor)
+        blob.download_to_filename(temporary_path)
+        os.replace(temporary_path, target)
+    logger.info(
+        f"Downloaded shapefile {name} from gs://{config.GCS_BUCKET_NAME}/{prefix}*"
+    )
+    return path
+
+
+@lru_cache(maxsize=1)
+def get_redis_client() -> Redis:
+    """Get the Redis client. The client, and therefore its connection pool, is created once and
+    shared by the whole process.
+
+    Returns:
+        Redis: The Redis client.
+    """
+    return Redis(
+        host=config.REDIS_HOST,
+        port=config.REDIS_PORT,
+        db=config.REDIS_DB,
+        password=config.REDIS_PASSWORD,
+    )
+
+
+def parse_blob_timestamp(
+    blob_name: str,
+    *,
+    blob_name_prefix: str = "",
+    blob_extension: str = ".png",
+    timestamp_format: str = "YYYY-MM-DD HH:mm:ss",
+    timezone: str = "America/Sao_Paulo",
+) -> Optional[DateTime]:
+    """Extract the timestamp from the name of a BLOB.
+
+    Args:
+        blob_name (str): The full name of the BLOB, including its path.
+        blob_name_prefix (str, optional): The prefix of the BLOB names. Defaults to an empty
+            string.
+        blob_extension (str, optional): The extension of the BLOBs. Defaults to ".png".
+        timestamp_format (str, optional): The format of the timestamp in the BLOB names.
+            Defaults to "YYYY-MM-DD HH:mm:ss".
+        timezone (str, optional): The timezone of the timestamps. Defaults to "America/Sao_Paulo".
+
+    Returns:
+        Optional[DateTime]: The timestamp, or None if the BLOB is not inside a directory.
+    """
+    logger.debug(f"Blob name: {blob_name}")
+    parts = blob_name.split("/")
+    if len(parts) < 2:
+        return None
+    timestamp_str = parts[-1].replace(blob_extension, "").replace(blob_name_prefix, "")
+    logger.debug(f"Timestamp str: {timestamp_str}")
+    # Parse the timestamp with America/Sao_Paulo timezone
+    return pendulum.from_format(timestamp_str, timestamp_format, tz=timezone)
+
+
 def parse_datetime_to_pendulum_datetime(datetime: datetime) -> DateTime:
     dt = DateTime.instance(datetime)
     dt = dt.in_tz(config.TIMEZONE)
@@ -282,3 +369,48 @@ def sanity_check_time_range(
             )
 
     return start_time, end_time
+
+
+def set_cursor(
+    response: Response, timestamps: List[datetime], since: Optional[DateTime]
+) -> None:
+    """Set the cursor a client sends back as `since` to only get what is newer: the latest
+    timestamp returned, or the one it sent if there is nothing new."""
+    cursor = max(timestamps, default=since)
+    if cursor is not None:
+        response.headers[config.CURSOR_HEADER] = cursor.isoformat()
+
+
+def format_utc_offset(seconds: int) -> str:
+    sign = "-" if seconds < 0 else "+"
+    seconds = abs(seconds)
+    return f"{sign}{seconds // 3600:02d}:{seconds % 3600 // 60:02d}"
+
+
+def get_chart_points(data: pd.DataFrame) -> List[dict]:
+    """Convert `data_medicao` and `valor` rows into chart points, as `SatelliteChartDataOut`
+    would serialize them. Long ranges have millions of rows, so columns are converted at once
+    rather than through a model per row."""
+    timestamps = pd.to_datetime(data["data_medicao"], format="%Y-%m-%d %H:%M:%S")
+    # Times skipped or repeated by DST changes are resolved like pendulum does
+    timestamps = timestamps.dt.tz_localize(
+        config.TIMEZONE, ambiguous=False, nonexistent=pd.Timedelta(hours=1)
+    )
+    local_times = timestamps.dt.tz_localize(None)
+    # There are only a couple of distinct offsets, so each is formatted once
+    offsets = (
+        (local_times - timestamps.dt.tz_convert(None)).dt.total_seconds().astype(int)
+    )
+    formatted = np.char.add(
+        np.datetime_as_string(local_times.to_numpy(), unit="s"),
+        offsets.map({offset: format_utc_offset(offset) for offset in offsets.unique()})
+        .to_numpy()
+        .astype(str),
+    )
+    values = pd.to_numeric(data["valor"], errors="coerce").astype(float)
+    # Zeros were always returned without a value, like missing values
+    values = values.astype(object).where(values.notna() & (values != 0), None)
+    return [
+        {"timestamp": timestamp, "value": value}
+        for timestamp, value in zip(formatted.tolist(), values.tolist())
+    ]